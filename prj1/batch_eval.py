@@ -2,36 +2,95 @@
 a program for evaluating the quality of search algorithms using the vector model
 
 it runs over all queries in query.text and get the top 10 results,
-and then qrels.text is used to compute the NDCG metric
+and then qrels.text is used to compute the NDCG metric (and MAP, P@10
+and recall@10; see metrics.py)
 
 usage:
-    python batch_eval.py index_file query.text qrels.text
+    python batch_eval.py index_file query.text qrels.text n [--seed s]
+        [--workers w] [--stages] [--profile [file]] [--tracemalloc]
 
     output is the average NDCG over all the queries
 
+    n is the number of queries: picked at random, repeats allowed, or
+    without repeats and reproducibly with a seed. n can also be "all",
+    for every query in query.text. With more than one worker the queries
+    are split into chunks, in order, over a pool of processes that each
+    load the index once; results come back in query order, so the
+    averages and p-values do not depend on the number of workers.
+
+    --stages, --profile and --tracemalloc are described in instrument.py;
+    stage times and counters from the workers are added up, while the
+    profile and heap snapshots only cover the main process.
+
 '''
 
 from cranqry import loadCranQry
-from random import choice
+from random import choice, Random
+from multiprocessing import Pool
+from time import perf_counter
+import argparse
 from query import QueryProcessor
 from cran import CranFile
 from index import InvertedIndex, IndexItem, Posting
-from metrics import ndcg_score
-from scipy.stats import wilcoxon, ttest_ind
+from segments import open_index
+import metrics
+import resultcache
+import instrument
+from resources import data_path
 from sys import argv
 
 # Values to set (using the init function)
-n = 10
+n = 10 # None for every query
 index_file = ""
 query_path = ""
 qrels_path = ""
+seed = None
+workers = 1
+options = None # the parsed command line
+
+# The index (and collection, if needed) of this process
+_loaded = {}
+
+def _load(path, stages=False):
+    ''' load the index once per process '''
+    # Workers time their stages too, when the main process does
+    instrument.enable(stages)
+    
+    # Load up the inverted index (plain or segmented)
+    ii = open_index(path)
+    
+    # Doc lengths come from the index; only indexes saved without them
+    #   need the document collection
+    cf = None if ii.doc_lengths else CranFile(data_path("cran.all"))
+    _loaded.update(index=ii, collection=cf)
+
+def run_queries(queries):
+    ''' (boolean top 10, vector top 10) docIDs of each query text, in order, against the index loaded in this process '''
+    ii, cf = _loaded['index'], _loaded['collection']
+    
+    # Run the vector queries as one batch (see matrix.py)
+    vector_results = QueryProcessor.vectorQueries(queries, ii, 10, cf)
+    
+    results = []
+    for text, vector_result in zip(queries, vector_results):
+        # Run bool query
+        # NOTE: There is no weighting on the bool query, so its first 10
+        #   docs (by docID) are its ranking
+        bool_result = QueryProcessor(text, ii, cf).booleanQuery()[:10]
+        results.append((bool_result, [doc for doc, _ in vector_result]))
+    return results
+
+def _run_chunk(queries):
+    ''' run_queries in a worker, with the stages it timed '''
+    results = run_queries(queries)
+    return results, instrument.take() if instrument.enabled else None
 
 def eval():
 
     # Algorithm:
-        # Pick N random samples from query.txt
-        # Get top 10 results from bool query for each rnd query
-        # Get top 10 results from vector query for each rnd query
+        # Pick N samples from query.txt (or take them all)
+        # Get top 10 results from bool query for each query
+        # Get top 10 results from vector query for each query
         # Compute NDCG btn bool query results and qrels.txt
         # Compute NDCG btn vector query results and qrels.txt
         # Get p-value btn bool and vector
@@ -40,110 +99,124 @@ def eval():
     qc = loadCranQry(query_path)
     poss_queries = list(qc)
     
-    # Load up the inverted index
-    ii = InvertedIndex()
-    ii.load(index_file)
-    
-    # Load up the document collection
-    cf = CranFile("cran.all")
+    # Get ground-truth results from qrels.txt, as {query: {doc: gain}}
+    qrel_dict = metrics.load_qrels(qrels_path)
     
-    # Get ground-truth results from qrels.txt
-    with open(qrels_path) as f:
-        qrels = f.readlines()
-        
-    # Index qrels into a dict
-    qrel_dict = {}
-    for qrel in qrels:
-        qrel_split = qrel.split()
-        if int(qrel_split[0]) in qrel_dict:
-            qrel_dict[int(qrel_split[0])].append(int(qrel_split[1]))
-        else:
-            qrel_dict[int(qrel_split[0])] = [int(qrel_split[1])]
-    
-    # Run over N random queries, collecting NDCGs
-    bool_ndcgs = []
-    vector_ndcgs = []
-    for _ in range(n):
-        # Get random query ID
-        query_id = choice(poss_queries)
-        
-        # Get the query
-        if 0 < int(query_id) < 10:
-            query_id = '00' + str(int(query_id))
-        elif 9 < int(query_id) < 100:
-            query_id = '0' + str(int(query_id))
-        try: 
-            query = qc[query_id].text
-        except KeyError:
-            print("Invalid query id", query_id)
+    # Pick the queries
+    if n is None:
+        query_ids = poss_queries
+    elif seed is not None:
+        if n > len(poss_queries):
+            print("Only", len(poss_queries), "queries to sample from")
             return
+        query_ids = Random(seed).sample(poss_queries, n)
+    else:
+        query_ids = []
+        for _ in range(n):
+            # Get random query ID
+            query_id = choice(poss_queries)
             
-        # Initialize the query processor
-        qp = QueryProcessor(query, ii, cf)
-        
-        # Run bool query
-        bool_result = qp.booleanQuery()[:10]
-            
-        # Run vector query
-        vector_result = qp.vectorQuery(10)
-            
-        # Pull top 10 ground-truth results from qrels dict
-        gt_results = qrel_dict[poss_queries.index(query_id)+1][:10]
-            
-        # Compute NDCG for bool query
-        # NOTE: There is no weighting on the bool query, so give all an even 1
-        truth_vector = list(map(lambda x: x in gt_results, bool_result))
-        bool_ndcg = ndcg_score(truth_vector, [1] * len(truth_vector), k=len(truth_vector))
-        
-        # Compute NDCG for vector query
-        vector_docs = []
-        vector_scores = []
-        for v in vector_result:
-            vector_docs.append(v[0])
-            vector_scores.append(v[1])
-        truth_vector = list(map(lambda x: x in gt_results, vector_docs))
-        vector_ndcg = ndcg_score(truth_vector, vector_scores, k=len(truth_vector))
-        
-        # Accumulate NDCGs
-        bool_ndcgs.append(bool_ndcg)
-        vector_ndcgs.append(vector_ndcg)
-        
-    # Average out score lists
-    bool_avg = 0
-    for bool in bool_ndcgs:
-        bool_avg += bool
-    bool_avg /= len(bool_ndcgs)
+            # Get the query
+            if 0 < int(query_id) < 10:
+                query_id = '00' + str(int(query_id))
+            elif 9 < int(query_id) < 100:
+                query_id = '0' + str(int(query_id))
+            if query_id not in qc:
+                print("Invalid query id", query_id)
+                return
+            query_ids.append(query_id)
     
-    vector_avg = 0
-    for vector in vector_ndcgs:
-        vector_avg += vector
-    vector_avg /= len(vector_ndcgs)
+    queries = [qc[query_id].text for query_id in query_ids]
+    
+    # Run the queries, collecting results in query order
+    start = perf_counter()
+    if workers <= 1:
+        _load(index_file, instrument.enabled)
+        results = run_queries(queries)
+    else:
+        # A few chunks per worker evens out the load
+        chunk_size = max(1, -(-len(queries) // (workers * 4)))
+        chunks = [queries[i : i + chunk_size]
+            for i in range(0, len(queries), chunk_size)]
+        results = []
+        with Pool(workers, initializer=_load,
+                  initargs=(index_file, instrument.enabled)) as pool:
+            for part, taken in pool.imap(_run_chunk, chunks):
+                results.extend(part)
+                if taken is not None:
+                    instrument.merge(taken)
+    elapsed = perf_counter() - start
     
-    # Present averages and p-values
-    print("Boolean NDCG average:", bool_avg)
-    print("Vector NDCG average:", vector_avg)
-    if n > 19:
+    # Score every query at once against all of its relevant docs; qrels
+    #   number the queries by their position in query.text
+    gains = metrics.qrels_matrix([qrel_dict.get(
+        poss_queries.index(query_id)+1, {}) for query_id in query_ids])
+    bool_scores = metrics.evaluate(metrics.rankings_matrix(
+        [b for b, _ in results], 10), gains, k=10)
+    vector_scores = metrics.evaluate(metrics.rankings_matrix(
+        [v for _, v in results], 10), gains, k=10)
+    bool_ndcgs = bool_scores['ndcg']
+    vector_ndcgs = vector_scores['ndcg']
+    
+    # Present averages and p-values (scipy.stats is slow to import, so
+    #   only load it here)
+    from scipy.stats import wilcoxon, ttest_ind
+    print("Boolean NDCG average:", bool_ndcgs.mean())
+    print("Vector NDCG average:", vector_ndcgs.mean())
+    if len(results) > 19:
         print("Wilcoxon p-value:", wilcoxon(bool_ndcgs, vector_ndcgs).pvalue)
     else:
         print("Wilcoxon p-value: Sample size too small to be significant")
     print("T-Test p-value:", ttest_ind(bool_ndcgs, vector_ndcgs).pvalue)
+    print("%-10s %10s %10s" % ("", "boolean", "vector"))
+    for name, label in (('ap', 'MAP'), ('precision', 'P@10'),
+            ('recall', 'Recall@10')):
+        print("%-10s %10.4f %10.4f" % (label, bool_scores[name].mean(),
+            vector_scores[name].mean()))
+    print("Evaluated %d queries in %.2f s with %d worker%s" % (len(results),
+        elapsed, max(1, workers), "" if workers <= 1 else "s"))
+    
+    # Random picks repeat queries, which the result cache answers
+    if workers <= 1:
+        print("Result cache:", resultcache.for_index(_loaded['index']))
     
 def init():
     global n
     global index_file
     global query_path
     global qrels_path
+    global seed
+    global workers
+    global options
     
     # Ensure args are valid
-    if len(argv) is not 5:
-        print("Syntax: python batch_eval.py <index-file-loc> <query-loc> <qrels-loc> <n>")
-        return False
+    parser = argparse.ArgumentParser(
+        description="Average NDCG of boolean and vector queries")
+    parser.add_argument('index_file', metavar='index-file-loc')
+    parser.add_argument('query_path', metavar='query-loc')
+    parser.add_argument('qrels_path', metavar='qrels-loc')
+    parser.add_argument('n', help='number of queries, or "all"')
+    parser.add_argument('--seed', type=int, default=None,
+        help="sample the queries without repeats, reproducibly")
+    parser.add_argument('--workers', type=int, default=1,
+        help="processes to evaluate with (default: 1)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv[1:])
+    options = args
 
     # Grab arguments
-    index_file = argv[1]
-    query_path = argv[2]
-    qrels_path = argv[3]
-    n = int(argv[4])
+    index_file = args.index_file
+    query_path = args.query_path
+    qrels_path = args.qrels_path
+    seed = args.seed
+    workers = args.workers
+    if args.n == 'all':
+        n = None
+        return True
+    try:
+        n = int(args.n)
+    except ValueError:
+        parser.error('n must be a number or "all"')
     
     # Ensure we have enough test cases
     if n < 2:
@@ -154,4 +227,6 @@ def init():
 
 if __name__ == '__main__':
     if init():
-        eval()
+        # Stage timings, a profile or heap snapshots, if asked for
+        with instrument.session(options):
+            eval()
@@ -0,0 +1,359 @@
+'''
+
+Benchmarks on synthetic corpora: Cranfield scaled up 10, 100, 1000 times
+
+    A synthetic corpus is written in the Cranfield format (see cran.py)
+    from the statistics of cran.all: titles and texts draw their words
+    from the unigram frequencies of cran.all titles and texts, their
+    lengths (in words) from the lengths cran.all has, and authors from
+    the ones it has. Words are drawn independently,
+    so phrases are rare, but term frequencies, document frequencies and
+    posting list lengths grow the way they would in a bigger collection
+    of the same kind. The same seed always gives the same corpus.
+
+    For each scale, run() measures
+
+        index_docs_per_s     build_index plus compute_tfidf
+        index_mb_per_s       the same, in MB of corpus text
+        save_s, load_s       InvertedIndex.save, and the best of REPEAT
+                             open_index calls
+        disk_bytes           size of the saved index directory
+        ram_loaded_bytes     Python heap taken by a loaded index
+                             (tracemalloc; mmapped files are not counted)
+        peak_rss_kb          peak RSS of the process so far
+        boolean_ms, vector_ms
+                             p50, p95 and p99 latency of the 225 Cranfield
+                             queries, one QueryProcessor each, without the
+                             result cache; each query's time is its best of
+                             REPEAT runs, after one run to warm up
+
+    and writes the results to a JSON file, with the machine and commit
+    they came from. compare() lines up two such files and marks every
+    change beyond a threshold as better or worse.
+
+    Indexing 1000 times Cranfield (1.4 million docs) in one process
+    needs many GB of memory; give it --memory-limit to spill blocks.
+
+usage:
+    python bench.py run <out.json> [--scales 10 100 1000] [--seed s]
+        [--work-dir dir] [--workers n] [--memory-limit MB]
+    python bench.py compare <old.json> <new.json> [--threshold 0.1]
+
+'''
+
+import os
+import gc
+import sys
+import json
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime
+from collections import Counter
+from time import perf_counter
+
+SCALES = (10, 100, 1000)
+
+PERCENTILES = (50, 95, 99)
+
+# Runs of each timed step, of which the fastest counts
+REPEAT = 3
+
+# Words per line of generated text, roughly as in cran.all
+LINE_WORDS = 12
+
+# (metric, true if higher is better), in report order; latencies are
+#   compared at every percentile
+METRICS = [
+    ('index_docs_per_s', True),
+    ('index_mb_per_s', True),
+    ('save_s', False),
+    ('load_s', False),
+    ('disk_bytes', False),
+    ('ram_loaded_bytes', False),
+    ('peak_rss_kb', False),
+] + [('%s_ms.p%d' % (mode, p), False) for mode in ('boolean', 'vector')
+    for p in PERCENTILES]
+
+
+class CorpusModel:
+    ''' what a synthetic corpus is drawn from: word frequencies and
+        lengths of the titles and texts of a Cranfield file '''
+
+    def __init__(self, docs):
+        title_words = Counter()
+        text_words = Counter()
+        self.title_lengths = []
+        self.text_lengths = []
+        self.authors = []
+        self.n_docs = 0
+        for doc in docs:
+            title = doc.title.split()
+            text = doc.body.split()
+            title_words.update(title)
+            text_words.update(text)
+            self.title_lengths.append(len(title))
+            self.text_lengths.append(len(text))
+            self.authors.append(" ".join(doc.author.split()))
+            self.n_docs += 1
+        self.title_words, self.title_weights = _cumulative(title_words)
+        self.text_words, self.text_weights = _cumulative(text_words)
+
+    @classmethod
+    def from_file(cls, filename):
+        from cran import CranFile
+        return cls(CranFile(filename))
+
+    def write(self, filename, n_docs, seed=0):
+        ''' write n_docs synthetic docs to a Cranfield-format file;
+            returns its size in bytes '''
+        rnd = random.Random(seed)
+        with open(filename, 'w', encoding='utf-8', newline='\n') as out:
+            for docid in range(1, n_docs + 1):
+                title = rnd.choices(self.title_words,
+                    cum_weights=self.title_weights,
+                    k=rnd.choice(self.title_lengths))
+                text = rnd.choices(self.text_words,
+                    cum_weights=self.text_weights,
+                    k=rnd.choice(self.text_lengths))
+                out.write(".I %d\n.T\n%s\n.A\n%s\n.B\nsynthetic %d.\n.W\n%s\n"
+                    % (docid, _lines(title), rnd.choice(self.authors), docid,
+                    _lines(text)))
+        return os.path.getsize(filename)
+
+
+def _cumulative(counts):
+    words = sorted(counts)
+    weights = []
+    total = 0
+    for w in words:
+        total += counts[w]
+        weights.append(total)
+    return words, weights
+
+
+def _lines(words):
+    return "\n".join(" ".join(words[i : i + LINE_WORDS])
+        for i in range(0, len(words), LINE_WORDS))
+
+
+def corpus(model, scale, work_dir, seed=0):
+    ''' path of the synthetic corpus for a scale, written if missing '''
+    path = os.path.join(work_dir, "cran_x%d_seed%d.all" % (scale, seed))
+    if not os.path.isfile(path):
+        model.write(path + ".tmp", model.n_docs * scale, seed)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def percentiles(times):
+    ''' {'p50': ms, ...} of a list of seconds, by nearest rank '''
+    times = sorted(times)
+    out = {}
+    for p in PERCENTILES:
+        rank = max(0, -(-p * len(times) // 100) - 1)
+        out['p%d' % p] = times[min(rank, len(times) - 1)] * 1000
+    return out
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names)
+
+
+def _peak_rss():
+    try:
+        from resource import getrusage, RUSAGE_SELF
+        return getrusage(RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+
+def measure(corpus_path, index_dir, queries, workers=1, memory_limit=0):
+    ''' the metrics of one corpus, as a dict '''
+    from cran import CranFile
+    from index import build_index
+    from segments import open_index
+    from query import QueryProcessor
+
+    cf = CranFile(corpus_path)
+    results = {'corpus_bytes': os.path.getsize(corpus_path)}
+
+    start = perf_counter()
+    ii = build_index(cf, workers, 0, int(memory_limit * 2**20))
+    ii.compute_tfidf()
+    elapsed = perf_counter() - start
+    results['docs'] = ii.nDocs
+    results['index_s'] = elapsed
+    results['index_docs_per_s'] = ii.nDocs / elapsed
+    results['index_mb_per_s'] = results['corpus_bytes'] / 2**20 / elapsed
+
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    start = perf_counter()
+    ii.save(index_dir)
+    results['save_s'] = perf_counter() - start
+    results['disk_bytes'] = _dir_size(index_dir)
+    del ii
+    gc.collect()
+
+    results['load_s'] = None
+    for _ in range(REPEAT):
+        start = perf_counter()
+        ii = open_index(index_dir)
+        elapsed = perf_counter() - start
+        results['load_s'] = min(elapsed, results['load_s'] or elapsed)
+        del ii
+        gc.collect()
+
+    # Again, traced, for the heap the index takes once loaded
+    tracemalloc.start()
+    ii = open_index(index_dir)
+    results['ram_loaded_bytes'] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    for mode in ('boolean', 'vector'):
+        def run(text):
+            qp = QueryProcessor(text, ii, cache=False)
+            return qp.booleanQuery() if mode == 'boolean' \
+                else qp.vectorQuery(10)
+        times = []
+        for text in queries:
+            run(text)
+            best = None
+            for _ in range(REPEAT):
+                start = perf_counter()
+                run(text)
+                elapsed = perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best)
+        results[mode + '_ms'] = percentiles(times)
+
+    results['peak_rss_kb'] = _peak_rss()
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(out_path, scales=SCALES, seed=0, work_dir=None, workers=1,
+        memory_limit=0):
+    ''' measure every scale and write the results to out_path '''
+    from cranqry import loadCranQry
+    from resources import data_path
+
+    if work_dir is None:
+        work_dir = os.path.join(tempfile.gettempdir(), 'cran_bench')
+    os.makedirs(work_dir, exist_ok=True)
+    model = CorpusModel.from_file(data_path("cran.all"))
+    qc = loadCranQry(data_path("query.text"))
+    queries = [qc[qid].text for qid in qc]
+
+    report = {'meta': {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'seed': seed, 'workers': workers, 'memory_limit_mb': memory_limit,
+    }, 'scales': {}}
+    for scale in scales:
+        start = perf_counter()
+        path = corpus(model, scale, work_dir, seed)
+        print("x%d: corpus of %d docs ready in %.1f s" % (scale,
+            model.n_docs * scale, perf_counter() - start), flush=True)
+        results = measure(path, os.path.join(work_dir, "index_x%d" % scale),
+            queries, workers, memory_limit)
+        report['scales'][str(scale)] = results
+        print("x%d: %.0f docs/s, load %.3f s, %.1f MB on disk, "
+            "boolean p50 %.2f ms, vector p50 %.2f ms" % (scale,
+            results['index_docs_per_s'], results['load_s'],
+            results['disk_bytes'] / 2**20, results['boolean_ms']['p50'],
+            results['vector_ms']['p50']), flush=True)
+
+        # Written after every scale, so a long run keeps what it has
+        with open(out_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def _metric(results, name):
+    value = results
+    for part in name.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(old_path, new_path, threshold=0.1):
+    ''' print every metric of two runs side by side, marking changes of
+        more than threshold (a fraction) as better or worse '''
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    for run, path in (("old", old_path), ("new", new_path)):
+        meta = (old if run == "old" else new)['meta']
+        print("%s: %s, commit %s, Python %s, %s CPUs" % (run, path,
+            meta.get('commit'), meta.get('python'), meta.get('cpus')))
+
+    for scale in old['scales']:
+        if scale not in new['scales']:
+            continue
+        print("\nx" + scale)
+        print("%-22s %14s %14s %9s" % ("metric", "old", "new", "change"))
+        for name, higher_is_better in METRICS:
+            a = _metric(old['scales'][scale], name)
+            b = _metric(new['scales'][scale], name)
+            if a is None or b is None:
+                continue
+            change = (b - a) / a if a else 0.0
+            verdict = ""
+            if abs(change) > threshold:
+                verdict = "better" if (change > 0) == higher_is_better \
+                    else "WORSE"
+            print("%-22s %14.4g %14.4g %+8.1f%% %s" % (name, a, b,
+                change * 100, verdict))
+
+
+def main(args=None):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Benchmarks on synthetic scaled-up Cranfield corpora")
+    commands = parser.add_subparsers(dest='command', required=True)
+    measure_cmd = commands.add_parser('run', help="measure and write JSON")
+    measure_cmd.add_argument('out', help="JSON file for the results")
+    measure_cmd.add_argument('--scales', type=int, nargs='+',
+        default=list(SCALES), help="times the size of cran.all")
+    measure_cmd.add_argument('--seed', type=int, default=0)
+    measure_cmd.add_argument('--work-dir', default=None,
+        help="where corpora and indexes go (default: system temp dir); "
+            "corpora are kept and reused")
+    measure_cmd.add_argument('--workers', type=int, default=1,
+        help="indexing processes")
+    measure_cmd.add_argument('--memory-limit', type=float, default=0,
+        help="spill index blocks past this many MB (see spimi.py)")
+    diff = commands.add_parser('compare', help="compare two runs")
+    diff.add_argument('old')
+    diff.add_argument('new')
+    diff.add_argument('--threshold', type=float, default=0.1,
+        help="relative change to flag (default 0.1)")
+    args = parser.parse_args(args)
+
+    if args.command == 'run':
+        run(args.out, args.scales, args.seed, args.work_dir, args.workers,
+            args.memory_limit)
+    else:
+        compare(args.old, args.new, args.threshold)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,428 @@
+'''
+
+Boolean query parsing and planning
+
+    A boolean query is parsed into an expression tree with the usual
+    precedence, NOT binding tightest and OR loosest; parentheses nest to
+    any depth, and words next to each other are ANDed:
+
+        expr    := and ('or' and)*
+        and     := not (['and'] not)*
+        not     := 'not' not | near
+        near    := atom ('near/k' atom)*
+        atom    := '(' expr ')' | '"' words '"' | term
+
+    Every word goes through the same preprocessing as the index (spelling,
+    stopwords, stemming) before it becomes a term; words that come out
+    empty, such as stopwords, drop out of the tree. The parser is lenient,
+    since the Cranfield queries are plain English: an operator missing an
+    operand is ignored, and so are unbalanced parentheses; a quote that
+    is never closed runs to the end of the query.
+
+    Quoted words are a phrase, and a NEAR/k b matches docs where a and b
+    are at most k words apart; both are matched on the positions in the
+    postings (see positional.py). NEAR only takes words, phrases and other
+    NEARs; between anything else it is read as AND.
+
+    Before a tree is evaluated the planner looks up every term once and
+    estimates the size of each node's result from the document
+    frequencies:
+
+        term       df
+        phrase     df of its rarest word (NEAR likewise)
+        NOT a      N - a
+        a AND b    min(a, b) over the operands that are not negated
+        a OR b     min(N, a + b)
+
+    AND operands are then evaluated smallest first, and negated operands
+    after all others, so NOT is folded into an AND-NOT (see setops.py).
+    An AND stops as soon as its result is empty, without looking at the
+    rest of its operands. OR operands are also merged smallest first.
+    explain() prints the plan with these estimates.
+
+'''
+
+import re
+import setops
+import positional
+import instrument
+from positional import Phrase, Near
+
+OPERATORS = ('and', 'or', 'not')
+
+# NEAR/k, in any case
+NEAR = re.compile(r'near/(\d+)$', re.IGNORECASE)
+
+# Text between quotes, or up to the end of the query for an unclosed one
+QUOTED = re.compile(r'"([^"]*)"?')
+
+
+class Term:
+    def __init__(self, term):
+        self.term = term
+
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+
+def tokenize(query, analyze):
+    ''' split a raw query into '(', ')', operators, terms and phrases
+
+        analyze maps text to one index term per word, "" for a word that
+        is dropped (a stopword). Every word of the query, quoted or not,
+        goes through it in one call, so a query without operators is
+        analyzed exactly as a vector query would be. Terms are returned
+        as ('term', term) pairs, phrases as ('phrase', [(offset, term),
+        ...]) and NEAR/k as ('near', k). '''
+    # First the structure, with ('word', i) and ('quoted', i, n) standing
+    #   in for the words
+    skeleton = []
+    words = []
+    depth = 0
+    rest = 0
+    for quoted in QUOTED.finditer(query):
+        depth = _split_words(query[rest : quoted.start()], skeleton, words,
+            depth)
+        rest = quoted.end()
+        phrase = quoted.group(1).split()
+        skeleton.append(('quoted', len(words), len(phrase)))
+        words.extend(phrase)
+    _split_words(query[rest:], skeleton, words, depth)
+
+    terms = analyze(' '.join(words)) if words else []
+    tokens = []
+    for token in skeleton:
+        if token[0] == 'word':
+            if terms[token[1]]:
+                tokens.append(('term', terms[token[1]]))
+        elif token[0] == 'quoted':
+            start, n = token[1], token[2]
+            kept = [(offset, term) for offset, term in
+                enumerate(terms[start : start + n]) if term]
+            if len(kept) == 1:
+                tokens.append(('term', kept[0][1]))
+            elif kept:
+                # Offsets count from the first word that is kept
+                tokens.append(('phrase', [(offset - kept[0][0], term)
+                    for offset, term in kept]))
+        else:
+            tokens.append(token)
+    return tokens
+
+
+def _split_words(text, skeleton, words, depth):
+    ''' tokens of unquoted text; returns the paren depth after it '''
+    for chunk in text.split():
+        # Parens can be stuck to the words they enclose
+        word = chunk.lstrip('(')
+        for _ in range(len(chunk) - len(word)):
+            skeleton.append('(')
+            depth += 1
+        closing = len(word) - len(word.rstrip(')'))
+        word = word.rstrip(')')
+
+        near = NEAR.match(word)
+        if word.lower() in OPERATORS:
+            skeleton.append(word.lower())
+        elif near:
+            skeleton.append(('near', int(near.group(1))))
+        elif word:
+            skeleton.append(('word', len(words)))
+            words.append(word)
+
+        # Drop any ')' that closes nothing
+        for _ in range(min(closing, depth)):
+            skeleton.append(')')
+            depth -= 1
+    return depth
+
+
+class Parser:
+    ''' recursive descent over the tokens of a query '''
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def parse(self):
+        return self.or_expr()
+
+    def or_expr(self):
+        children = [self.and_expr()]
+        while self.peek() == 'or':
+            self.next()
+            children.append(self.and_expr())
+        return _combine(Or, children)
+
+    def and_expr(self):
+        children = []
+        while self.peek() not in (None, ')', 'or'):
+            if self.peek() == 'and':
+                self.next()
+                continue
+            children.append(self.not_expr())
+        return _combine(And, children)
+
+    def not_expr(self):
+        if self.peek() == 'not':
+            self.next()
+            child = self.not_expr()
+            if child is None:
+                return None
+            # NOT NOT a is just a
+            return child.child if isinstance(child, Not) else Not(child)
+        return self.near_expr()
+
+    def near_expr(self):
+        node = self.atom()
+        while isinstance(self.peek(), tuple) and self.peek()[0] == 'near':
+            k = self.next()[1]
+            right = self.atom()
+            if node is None or right is None:
+                node = node or right
+            elif _positional(node) and _positional(right):
+                node = Near(node, right, k)
+            else:
+                node = _combine(And, [node, right])
+        return node
+
+    def atom(self):
+        token = self.peek()
+        if token == '(':
+            self.next()
+            child = self.or_expr()
+            if self.peek() == ')':
+                self.next()
+            return child
+        if isinstance(token, tuple) and token[0] == 'term':
+            self.next()
+            return Term(token[1])
+        if isinstance(token, tuple) and token[0] == 'phrase':
+            self.next()
+            return Phrase(token[1])
+        return None
+
+
+def _positional(node):
+    return isinstance(node, (Term, Phrase, Near))
+
+
+def _combine(kind, children):
+    ''' one And/Or node over children, flattening nested nodes of its kind '''
+    flat = []
+    for child in children:
+        if child is None: continue
+        if isinstance(child, kind):
+            flat.extend(child.children)
+        else:
+            flat.append(child)
+    if not flat:
+        return None
+    return flat[0] if len(flat) == 1 else kind(flat)
+
+
+def parse(query, analyze):
+    ''' the expression tree of a raw query, or None if it has no terms '''
+    return Parser(tokenize(query, analyze)).parse()
+
+
+def key(node):
+    ''' a hashable form of a tree, the same for trees that must give the
+        same docs: AND and OR operands in any order '''
+    if node is None:
+        return None
+    if isinstance(node, Term):
+        return node.term
+    if isinstance(node, Phrase):
+        return ('phrase', tuple(node.terms))
+    if isinstance(node, Near):
+        return ('near', node.k, key(node.left), key(node.right))
+    if isinstance(node, Not):
+        return ('not', key(node.child))
+    return (type(node).__name__.lower(),
+        tuple(sorted((key(child) for child in node.children), key=repr)))
+
+
+def _df(index, term):
+    item = index.find(term)
+    return item.doc_freq() if item else 0
+
+
+def plan(node, index):
+    ''' copy of a tree with operands in evaluation order
+
+        Every node of the copy gets est (estimated number of docs in its
+        result) and cost (number of postings it may read). '''
+    n = index.nDocs
+    if isinstance(node, Term):
+        planned = Term(node.term)
+        planned.item = index.find(node.term)
+        planned.est = planned.item.doc_freq() if planned.item else 0
+        planned.cost = planned.est
+        return planned
+
+    if isinstance(node, (Phrase, Near)):
+        # Only docs with every word can match
+        planned = Phrase(node.terms) if isinstance(node, Phrase) \
+            else Near(node.left, node.right, node.k)
+        planned.est = min(_df(index, term) for term in positional.words(node))
+        planned.cost = sum(_df(index, term)
+            for term in set(positional.words(node)))
+        return planned
+
+    if isinstance(node, Not):
+        planned = Not(plan(node.child, index))
+        planned.est = n - planned.child.est
+        planned.cost = planned.child.cost
+        return planned
+
+    children = [plan(child, index) for child in node.children]
+    if isinstance(node, And):
+        positive = sorted((c for c in children if not isinstance(c, Not)),
+            key=lambda c: c.est)
+        negative = sorted((c for c in children if isinstance(c, Not)),
+            key=lambda c: c.est)
+        planned = And(positive + negative)
+        if positive:
+            planned.est = positive[0].est
+        else:
+            # NOT a AND NOT b = NOT (a OR b)
+            planned.est = max(0, n - sum(c.child.est for c in negative))
+    else:
+        planned = Or(sorted(children, key=lambda c: c.est))
+        planned.est = min(n, sum(c.est for c in children))
+    planned.cost = sum(c.cost for c in children)
+    return planned
+
+
+def evaluate(node, index):
+    ''' (docIDs, negated) of a planned tree '''
+    if isinstance(node, Term):
+        if node.item is None:
+            return [], False
+        with instrument.stage('boolean.postings'):
+            docs = node.item.sorted_postings
+        instrument.count('postings.scanned', len(docs))
+        return docs, False
+
+    if isinstance(node, (Phrase, Near)):
+        with instrument.stage('boolean.positional'):
+            return positional.match(node, index), False
+
+    if isinstance(node, Not):
+        docs, negated = evaluate(node.child, index)
+        return docs, not negated
+
+    if isinstance(node, And):
+        docs, negated = evaluate(node.children[0], index)
+        for child in node.children[1:]:
+            # Nothing can come back into an empty AND
+            if not docs and not negated:
+                break
+            # A negated operand comes back flagged and is folded into an
+            #   AND-NOT
+            child_docs, child_negated = evaluate(child, index)
+            with instrument.stage('boolean.merge'):
+                docs, negated = setops.and_signed(docs, negated, child_docs,
+                    child_negated)
+        return docs, negated
+
+    docs, negated = evaluate(node.children[0], index)
+    for child in node.children[1:]:
+        # Nothing can be added to NOT (nothing)
+        if not docs and negated:
+            break
+        child_docs, child_negated = evaluate(child, index)
+        with instrument.stage('boolean.merge'):
+            docs, negated = setops.or_signed(docs, negated, child_docs,
+                child_negated)
+    return docs, negated
+
+
+def run(tree, index):
+    ''' sorted docIDs matching a parsed query '''
+    if tree is None:
+        return []
+    with instrument.stage('boolean.plan'):
+        planned = plan(tree, index)
+    docs, negated = evaluate(planned, index)
+    # Only a query that is negative as a whole needs the complement, so
+    #   only then is the list of every doc read. An index still being
+    #   built keeps it in indexing order, so it is sorted (which is
+    #   linear when it is already in order)
+    with instrument.stage('boolean.merge'):
+        docs = setops.resolve(docs, negated,
+            sorted(index.indexed_docs()) if negated else None)
+    instrument.count('boolean.results', len(docs))
+    return docs
+
+
+def _describe(node):
+    ''' a phrase or NEAR expression as query text '''
+    if isinstance(node, Phrase):
+        words = []
+        for offset, term in node.terms:
+            # A dropped stopword shows as '*'
+            words.extend(['*'] * (offset - len(words)))
+            words.append(term)
+        return '"%s"' % ' '.join(words)
+    if isinstance(node, Near):
+        return '(%s NEAR/%d %s)' % (_describe(node.left), node.k,
+            _describe(node.right))
+    return node.term
+
+
+def explain(tree, index):
+    ''' the plan of a parsed query as text, one node per line '''
+    if tree is None:
+        return "(no terms)"
+    planned = plan(tree, index)
+    lines = []
+
+    def walk(node, depth, label=''):
+        indent = '  ' * depth
+        if isinstance(node, Term):
+            text = indent + label + node.term
+        elif isinstance(node, (Phrase, Near)):
+            text = indent + label + _describe(node)
+        elif isinstance(node, Not) and label:
+            # An AND-NOT; show the subtracted operand in place
+            walk(node.child, depth, 'AND NOT ')
+            return
+        elif isinstance(node, Not):
+            text = indent + 'NOT'
+        else:
+            text = indent + label + type(node).__name__.upper()
+        lines.append("%-40s est %6d docs  cost %7d postings" % (text,
+            node.est, node.cost))
+
+        if isinstance(node, Not):
+            walk(node.child, depth + 1)
+        elif isinstance(node, (And, Or)):
+            for i, child in enumerate(node.children):
+                walk(child, depth + 1, 'AND NOT ' if i and
+                    isinstance(node, And) and isinstance(child, Not) else '')
+
+    walk(planned, 0)
+    lines.append("%d docs in the index; an AND stops once it is empty"
+        % index.nDocs)
+    return '\n'.join(lines)
@@ -0,0 +1,224 @@
+'''
+
+Integer codecs for compressing posting lists
+
+    Each codec turns a list of non-negative ints into bytes, and decodes
+    bytes back into a stream of ints. Decoding is done with generators, so
+    a caller can stop early without expanding the whole list.
+
+        raw     fixed 4-byte little-endian ints (what version 1 indexes use)
+        vbyte   variable-byte: 7 bits per byte, high bit marks the last byte
+        gamma   Elias-gamma: unary length, then the binary value
+        delta   Elias-delta: gamma-coded length, then the binary value
+
+    The compressed codecs are meant for small numbers, so the index stores
+    docID and position gaps with them rather than absolute values.
+
+usage (size and decode-speed report):
+    python codec.py index_dir [scale ...]
+
+'''
+
+import sys
+import random
+from array import array
+from time import perf_counter
+
+
+class RawCodec:
+    ''' fixed-width 32-bit ints, no gaps '''
+    name = 'raw'
+    gaps = False
+
+    def encode(self, numbers):
+        arr = array('I', numbers)
+        if sys.byteorder == 'big':
+            arr.byteswap()
+        return arr.tobytes()
+
+    def decode(self, buf):
+        arr = array('I')
+        arr.frombytes(buf)
+        if sys.byteorder == 'big':
+            arr.byteswap()
+        return iter(arr)
+
+
+class VByteCodec:
+    ''' variable-byte codes, as in the IR book (section 5.3.1) '''
+    name = 'vbyte'
+    gaps = True
+
+    def encode(self, numbers):
+        out = bytearray()
+        for n in numbers:
+            # Low 7-bit groups go last; the last byte gets the high bit
+            chunk = [n & 0x7f | 0x80]
+            n >>= 7
+            while n:
+                chunk.append(n & 0x7f)
+                n >>= 7
+            out.extend(reversed(chunk))
+        return bytes(out)
+
+    def decode(self, buf):
+        n = 0
+        for byte in buf:
+            if byte & 0x80:
+                yield n << 7 | (byte & 0x7f)
+                n = 0
+            else:
+                n = n << 7 | byte
+
+
+class GammaCodec:
+    ''' Elias-gamma codes; values are shifted by one since 0 has no code '''
+    name = 'gamma'
+    gaps = True
+
+    def _code(self, n):
+        binary = bin(n)[2:]
+        return '0' * (len(binary) - 1) + binary
+
+    def encode(self, numbers):
+        bits = ''.join(self._code(n + 1) for n in numbers)
+        return _bits_to_bytes(bits)
+
+    def decode(self, buf):
+        bits = _bytes_to_bits(buf)
+        i = 0
+        while True:
+            # The run of zeros gives the length; the tail is zero padding
+            one = bits.find('1', i)
+            if one < 0: return
+            length = one - i
+            yield int(bits[one : one + length + 1], 2) - 1
+            i = one + length + 1
+
+
+class DeltaCodec(GammaCodec):
+    ''' Elias-delta codes; values are shifted by one since 0 has no code '''
+    name = 'delta'
+
+    def _code(self, n):
+        binary = bin(n)[2:]
+        return GammaCodec._code(self, len(binary)) + binary[1:]
+
+    def decode(self, buf):
+        bits = _bytes_to_bits(buf)
+        i = 0
+        while True:
+            # Gamma-coded length, then the value minus its leading 1
+            one = bits.find('1', i)
+            if one < 0: return
+            length = one - i
+            n_bits = int(bits[one : one + length + 1], 2)
+            i = one + length + 1
+            yield int('1' + bits[i : i + n_bits - 1], 2) - 1
+            i += n_bits - 1
+
+
+def _bits_to_bytes(bits):
+    ''' pack a string of 0/1 into bytes, zero padded on the right '''
+    if not bits:
+        return b''
+    bits += '0' * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big')
+
+
+def _bytes_to_bits(buf):
+    ''' unpack bytes into a string of 0/1 '''
+    if not buf:
+        return ''
+    return bin(int.from_bytes(buf, 'big'))[2:].zfill(8 * len(buf))
+
+
+CODECS = {c.name: c for c in (RawCodec(), VByteCodec(), GammaCodec(),
+    DeltaCodec())}
+
+# Codec numbers as stored in the index meta file
+CODEC_IDS = ['raw', 'vbyte', 'gamma', 'delta']
+
+
+def get_codec(name):
+    ''' look a codec up by name '''
+    if name not in CODECS:
+        raise ValueError("Unknown codec " + str(name) + ". Use one of: " +
+            ", ".join(CODEC_IDS))
+    return CODECS[name]
+
+
+def to_gaps(numbers):
+    ''' sorted ints -> first value followed by differences '''
+    prev = 0
+    gaps = []
+    for n in numbers:
+        gaps.append(n - prev)
+        prev = n
+    return gaps
+
+
+def from_gaps(gaps):
+    ''' stream of gaps -> stream of the original ints '''
+    total = 0
+    for g in gaps:
+        total += g
+        yield total
+
+
+def _synthetic_lists(lists, scale, seed=7800):
+    ''' scale up posting lists: scale times as many docs per term '''
+    rnd = random.Random(seed)
+    max_doc = max(max(l) for l in lists if l) * scale
+    out = []
+    for l in lists:
+        df = min(len(l) * scale, max_doc)
+        out.append(sorted(rnd.sample(range(1, max_doc + 1), df)))
+    return out
+
+
+def report(path, scales=()):
+    ''' print the size and decode speed of every codec '''
+    from index import InvertedIndex
+
+    ii = InvertedIndex()
+    ii.load(path)
+
+    # Gap lists for docIDs and positions, as the codecs would see them
+    doc_lists = []
+    pos_lists = []
+    for term in ii.items:
+        item = ii.items[term]
+        doc_lists.append(list(item.sorted_postings))
+        for doc in item.sorted_postings:
+            pos_lists.append(list(item.posting[doc].positions))
+
+    corpora = [("Cranfield", doc_lists, pos_lists)]
+    for scale in scales:
+        corpora.append(("Synthetic x" + str(scale),
+            _synthetic_lists(doc_lists, scale), pos_lists * scale))
+
+    for label, docs, positions in corpora:
+        gaps = [to_gaps(l) for l in docs] + [to_gaps(l) for l in positions]
+        n_ints = sum(len(g) for g in gaps)
+        print(label + ":", n_ints, "ints")
+        print("  codec   bytes        bytes/int  decode Mints/s")
+        for name in CODEC_IDS:
+            codec = CODECS[name]
+            blocks = [codec.encode(g) for g in gaps]
+            size = sum(len(b) for b in blocks)
+
+            start = perf_counter()
+            for b in blocks:
+                for _ in codec.decode(b): pass
+            elapsed = perf_counter() - start
+
+            print("  %-7s %-12d %-10.2f %.2f" % (name, size, size / n_ints,
+                n_ints / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Syntax: python codec.py <index-location> [scale ...]")
+    else:
+        report(sys.argv[1], [int(s) for s in sys.argv[2:]])
@@ -2,48 +2,166 @@
 
 processing the special format used by the Cranfield Dataset
 
+    A file is a run of records, each starting with an ".I <id>" line and
+    split into fields by marker lines: ".T" title, ".A" authors, ".B"
+    bibliography and ".W" text (queries only have ".W"). A marker is a
+    line holding the marker and nothing else, so text that happens to
+    contain ".I" or ".W" stays text. The text field runs to the end of
+    the record; a few Cranfield records have stray marker lines inside
+    their text, which are skipped.
 
+    Files are read as bytes, a line at a time, and records() yields each
+    record with its byte offset and length. Iterating over a CranFile
+    therefore holds one document in memory at a time, and find() reads a
+    single document from its offset without parsing the rest of the file.
 
 '''
 from doc import Document
 
+ENCODING = 'utf-8'
+
+# The field that runs to the end of a record
+TEXT = 'W'
+
+
+def _marker(line):
+    ''' (letter, id) of a marker line, or None for a line of text; id is
+        only set for ".I" '''
+    if line[:1] != b'.':
+        return None
+    parts = line.split()
+    if len(parts[0]) != 2 or not parts[0][1:].isalpha():
+        return None
+    letter = parts[0][1:].decode(ENCODING)
+    if letter == 'I':
+        return (letter, parts[1].decode(ENCODING)) if len(parts) == 2 \
+            else None
+    return (letter, None) if len(parts) == 1 else None
+
+
+def records(f, offset=0, limit=None):
+    ''' (offset, length, id, fields) of each record of a file opened in
+        binary mode, starting at offset and stopping after limit records
+
+        fields maps each marker letter ('T', 'A', ...) to its text. '''
+    f.seek(offset)
+    pos = offset
+    start = None
+    n = 0
+    for line in f:
+        # Only a line starting with '.' can be a marker
+        marker = _marker(line) if line[:1] == b'.' else None
+        if marker and marker[0] == 'I':
+            if start is not None:
+                yield start, pos - start, rid, _decode(fields)
+                n += 1
+                if limit is not None and n >= limit:
+                    return
+            start, rid = pos, marker[1]
+            fields = {}
+            field = None
+        elif start is None:
+            pass # before the first record
+        elif marker and field != TEXT:
+            field = marker[0]
+            fields[field] = []
+        elif field is not None and not marker:
+            fields[field].append(line)
+        pos += len(line)
+    if start is not None:
+        yield start, pos - start, rid, _decode(fields)
+
+
+def _decode(fields):
+    return {letter: b''.join(lines).decode(ENCODING)
+        for letter, lines in fields.items()}
+
+
+def offsets(filename):
+    ''' {id: (byte offset, length)} of every record of a file '''
+    table = {}
+    with open(filename, 'rb') as f:
+        pos = 0
+        last = None
+        for line in f:
+            marker = _marker(line) if line[:2] == b'.I' else None
+            if marker and marker[0] == 'I':
+                if last is not None:
+                    table[last[0]] = (last[1], pos - last[1])
+                last = (marker[1], pos)
+            pos += len(line)
+        if last is not None:
+            table[last[0]] = (last[1], pos - last[1])
+    return table
+
+
+def read_record(filename, offset):
+    ''' (id, fields) of the record at a byte offset '''
+    with open(filename, 'rb') as f:
+        for _, _, rid, fields in records(f, offset, limit=1):
+            return rid, fields
+    raise ValueError("No record at offset %d of %s" % (offset, filename))
+
+
+def _document(rid, fields):
+    return Document(rid, fields.get('T', ''), fields.get('A', ''),
+        fields.get(TEXT, ''))
+
+
+def iter_docs(filename):
+    ''' the documents of a collection file, parsed one at a time '''
+    with open(filename, 'rb') as f:
+        for _, _, rid, fields in records(f):
+            yield _document(rid, fields)
+
 
 class CranFile:
+    ''' the documents of a collection file
+
+        Iterating parses the file as it goes. docs is the list of every
+        document, parsed on first use; offsets (also built on first use)
+        lets find() read a single document. '''
+
     def __init__(self, filename):
-        self.docs = []
-
-        cf = open(filename)
-        docid = ''
-        title = ''
-        author = ''
-        body = ''
-
-        for line in cf:
-            if '.I' in line:
-                if docid != '':
-                    body = buf
-                    self.docs.append(Document(docid, title, author, body))
-                # start a new document
-                docid = line.strip().split()[1]
-                buf = ''
-            elif '.T' in line:
-                None
-            elif '.A' in line:
-                title = buf # got title
-                buf = ''
-            elif '.B' in line:
-                author = buf # got author
-                buf = ''
-            elif '.W' in line:
-                buf = '' # skip affiliation
-            else:
-                buf += line
-        self.docs.append(Document(docid, title, author, buf)) # the last one
+        self.filename = filename
+        self._docs = None
+        self._offsets = None
+
+    def __iter__(self):
+        if self._docs is not None:
+            return iter(self._docs)
+        return iter_docs(self.filename)
+
+    def __len__(self):
+        if self._docs is not None:
+            return len(self._docs)
+        return len(self.offsets)
+
+    @property
+    def docs(self):
+        if self._docs is None:
+            self._docs = list(iter_docs(self.filename))
+        return self._docs
+
+    @property
+    def offsets(self):
+        ''' {docID: (byte offset, length)} of every document '''
+        if self._offsets is None:
+            self._offsets = offsets(self.filename)
+        return self._offsets
+
+    def find(self, docID):
+        ''' one document, read from its offset, or None '''
+        where = self.offsets.get(str(docID))
+        if where is None:
+            return None
+        return _document(*read_record(self.filename, where[0]))
+
 
 if __name__ == '__main__':
     ''' testing '''
-    
+
     cf = CranFile (r"..\CranfieldDataset\cran.all")
-    for doc in cf.docs:
+    for doc in cf:
         print (doc.docID, doc.title)
-    print (len(cf.docs))
+    print (len(cf))
@@ -1,32 +1,37 @@
-
 '''
   handling the specific input format of the query.text for the Cranfield data
+
+    Queries are records in the same format as the collection (see
+    cran.py): ".I <qid>", then ".W" and the query text.
 '''
 
+import cran
+
 
 class CranQry:
     def __init__(self, qid, text):
         self.qid = qid
         self.text = text
 
+def iter_queries(qfile):
+    ''' the queries of a file, parsed one at a time '''
+    with open(qfile, 'rb') as f:
+        for _, _, qid, fields in cran.records(f):
+            yield CranQry(qid, fields.get(cran.TEXT, ''))
+
 def loadCranQry(qfile):
-    queries = {}
-    f = open(qfile)
-    text = ''
-    qid = ''
-    for line in f:
-        if '.I' in line:
-            if qid !='':
-                queries[qid] = CranQry(qid, text)
-                #print 'qid:', qid, text
-            qid = line.strip().split()[1]
-            text = ''
-        elif '.W' in line:
-            None
-        else:
-            text += line
-    queries[qid] = CranQry(qid, text)
-    return queries
+    ''' {qid: CranQry} of every query, in file order '''
+    return {q.qid: q for q in iter_queries(qfile)}
+
+def findCranQry(qfile, qid, offsets=None):
+    ''' one query, read from its offset, or None; offsets is the
+        cran.offsets() of the file, which is made if not given '''
+    if offsets is None:
+        offsets = cran.offsets(qfile)
+    if qid not in offsets:
+        return None
+    qid, fields = cran.read_record(qfile, offsets[qid][0])
+    return CranQry(qid, fields.get(cran.TEXT, ''))
 
 def test():
     '''testing'''
@@ -0,0 +1,525 @@
+'''
+
+Binary on-disk format for the inverted index
+
+    An index is saved as a directory holding a few flat files:
+
+        meta       magic, format version, nDocs, nTerms, largest docID,
+                   posting codec (version 2 on)
+        terms      every term, utf-8 encoded, one after another, sorted
+        lexicon    one fixed-size record per term (see LEX_RECORD)
+        postings   per term: the docIDs and term frequencies
+        positions  per term: the positions of every posting, in docID order
+        docids     docIDs of every indexed doc, in indexing order (version 3)
+        norms      the tf-idf vector length of every doc, indexed by docID
+        vecidx     per doc: byte offset of its tf-idf vector in vectors
+        vectors    per doc: (term number, tf, weight) for every term in the
+                   doc, weight 0 included (version 2: (term number, weight)
+                   for nonzero weights only)
+        lengths    the number of words in every doc's body, indexed by
+                   docID (optional)
+        bounds     per term: its largest tf / doc length over all its
+                   postings, the score bound topk.py prunes with (optional)
+
+    All numbers are little-endian. The files are opened with mmap, so
+    loading only reads the meta file; posting lists are decoded the first
+    time a query asks for them.
+
+    lengths and bounds are only written when the doc lengths are known,
+    which they are for every index built from documents; an index
+    converted from an old pickle has neither.
+
+    Postings and positions are written with one of the codecs in codec.py.
+    With the raw codec a term's postings are df docIDs followed by df term
+    frequencies, and positions are absolute (this is the whole of version
+    1). The compressed codecs store (docID gap, tf) pairs, and each doc's
+    positions as gaps from the previous position in that doc.
+
+usage (convert an old pickled index):
+    python diskindex.py index.pkl index_dir [raw|vbyte|gamma|delta]
+
+'''
+
+import os
+import sys
+import mmap
+import pickle
+import struct
+from array import array
+from itertools import islice
+from collections.abc import Mapping
+from codec import get_codec, CODEC_IDS, to_gaps, from_gaps
+from postings import CompactPostings
+
+MAGIC = b'CRANIDX\0'
+VERSION = 3
+
+# magic, version, nDocs, nTerms, largest docID
+META_V1 = struct.Struct('<8sIIII')
+
+# ... and the posting codec number
+META = struct.Struct('<8sIIIII')
+
+# term offset, term length, df, postings offset, positions offset
+LEX_RECORD_V1 = struct.Struct('<IIIQQ')
+
+# term offset, term length, df, postings offset, postings length,
+#   positions offset, positions length
+LEX_RECORD = struct.Struct('<IIIQIQI')
+
+# term number, weight
+VEC_RECORD_V2 = struct.Struct('<Id')
+
+# term number, tf, weight
+VEC_RECORD = struct.Struct('<IId')
+
+
+def _to_bytes(arr):
+    ''' little-endian bytes of an array '''
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _from_bytes(typecode, buf):
+    ''' array of the given type from little-endian bytes '''
+    arr = array(typecode)
+    arr.frombytes(buf)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def _map(filename):
+    ''' read-only mmap of a file (empty files cannot be mapped) '''
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def is_disk_index(path):
+    ''' true if path looks like an index written by write_index '''
+    return os.path.isfile(os.path.join(path, 'meta'))
+
+
+class IndexWriter:
+    ''' write an index one term at a time, in sorted term order '''
+
+    def __init__(self, path, codec='raw', doc_lengths=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.codec = get_codec(codec)
+        self.doc_lengths = doc_lengths # docID -> words, for the bounds
+        self.bounds = array('d')
+        self.n_terms = 0
+        self.term_off = self.post_off = self.pos_off = 0
+        self.terms_out = open(os.path.join(path, 'terms'), 'wb')
+        self.lex_out = open(os.path.join(path, 'lexicon'), 'wb')
+        self.post_out = open(os.path.join(path, 'postings'), 'wb')
+        self.pos_out = open(os.path.join(path, 'positions'), 'wb')
+
+    def add_term(self, term, postings):
+        ''' write a term's (docID, positions) pairs; return its number '''
+        codec = self.codec
+        encoded = term.encode('utf-8')
+
+        docs = [doc for doc, _ in postings]
+        tfs = [len(doc_positions) for _, doc_positions in postings]
+        positions = []
+        for _, doc_positions in postings:
+            positions.extend(to_gaps(doc_positions) if codec.gaps
+                else doc_positions)
+        if codec.gaps:
+            post_bytes = codec.encode(
+                n for pair in zip(to_gaps(docs), tfs) for n in pair)
+        else:
+            post_bytes = codec.encode(docs) + codec.encode(tfs)
+        pos_bytes = codec.encode(positions)
+
+        if self.doc_lengths:
+            self.bounds.append(max((tf / self.doc_lengths[doc]
+                for doc, tf in zip(docs, tfs)), default=0.0))
+
+        self.lex_out.write(LEX_RECORD.pack(self.term_off, len(encoded),
+            len(docs), self.post_off, len(post_bytes), self.pos_off,
+            len(pos_bytes)))
+        self.terms_out.write(encoded)
+        self.post_out.write(post_bytes)
+        self.pos_out.write(pos_bytes)
+
+        self.term_off += len(encoded)
+        self.post_off += len(post_bytes)
+        self.pos_off += len(pos_bytes)
+        self.n_terms += 1
+        return self.n_terms - 1
+
+    def finish(self, n_docs, doc_ids, norms, vectors):
+        ''' write the per-doc tables and the meta file
+
+            norms maps docID -> vector length; vectors yields
+            (docID, [(term number, tf, weight), ...]) in docID order '''
+        for out in (self.terms_out, self.lex_out, self.post_out,
+                self.pos_out):
+            out.close()
+
+        # Largest docID anywhere in the index, for the per-doc tables
+        max_doc = max([n_docs] + list(doc_ids) + list(norms))
+
+        with open(os.path.join(self.path, 'docids'), 'wb') as out:
+            out.write(_to_bytes(array('I', doc_ids)))
+
+        # Doc vector lengths, indexed by docID (slot 0 is unused)
+        norm_table = array('d', [0.0] * (max_doc + 1))
+        for doc, norm in norms.items():
+            norm_table[doc] = norm
+        with open(os.path.join(self.path, 'norms'), 'wb') as out:
+            out.write(_to_bytes(norm_table))
+
+        # Sparse doc vectors, as a forward index keyed by docID
+        offsets = array('Q', [0] * (max_doc + 2))
+        with open(os.path.join(self.path, 'vectors'), 'wb') as out:
+            off = 0
+            next_doc = 0
+            for doc, vector in vectors:
+                while next_doc <= doc:
+                    offsets[next_doc] = off
+                    next_doc += 1
+                for term_id, tf, weight in vector:
+                    out.write(VEC_RECORD.pack(term_id, tf, weight))
+                    off += VEC_RECORD.size
+            while next_doc <= max_doc + 1:
+                offsets[next_doc] = off
+                next_doc += 1
+        with open(os.path.join(self.path, 'vecidx'), 'wb') as out:
+            out.write(_to_bytes(offsets))
+
+        # Doc lengths, indexed by docID like the norms, and term bounds
+        if self.doc_lengths:
+            length_table = array('I', [0] * (max_doc + 1))
+            for doc, length in self.doc_lengths.items():
+                length_table[doc] = length
+            with open(os.path.join(self.path, 'lengths'), 'wb') as out:
+                out.write(_to_bytes(length_table))
+            with open(os.path.join(self.path, 'bounds'), 'wb') as out:
+                out.write(_to_bytes(self.bounds))
+
+        # The meta file goes last, so a half-written index will not load
+        with open(os.path.join(self.path, 'meta'), 'wb') as out:
+            out.write(META.pack(MAGIC, VERSION, n_docs, self.n_terms, max_doc,
+                CODEC_IDS.index(self.codec.name)))
+
+
+def write_index(ii, path, codec='raw'):
+    ''' write an InvertedIndex to the directory at path '''
+    writer = IndexWriter(path, codec, ii.doc_lengths)
+
+    # Sort on the encoded bytes, which is the order lookups compare in
+    terms = sorted(ii.items, key=lambda t: t.encode('utf-8'))
+
+    # Forward (term number, tf, weight) lists of every doc
+    forward = {}
+    for term in terms:
+        # Postings are written in docID order, whether or not the
+        #   index was sorted before saving
+        postings = sorted((doc, sorted(posting.positions))
+            for doc, posting in ii.items[term].posting.items())
+        term_id = writer.add_term(term, postings)
+
+        for doc, positions in postings:
+            weight = ii.doc_tfidf[doc].get(term, 0.0) \
+                if doc in ii.doc_tfidf else 0.0
+            forward.setdefault(doc, []).append(
+                (term_id, len(positions), weight))
+
+    vectors = ((doc, forward[doc]) for doc in sorted(forward))
+    writer.finish(ii.nDocs, ii.indexed_docs(), ii.doc_norms, vectors)
+
+
+class DiskIndexItem:
+    ''' an index item whose postings stay on disk until first used '''
+
+    def __init__(self, lexicon, term, df, post_off, post_len, pos_off,
+            pos_len, max_score=None):
+        self.term = term
+        self.df = df
+        self.max_score = max_score # see InvertedIndex.max_score
+        self._lexicon = lexicon
+        self._post = (post_off, post_off + post_len)
+        self._pos = (pos_off, pos_off + pos_len)
+        self._docs = None
+        self._posting = None
+
+    def doc_freq(self):
+        ''' number of docs the term is in, without decoding postings '''
+        return self.df
+
+    def iter_postings(self):
+        ''' stream (docID, tf) pairs in docID order '''
+        codec = self._lexicon.codec
+        start, end = self._post
+        block = self._lexicon.postings[start : end]
+        if not codec.gaps:
+            # docIDs, then term frequencies
+            half = 4 * self.df
+            return zip(codec.decode(block[:half]), codec.decode(block[half:]))
+        return self._iter_gap_pairs(codec.decode(block))
+
+    def _iter_gap_pairs(self, stream):
+        doc = 0
+        for _ in range(self.df):
+            doc += next(stream)
+            yield doc, next(stream)
+
+    def postings_arrays(self):
+        ''' (docIDs, tfs) read in place from the mapped postings of a raw
+            index, or from the postings already decoded; None if they
+            would have to be decoded first '''
+        if self._posting is not None:
+            return self._posting.docids, self._posting.tfs
+        if self._lexicon.codec.gaps or sys.byteorder == 'big' or \
+           not self.df:
+            return None
+        # Raw blocks are little-endian uint32s: docIDs, then tfs
+        start = self._post[0]
+        half = 4 * self.df
+        block = memoryview(self._lexicon.postings)[start : start + 2 * half]
+        return block[:half].cast('I'), block[half:].cast('I')
+
+    def iter_docids(self):
+        ''' stream docIDs in order, without decoding any positions '''
+        if self._docs is not None:
+            return iter(self._docs)
+        if not self._lexicon.codec.gaps:
+            start = self._post[0]
+            return self._lexicon.codec.decode(
+                self._lexicon.postings[start : start + 4 * self.df])
+        return (doc for doc, _ in self.iter_postings())
+
+    @property
+    def sorted_postings(self):
+        ''' docIDs, sorted; only the postings block is decoded '''
+        if self._docs is None:
+            self._docs = array('I', self.iter_docids())
+        return self._docs
+
+    @property
+    def posting(self):
+        ''' CompactPostings of the term, decoded on first access '''
+        if self._posting is None:
+            codec = self._lexicon.codec
+            start, end = self._pos
+            block = self._lexicon.positions[start : end]
+
+            docids = array('I')
+            tfs = array('I')
+            for doc, tf in self.iter_postings():
+                docids.append(doc)
+                tfs.append(tf)
+
+            if codec.gaps:
+                # Positions restart from 0 in every doc
+                stream = codec.decode(block)
+                positions = array('I')
+                for tf in tfs:
+                    positions.extend(from_gaps(islice(stream, tf)))
+            else:
+                positions = _from_bytes('I', block)
+
+            self._posting = CompactPostings(docids, tfs, positions)
+            self._docs = docids
+        return self._posting
+
+    def sort(self):
+        ''' postings on disk are already sorted '''
+        pass
+
+
+class DiskLexicon(Mapping):
+    ''' read-only term -> DiskIndexItem mapping over a saved index '''
+
+    def __init__(self, path, n_terms, version=VERSION, codec='raw'):
+        self.n_terms = n_terms
+        self.codec = get_codec(codec)
+        self.record = LEX_RECORD if version > 1 else LEX_RECORD_V1
+        self.terms = _map(os.path.join(path, 'terms'))
+        self.records = _map(os.path.join(path, 'lexicon'))
+        self.postings = _map(os.path.join(path, 'postings'))
+        self.positions = _map(os.path.join(path, 'positions'))
+        self.bounds = None
+        if os.path.isfile(os.path.join(path, 'bounds')):
+            self.bounds = _from_bytes('d', _map(os.path.join(path, 'bounds')))
+
+        # Items already handed out, so their decoded postings are kept
+        self._cache = {}
+
+    def _record(self, i):
+        return self.record.unpack_from(self.records, i * self.record.size)
+
+    def term_at(self, i):
+        ''' the i-th term in sorted order '''
+        off, length = self._record(i)[:2]
+        return self.terms[off : off + length].decode('utf-8')
+
+    def _search(self, term):
+        ''' binary search for a term; return its number or -1 '''
+        key = term.encode('utf-8')
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            off, length = self._record(mid)[:2]
+            found = self.terms[off : off + length]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def __getitem__(self, term):
+        if term in self._cache:
+            return self._cache[term]
+        if not isinstance(term, str):
+            raise KeyError(term)
+        i = self._search(term)
+        if i < 0:
+            raise KeyError(term)
+        record = self._record(i)
+        if self.record is LEX_RECORD_V1:
+            # Version 1 is raw, where the postings length follows from df;
+            #   positions are written in term order, so a term's block
+            #   ends where the next term's starts
+            _, _, df, post_off, pos_off = record
+            pos_end = self._record(i + 1)[4] if i + 1 < self.n_terms \
+                else len(self.positions)
+            item = DiskIndexItem(self, term, df, post_off, 8 * df, pos_off,
+                pos_end - pos_off)
+        else:
+            item = DiskIndexItem(self, term, *record[2:],
+                max_score=self.bounds[i] if self.bounds is not None else None)
+        self._cache[term] = item
+        return item
+
+    def __contains__(self, term):
+        return term in self._cache or \
+            (isinstance(term, str) and self._search(term) >= 0)
+
+    def __len__(self):
+        return self.n_terms
+
+    def __iter__(self):
+        for i in range(self.n_terms):
+            yield self.term_at(i)
+
+
+class DiskDocVectors(Mapping):
+    ''' read-only docID -> {term: weight} mapping over a saved index '''
+
+    def __init__(self, path, lexicon, max_doc, version=VERSION):
+        self.lexicon = lexicon
+        self.max_doc = max_doc
+        self.record = VEC_RECORD if version > 2 else VEC_RECORD_V2
+        self.offsets = _from_bytes('Q', _map(os.path.join(path, 'vecidx')))
+        self.vectors = _map(os.path.join(path, 'vectors'))
+
+    def _records(self, doc):
+        if not isinstance(doc, int) or not 0 < doc <= self.max_doc:
+            raise KeyError(doc)
+        for off in range(self.offsets[doc], self.offsets[doc + 1],
+                self.record.size):
+            yield self.record.unpack_from(self.vectors, off)
+
+    def __getitem__(self, doc):
+        # Zero weights are stored to keep the tfs; vectors stay sparse
+        vector = {}
+        for record in self._records(doc):
+            if record[-1] != 0:
+                vector[self.lexicon.term_at(record[0])] = record[-1]
+        return vector
+
+    def term_freqs(self, doc):
+        ''' {term: tf} of every term in a doc (version 3 indexes) '''
+        if self.record is not VEC_RECORD:
+            raise ValueError("Index version too old to hold term frequencies")
+        return {self.lexicon.term_at(term_id): tf
+            for term_id, tf, _ in self._records(doc)}
+
+    def __len__(self):
+        return self.max_doc
+
+    def __iter__(self):
+        return iter(range(1, self.max_doc + 1))
+
+
+def load_index(ii, path):
+    ''' point an InvertedIndex at the saved index in path '''
+    with open(os.path.join(path, 'meta'), 'rb') as f:
+        meta = f.read()
+    magic, version = struct.unpack_from('<8sI', meta)
+    if magic != MAGIC:
+        raise ValueError(path + " is not an index directory")
+    if version == 1:
+        _, _, n_docs, n_terms, max_doc = META_V1.unpack(meta)
+        codec = 'raw'
+    elif version <= VERSION:
+        _, _, n_docs, n_terms, max_doc, codec_id = META.unpack(meta)
+        codec = CODEC_IDS[codec_id]
+    else:
+        raise ValueError("Unsupported index format version " + str(version))
+
+    ii.nDocs = n_docs
+    ii.items = DiskLexicon(path, n_terms, version, codec)
+    ii.doc_tfidf = DiskDocVectors(path, ii.items, max_doc, version)
+    if version > 2:
+        ii.doc_ids = _from_bytes('I', _map(os.path.join(path, 'docids')))
+    else:
+        ii.doc_ids = array('I', range(1, n_docs + 1))
+
+    norms = _from_bytes('d', _map(os.path.join(path, 'norms')))
+    ii.doc_norms = {doc: norms[doc] for doc in range(1, max_doc + 1)}
+
+    ii.doc_lengths = {}
+    if os.path.isfile(os.path.join(path, 'lengths')):
+        lengths = _from_bytes('I', _map(os.path.join(path, 'lengths')))
+        ii.doc_lengths = {doc: lengths[doc] for doc in ii.doc_ids}
+
+
+class _IndexUnpickler(pickle.Unpickler):
+    ''' resolve classes pickled by running index.py as a script '''
+
+    def find_class(self, module, name):
+        if module == '__main__' and name in ('IndexItem', 'Posting'):
+            module = 'index'
+        return super().find_class(module, name)
+
+
+def load_pickle(ii, filename):
+    ''' fill an InvertedIndex from an old pickled index '''
+    with open(filename, 'rb') as inf:
+        file_read = _IndexUnpickler(inf).load()
+    ii.items = file_read[0]
+    ii.nDocs = file_read[1]
+    ii.doc_tfidf = file_read[2]
+
+    # Older indexes did not save the vector lengths
+    ii.doc_norms = file_read[3] if len(file_read) > 3 else {}
+    if not ii.doc_norms:
+        ii.compute_tfidf()
+
+
+def convert(pkl_file, path, codec='raw'):
+    ''' convert a pickled index to the binary format '''
+    from index import InvertedIndex
+    ii = InvertedIndex()
+    load_pickle(ii, pkl_file)
+    write_index(ii, path, codec)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print("Syntax: python diskindex.py <index.pkl> <index-save-location> [codec]")
+    else:
+        convert(*sys.argv[1:])
+        print("Index saved to", sys.argv[2] + "!")
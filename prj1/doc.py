@@ -4,8 +4,53 @@ The document class, containing information from the raw document and possibly ot
 
 The collection class holds a set of docuemnts, indexed by docID
 
+    A collection can also be backed by a document store saved in an
+    index directory, so single documents can be read without parsing
+    cran.all. The store is a few flat files in path/docs:
+
+        meta      magic, version, number of docs, number of blocks
+        blocks    zlib-compressed blocks of records, one after another
+        blockidx  byte offset of every block in blocks (blocks + 1)
+        docidx    per doc, sorted by docID: docID, block number, offset
+                  of its record in the uncompressed block
+
+    A record is the utf-8 lengths of docID, title, author and body
+    (RECORD), then the four strings. Records are packed into a block
+    until it holds BLOCK_SIZE bytes, in the order the docs were written.
+    Finding a doc is a binary search of docidx and one block to
+    decompress; the last CACHE_BLOCKS blocks stay decompressed.
+
+usage (write a store, or time lookups in one):
+    python doc.py write <cran.all> <index-dir>
+    python doc.py report <index-dir>
+
 '''
 
+import os
+import zlib
+import shutil
+import struct
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from diskindex import _to_bytes, _from_bytes, _map
+
+MAGIC = b'CRANDOC\0'
+VERSION = 1
+
+# magic, version, docs, blocks
+META = struct.Struct('<8sIII')
+
+# utf-8 lengths of docID, title, author, body
+RECORD = struct.Struct('<IIII')
+
+# Uncompressed bytes per block
+BLOCK_SIZE = 8192
+
+# Decompressed blocks kept by each DocStore
+CACHE_BLOCKS = 64
+
+
 class Document:
     def __init__(self, docid, title, author, body):
         self.docID = docid
@@ -17,18 +62,208 @@ class Document:
     # add more methods if needed
 
 
+def has_store(path):
+    ''' true if an index directory holds a saved document store '''
+    return path is not None and \
+        os.path.isfile(os.path.join(path, 'docs', 'meta'))
+
+
+def write_store(docs, path, level=6):
+    ''' write docs (any iterable of Documents) to path/docs; returns the
+        number of docs written '''
+    out_dir = os.path.join(path, 'docs')
+    os.makedirs(out_dir, exist_ok=True)
+    block_idx = array('Q', [0])
+    with open(os.path.join(out_dir, 'blocks'), 'wb') as out:
+        entries = _write_blocks(docs, out, block_idx, level)
+    return _write_index(out_dir, block_idx, entries)
+
+
+def add_to_store(docs, path, level=6):
+    ''' add docs to the store in path/docs, replacing any with the same
+        docID; returns the number of docs it then holds
+
+        The compressed blocks already there are copied as they are and
+        the new docs packed into blocks after them, in a new store that
+        then takes the old one's place (readers that have the old one
+        open keep reading it). A replaced doc's record stays in its
+        block, but nothing points to it. '''
+    store = DocStore(path)
+    out_dir = os.path.join(path, 'docs.new')
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    block_idx = array('Q', store.block_idx)
+    with open(os.path.join(out_dir, 'blocks'), 'wb') as out:
+        out.write(store.blocks)
+        entries = _write_blocks(docs, out, block_idx, level)
+    added = set(doc for doc, _, _ in entries)
+    entries.extend(entry for entry in zip(store.doc_ids, store.doc_block,
+        store.doc_start) if entry[0] not in added)
+    n = _write_index(out_dir, block_idx, entries)
+
+    old_dir = os.path.join(path, 'docs.old')
+    shutil.rmtree(old_dir, ignore_errors=True)
+    os.rename(os.path.join(path, 'docs'), old_dir)
+    os.rename(out_dir, os.path.join(path, 'docs'))
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return n
+
+
+def _write_blocks(docs, out, block_idx, level):
+    ''' pack docs into compressed blocks written to out, adding each
+        block's end to block_idx; returns (docID, block, offset in block)
+        of every doc '''
+    entries = []
+    block = bytearray()
+
+    def flush():
+        data = zlib.compress(bytes(block), level)
+        out.write(data)
+        block_idx.append(block_idx[-1] + len(data))
+        block.clear()
+
+    for doc in docs:
+        fields = [str(f).encode('utf-8') for f in
+            (doc.docID, doc.title, doc.author, doc.body)]
+        entries.append((int(doc.docID), len(block_idx) - 1, len(block)))
+        block += RECORD.pack(*map(len, fields))
+        for f in fields:
+            block += f
+        if len(block) >= BLOCK_SIZE:
+            flush()
+    if block:
+        flush()
+    return entries
+
+
+def _write_index(out_dir, block_idx, entries):
+    ''' write the block and doc indexes, then meta; returns the number
+        of docs '''
+    entries.sort()
+    doc_idx = array('I')
+    for entry in entries:
+        doc_idx.extend(entry)
+    with open(os.path.join(out_dir, 'blockidx'), 'wb') as out:
+        out.write(_to_bytes(block_idx))
+    with open(os.path.join(out_dir, 'docidx'), 'wb') as out:
+        out.write(_to_bytes(doc_idx))
+
+    # The meta file goes last, so a half-written store will not load
+    with open(os.path.join(out_dir, 'meta'), 'wb') as out:
+        out.write(META.pack(MAGIC, VERSION, len(entries),
+            len(block_idx) - 1))
+    return len(entries)
+
+
+class DocStore:
+    ''' the documents saved in an index directory, read one at a time '''
+
+    def __init__(self, path, cache_blocks=CACHE_BLOCKS):
+        in_dir = os.path.join(path, 'docs')
+        with open(os.path.join(in_dir, 'meta'), 'rb') as f:
+            magic, version, self.n_docs, self.n_blocks = \
+                META.unpack(f.read())
+        if magic != MAGIC or version > VERSION:
+            raise ValueError(in_dir + " is not a document store")
+
+        self.blocks = _map(os.path.join(in_dir, 'blocks'))
+        self.block_idx = _from_bytes('Q',
+            _map(os.path.join(in_dir, 'blockidx')))
+        doc_idx = _from_bytes('I', _map(os.path.join(in_dir, 'docidx')))
+        self.doc_ids = doc_idx[0::3]
+        self.doc_block = doc_idx[1::3]
+        self.doc_start = doc_idx[2::3]
+        self.block = lru_cache(maxsize=cache_blocks)(self._read_block)
+
+    def _read_block(self, i):
+        return zlib.decompress(
+            self.blocks[self.block_idx[i] : self.block_idx[i + 1]])
+
+    def __len__(self):
+        return self.n_docs
+
+    def __contains__(self, docID):
+        i = bisect_left(self.doc_ids, int(docID))
+        return i < self.n_docs and self.doc_ids[i] == int(docID)
+
+    def find(self, docID):
+        ''' a Document, or None if the store does not have it '''
+        i = bisect_left(self.doc_ids, int(docID))
+        if i == self.n_docs or self.doc_ids[i] != int(docID):
+            return None
+        block = self.block(self.doc_block[i])
+        pos = self.doc_start[i]
+        lengths = RECORD.unpack_from(block, pos)
+        pos += RECORD.size
+        fields = []
+        for n in lengths:
+            fields.append(block[pos : pos + n].decode('utf-8'))
+            pos += n
+        return Document(*fields)
+
+
 class Collection:
     ''' a collection of documents'''
 
-    def __init__(self):
+    def __init__(self, store=None):
         self.docs = {} # documents are indexed by docID
+        self.store = store # DocStore behind the dict, if any
+
+    @classmethod
+    def open(cls, path):
+        ''' the collection saved with an index '''
+        return cls(DocStore(path))
+
+    def add(self, doc):
+        self.docs[doc.docID] = doc
 
     def find(self, docID):
         ''' return a document object'''
-        if self.docs.has_key(docID):
+        if docID in self.docs:
             return self.docs[docID]
-        else:
-            return None
+        if self.store is not None:
+            return self.store.find(docID)
+        return None
 
     # more methods if needed
 
+
+def report(path, repeat=3):
+    ''' size of a store and the time to find docs, cold and cached '''
+    from time import perf_counter
+
+    store = DocStore(path)
+    stored = sum(os.path.getsize(os.path.join(path, 'docs', name))
+        for name in ('meta', 'blocks', 'blockidx', 'docidx'))
+    raw = sum(len(store._read_block(i)) for i in range(store.n_blocks))
+    print("%d docs in %d blocks: %d bytes of records, %d bytes on disk"
+        % (store.n_docs, store.n_blocks, raw, stored))
+
+    # Cold: every find decompresses its block. Cached: every block is
+    #   already decompressed
+    cached = DocStore(path, cache_blocks=store.n_blocks)
+    for name, reader in (("cold", store), ("cached", cached)):
+        best = None
+        for _ in range(repeat):
+            start = perf_counter()
+            for doc in reader.doc_ids:
+                if reader is store:
+                    store.block.cache_clear()
+                reader.find(doc)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("find, %-6s %8.1f us per doc" % (name,
+            best / store.n_docs * 1e6))
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) == 4 and argv[1] == 'write':
+        from cran import CranFile
+        n = write_store(CranFile(argv[2]), argv[3])
+        print(n, "docs written to", os.path.join(argv[3], 'docs'))
+    elif len(argv) == 3 and argv[1] == 'report':
+        report(argv[2])
+    else:
+        print("Syntax: python doc.py write <cran.all> <index-dir>")
+        print("        python doc.py report <index-dir>")
@@ -10,14 +10,39 @@ Index structure:
 
     each PostingItem contains a document ID and a list of positions that the term occurs
 
+    once sorted, an IndexItem's postings are packed into flat arrays (see
+    postings.py) that are read through the same dict-like interface
+
+    save/load use the binary format in diskindex.py; a loaded index is
+    read-only, with posting lists decoded from disk on first use
+
 '''
 
 import util
 import doc
+import diskindex
+import spimi
 from cran import CranFile
-from pickle import dump, load
+from doc import write_store
+from resources import data_path
+from postings import CompactPostings
+import instrument
 from math import log10, sqrt
+from array import array
+from itertools import islice, count
 from sys import argv
+from time import perf_counter
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from tempfile import mkstemp
+from os import close, remove
+
+# Every change to an index gets a new version stamp, so what is cached
+#   from it (query results, the scoring matrix) can tell it is stale
+_versions = count(1)
+
+def next_version():
+    return next(_versions)
 
 
 class Posting:
@@ -52,36 +77,101 @@ class IndexItem:
         self.term = term
         self.posting = {} #postings are stored in a python dict for easier index building
         self.sorted_postings= [] # may sort them by docID for easier query processing
+        self.max_score = None # largest tf / doc length, once worked out
+
+        # sort() replaces both with array-backed versions (CompactPostings
+        #   and its docID array) once the index is built
 
     def add(self, docid, pos):
         ''' add a posting'''
+        # A sorted item has been packed into arrays; unpack it to add more
+        if not isinstance(self.posting, dict):
+            compact = self.posting
+            self.posting = {}
+            for doc, posting in compact.items():
+                self.posting[doc] = Posting(doc)
+                self.posting[doc].merge(posting.positions)
+            self.sorted_postings = []
+        self.max_score = None
+            
         if not docid in self.posting:
             self.posting[docid] = Posting(docid)
         self.posting[docid].append(pos)
 
+    def doc_freq(self):
+        ''' the number of documents the term appears in'''
+        return len(self.posting)
+
+    def iter_docids(self):
+        ''' stream docIDs in sorted order'''
+        return iter(self.sorted_postings or sorted(self.posting))
+
+    def iter_postings(self):
+        ''' stream (docID, tf) pairs in docID order'''
+        if isinstance(self.posting, CompactPostings):
+            return self.posting.iter_postings()
+        return ((doc, self.posting[doc].term_freq())
+            for doc in self.iter_docids())
+
+    def postings_arrays(self):
+        ''' (docIDs, tfs) as the arrays they are packed in, or None before
+            sort() has packed them'''
+        if isinstance(self.posting, CompactPostings):
+            return self.posting.docids, self.posting.tfs
+        return None
+
     def sort(self):
         ''' sort by document ID for more efficient merging. For each document also sort the positions'''
         # ToDo
         
-        # We already have the postings in posting dict. Store the sorted docID keys
-        #   in sorted_postings list, for easier reference in postings dict.
-        self.sorted_postings = sorted(self.posting)
+        # Pack the postings into flat arrays of docIDs, term frequencies
+        #   and positions, sorted by docID and then by position. The
+        #   packed form still looks like a dict of postings; see postings.py
+        if isinstance(self.posting, dict):
+            self.posting = CompactPostings.from_dict(self.posting)
         
-        # We sort the positions of each posting in place
-        for doc in self.posting:
-            self.posting[doc].sort()
+        # sorted_postings is the docID array itself
+        self.sorted_postings = self.posting.docids
+
+    def merge(self, other):
+        ''' merge in another item for the same term, built from other docs'''
+        # Packed items whose docs all come after ours just get appended
+        if isinstance(self.posting, CompactPostings) and \
+           isinstance(other.posting, CompactPostings) and \
+           (not self.posting or not other.posting or
+                self.posting.docids[-1] < other.posting.docids[0]):
+            self.posting.extend(other.posting)
+            return
+        
+        # Otherwise add the postings one position at a time
+        for doc, posting in other.posting.items():
+            for pos in posting.positions:
+                self.add(doc, pos)
 
 
 class InvertedIndex:
 
-    def __init__(self):
+    def __init__(self, memory_limit=0, tmp_dir=None):
         self.items = {} # list of IndexItems
-        self.doc_tfidf = {} # tf-idf of every term in every doc
+        self.doc_tfidf = {} # sparse tf-idf vector of every doc
+        self.doc_norms = {} # length of every doc's tf-idf vector
         self.nDocs = 0  # the number of indexed documents
+        self.doc_ids = array('I') # docIDs, in the order they were indexed
+        self.doc_lengths = {} # number of words in every doc's body
+        self.path = None # where a loaded index was loaded from
+        self.analyzer = util.default_analyzer() # text to terms, shared with queries
+        self.version = next_version() # changes whenever the index does
+        
+        # With a memory limit (in bytes), indexDoc spills blocks of terms
+        #   to files in tmp_dir and save() merges them; see spimi.py
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.blocks = [] # block files spilled so far
+        self.block_bytes = 0 # estimated size of the block in memory
 
 
     def indexDoc(self, doc): # indexing a Document object
-        ''' indexing a docuemnt, using the simple SPIMI algorithm, but no need to store blocks due to the small collection we are handling. Using save/load the whole index instead'''
+        ''' indexing a docuemnt, using the SPIMI algorithm. Without a memory limit the whole index stays in memory; with one, blocks are written out when they grow too big and merged by save()'''
         
         # Using the SPIMI algorithm as defined at
         # https://nlp.stanford.edu/IR-book/html/htmledition/single-pass-in-memory-indexing-1.html
@@ -102,33 +192,57 @@ class InvertedIndex:
         # ---
         
         # Increment number of documents indexed
+        self.version = next_version()
         self.nDocs += 1
+        self.doc_ids.append(int(doc.docID))
         
         # Grab title and body of doc, merge into one string
         doc_string = doc.body
         
-        # Tokenize and lowercase doc into list form
-        token_list = util.tokenize_doc(doc_string)
-            
-        # Helper function to replace stopwords with empty string
-        def remove_stop_word(tok):
-            return "" if util.isStopWord(tok) else tok
-            
-        # Remove the stopwords from both positional list and token list
-        token_list_no_stopword = list(map(remove_stop_word, token_list))
-        
-        # Stem the words
-        stemmed_token_list = list(map(lambda tok: util.stemming(tok), token_list_no_stopword))
+        # Tokenize, lowercase, drop stopwords (now "") and stem, in one
+        #   pass; see util.Analyzer
+        with instrument.stage('index.analyze'):
+            stemmed_token_list = list(self.analyzer.terms(doc_string))
+        self.doc_lengths[int(doc.docID)] = len(stemmed_token_list)
+        instrument.count('index.docs')
+        instrument.count('index.tokens', len(stemmed_token_list))
         
         # Note that the stemmed tokens are now our terms
-        for pos, term in enumerate(stemmed_token_list):
-            # Skip over stopwords, now replaced by ""
-            if term == "": continue
-            
-            # If this term has already appeared, update the existing posting
-            if not term in self.items:
-                self.items[term] = IndexItem(term)
-            self.items[term].add(int(doc.docID), pos)
+        n_terms = len(self.items)
+        with instrument.stage('index.postings'):
+            for pos, term in enumerate(stemmed_token_list):
+                # Skip over stopwords, now replaced by ""
+                if term == "": continue
+                
+                # If this term has already appeared, update the existing
+                #   posting
+                if not term in self.items:
+                    self.items[term] = IndexItem(term)
+                self.items[term].add(int(doc.docID), pos)
+        
+        # Spill the block once it is estimated to be too big
+        if self.memory_limit:
+            doc_terms = set(stemmed_token_list)
+            doc_terms.discard("")
+            self.block_bytes += \
+                (len(self.items) - n_terms) * spimi.TERM_BYTES + \
+                len(doc_terms) * spimi.POSTING_BYTES + \
+                sum(1 for t in stemmed_token_list if t) * spimi.POSITION_BYTES
+            if self.block_bytes > self.memory_limit:
+                self.flush_block()
+
+    def flush_block(self):
+        ''' write the terms in memory to a new block file and drop them'''
+        if not self.items: return
+        fd, filename = mkstemp(suffix='.blk', dir=self.tmp_dir)
+        close(fd)
+        with instrument.stage('index.spill'):
+            spimi.write_block(self.items, filename)
+        instrument.count('index.blocks')
+        self.version = next_version()
+        self.blocks.append(filename)
+        self.items = {}
+        self.block_bytes = 0
 
 
     def sort(self):
@@ -136,80 +250,133 @@ class InvertedIndex:
         #ToDo
         
         # The actual sort is implemented in IndexItem. Just call it here.
+        self.version = next_version()
         for item in self.items:
             self.items[item].sort()
 
+    def merge(self, other):
+        ''' merge in a partial index built over a different set of docs'''
+        # New terms are added in the order the partial index saw them, so
+        #   merging partials in doc order gives the same index as one pass
+        self.version = next_version()
+        self.nDocs += other.nDocs
+        self.doc_ids.extend(other.doc_ids)
+        self.doc_lengths.update(other.doc_lengths)
+        # Stems a worker process memoized come back with its partial index
+        if other.analyzer is not self.analyzer:
+            self.analyzer.update(other.analyzer)
+        for term, item in other.items.items():
+            if term in self.items:
+                self.items[term].merge(item)
+            else:
+                self.items[term] = item
+
     def find(self, term):
         return self.items[term] if term in self.items else None
 
-    def save(self, filename):
+    def indexed_docs(self):
+        ''' docIDs of every indexed doc, including docs with no terms'''
+        # Indexes from before docIDs were tracked numbered docs from 1
+        return self.doc_ids if len(self.doc_ids) else range(1, self.nDocs + 1)
+
+    def save(self, filename, codec='raw'):
         ''' save to disk'''
-        # ToDo: using your preferred method to serialize/deserialize the index
-        
-        # Combine items dict and nDocs into a list so they can be pickled together
-        to_pickle = [self.items, self.nDocs, self.doc_tfidf]
+        # The index is written as a directory of flat binary files that
+        #   load() can mmap; see diskindex.py for the layout. Postings can
+        #   be compressed with any of the codecs in codec.py.
+        if not self.blocks:
+            diskindex.write_index(self, filename, codec)
+            self.analyzer.save(filename)
+            return
         
-        # Use Pickle to dump the index to a file
-        with open(filename, 'wb') as out:
-            dump(to_pickle, out)
+        # Spilled blocks are merged straight into the saved index, which
+        #   then replaces the partial index held in memory
+        self.flush_block()
+        spimi.merge_blocks(self.blocks, filename, self.nDocs, self.doc_ids,
+            codec, self.memory_limit, self.tmp_dir, self.doc_lengths)
+        for block in self.blocks:
+            remove(block)
+        self.blocks = []
+        self.analyzer.save(filename)
+        self.load(filename)
 
     def load(self, filename):
         ''' load from disk'''
-        # ToDo
-        
-        # Load data back from pickled file
-        with open(filename, 'rb') as inf:
-            file_read = load(inf)
-            self.items = file_read[0]
-            self.nDocs = file_read[1]
-            self.doc_tfidf = file_read[2]
+        # Binary indexes are mapped, not read: postings stay on disk until
+        #   a query asks for them. Old pickled indexes still load.
+        if diskindex.is_disk_index(filename):
+            diskindex.load_index(self, filename)
+            self.analyzer.load(filename)
+        else:
+            diskindex.load_pickle(self, filename)
+        self.path = filename
+        self.version = next_version()
 
     def idf(self, term):
         ''' compute the inverted document frequency for a given term'''
         #ToDo: return the IDF of the term
         
         # IDF of term t is log(total # of docs / # docs with t in it)
-        return log10(self.nDocs / len(self.items[term].posting)) \
+        return log10(self.nDocs / self.items[term].doc_freq()) \
             if term in self.items else 0
 
+    def max_score(self, term):
+        ''' the largest tf / doc length over a term's postings, or None
+            if the doc lengths are not known (see topk.py)'''
+        item = self.find(term)
+        if item is None:
+            return 0.0
+        
+        # Saved indexes store the bound; otherwise work it out once
+        if getattr(item, 'max_score', None) is None:
+            if not self.doc_lengths:
+                return None
+            item.max_score = max(tf / self.doc_lengths[doc]
+                for doc, tf in item.iter_postings())
+        return item.max_score
+
     def compute_tfidf(self):
-        """ pre-compute tf-idf vectors for each word in each doc """
-        # Handle empty items with empty fector
-        self.doc_tfidf[471] = {}
-        self.doc_tfidf[995] = {}
+        """ pre-compute sparse tf-idf vectors for each doc """
+        # Spilled indexes get their vectors while the blocks are merged
+        if self.blocks: return
         
-        # Compute tf-idf vector for every other doc
-        for iter in range(self.nDocs):
-            doc = iter + 1
-            word_vector = {}
-            
-            # Ignore docs we know to be empty
-            if doc in (471, 995): continue
-            
-            for word in self.items:
-                # Get tf
-                try:
-                    tf = self.find(word).posting[doc].term_freq()
-                except KeyError: # if not in doc
-                    tf = 0
-                
-                # Get idf
-                idf = self.idf(word)
+        # Only the (term, doc) pairs that actually appear in a posting get
+        #   a weight; every other weight is 0 and is simply not stored.
+        
+        # Compute the idf of every term once, rather than once per doc
+        idf_table = {}
+        for word in self.items:
+            idf_table[word] = self.idf(word)
+        
+        # Every doc starts with an empty vector. Docs with no terms
+        #   (e.g. 471 and 995 in Cranfield) just stay that way.
+        self.doc_tfidf = {doc: {} for doc in self.indexed_docs()}
+        
+        # Walk the real postings, filling in the un-normalized weights
+        with instrument.stage('index.tfidf.weights'):
+            for word, item in self.items.items():
+                idf = idf_table[word]
                 
-                # Calculate tf-idf; add to current dict
-                word_vector[word] = log10(1 + tf) * idf
+                # A term in every doc has an idf of 0; it adds nothing
+                if idf == 0: continue
                 
-            # Normalize the word vector
-            accum = 0
-            for word in word_vector:
-                accum += word_vector[word]**2
-            accum = sqrt(accum)
+                for doc, posting in item.posting.items():
+                    self.doc_tfidf.setdefault(doc, {})[word] = \
+                        log10(1 + posting.term_freq()) * idf
+                instrument.count('postings.scanned', len(item.posting))
+        
+        # Normalize each vector by its length, keeping the lengths around
+        with instrument.stage('index.tfidf.normalize'):
+            self.doc_norms = {}
+            for doc, word_vector in self.doc_tfidf.items():
+                accum = sqrt(sum(w * w for w in word_vector.values()))
+                self.doc_norms[doc] = accum
                 
-            for word in word_vector:
-                word_vector[word] /= accum
+                # Empty vectors have nothing to normalize
+                if accum == 0: continue
                 
-            self.doc_tfidf[doc] = word_vector
-
+                for word in word_vector:
+                    word_vector[word] /= accum
 
 def test():
     ''' test your code thoroughly. put the testing cases here'''
@@ -217,7 +384,7 @@ def test():
     ####### TEST CASES FOR INVERTED INDEX CLASS #######
     
     # Get all documents from cran.all--let Cranfile object handle this
-    cf = CranFile("cran.all")
+    cf = CranFile(data_path("cran.all"))
     
     # Build an inverted index object
     ii = InvertedIndex()
@@ -261,12 +428,21 @@ def test():
     # Get the tfidf dict
     ii.compute_tfidf()
     
+    # Empty docs should be found without being told which they are
+    print("Empty docs have empty tf-idf vectors:",
+        ii.doc_tfidf[471] == {} and ii.doc_tfidf[995] == {})
+    
+    # Vectors are sparse: only terms in the doc are stored
+    print("Doc tf-idf vectors only hold terms in the doc:",
+        all(doc in ii.find(word).posting for doc in ii.doc_tfidf
+            for word in ii.doc_tfidf[doc]))
+    
     # Save off our index
-    ii.save("index.pkl")
+    ii.save("test_index")
     
     # Read back in the index, ensure they are the same
     ii_from_file = InvertedIndex()
-    ii_from_file.load("index.pkl")
+    ii_from_file.load("test_index")
     
     # Cannot determine if the actual items are equal objects, 
     #   so just ensure the stats are the same
@@ -323,10 +499,10 @@ def test():
     #     in the index, but some double-stemmings differ anyway.
     
     # Ensure stopwords were removed
-    from nltk.stem.porter import PorterStemmer
-    with open("stopwords") as f:
+    from resources import stemmer
+    with open(data_path("stopwords")) as f:
         stopwords = f.readlines()
-    s = PorterStemmer()
+    s = stemmer()
     stopword_vector = list(
         map(lambda x: s.stem(x.strip()) in ii.items.items(), stopwords))
     print("All stopwords removed from index:", not any(stopword_vector))
@@ -344,37 +520,140 @@ def test():
     print("Average posting length:", sum/posting_count)
     
 
+def index_docs(docs):
+    ''' build a sorted index over a list of docs (one worker's slice)'''
+    ii = InvertedIndex()
+    for doc in docs:
+        ii.indexDoc(doc)
+    ii.sort()
+    return ii
+
+
+def build_index(docs, workers=1, chunk_size=0, memory_limit=0, tmp_dir=None):
+    ''' index docs, splitting them over a pool of processes. docs can be any iterable (a CranFile is read from disk a doc at a time), but needs a len() to pick a default chunk size'''
+    # A memory-bounded build spills blocks as it goes, in one process
+    if memory_limit:
+        ii = InvertedIndex(memory_limit, tmp_dir)
+        for doc in docs:
+            ii.indexDoc(doc)
+        ii.sort()
+        return ii
+    
+    if workers <= 1:
+        return index_docs(docs)
+    
+    # By default give each worker a few chunks, to even out the load
+    if chunk_size <= 0:
+        chunk_size = max(1, -(-len(docs) // (workers * 4)))
+    docs = iter(docs)
+    chunks = iter(lambda: list(islice(docs, chunk_size)), [])
+    
+    # Partial indexes come back in chunk order, which keeps the merged
+    #   index identical to a serial build
+    ii = InvertedIndex()
+    with Pool(workers) as pool:
+        for part in pool.imap(index_docs, chunks):
+            ii.merge(part)
+    ii.sort()
+    return ii
+
+
+def same_index(a, b):
+    ''' true if two indexes hold exactly the same postings'''
+    if a.nDocs != b.nDocs or list(a.items) != list(b.items):
+        return False
+    for term in a.items:
+        pa = [(d, p.positions) for d, p in a.items[term].posting.items()]
+        pb = [(d, p.positions) for d, p in b.items[term].posting.items()]
+        if pa != pb:
+            return False
+    return True
+
+
 def indexingCranfield():
     #ToDo: indexing the Cranfield dataset and save the index to a file
     # command line usage: "python index.py cran.all index_file"
     # the index is saved to index_file
     
-    # Ensure args are valid
-    if len(argv) != 3:
-        print("Syntax: python index.py <cran.all path> <index-save-location>")
-        return
-
     # Grab arguments
-    file_to_index = argv[1]
-    save_location = argv[2]
-    
-    # Index file
-    print("Indexing documents from", file_to_index + "...")
-    cf = CranFile(file_to_index)
-    ii = InvertedIndex()
-    for doc in cf.docs:
-        ii.indexDoc(doc)
+    parser = ArgumentParser(description="Index the Cranfield collection")
+    parser.add_argument("cran_file", help="cran.all path")
+    parser.add_argument("save_location", help="index save location")
+    parser.add_argument("codec", nargs="?", default="raw",
+        choices=["raw", "vbyte", "gamma", "delta"],
+        help="posting list codec (default raw)")
+    parser.add_argument("--workers", type=int, default=1,
+        help="number of indexing processes (default 1)")
+    parser.add_argument("--chunk-size", type=int, default=0,
+        help="docs per worker task (default: a quarter of an even split)")
+    parser.add_argument("--report", action="store_true",
+        help="also build serially and report the parallel speedup, or the "
+             "peak RSS of a --memory-limit build")
+    parser.add_argument("--memory-limit", type=float, default=0,
+        help="spill index blocks to disk past this many MB (one process)")
+    parser.add_argument("--tmp-dir", default=None,
+        help="where to write spilled blocks (default: system temp dir)")
+    parser.add_argument('--spelling', action='store_true',
+        help="also save a spelling table of the words the index knows "
+            "(see spelling.py)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv[1:])
+    
+    # Stage timings, a profile or heap snapshots, if asked for
+    with instrument.session(args):
+        # Index file
+        print("Indexing documents from", args.cran_file + "...")
+        cf = CranFile(args.cran_file)
+        start = perf_counter()
+        with instrument.stage('index.build'):
+            ii = build_index(cf, args.workers, args.chunk_size,
+                int(args.memory_limit * 2**20), args.tmp_dir)
+        elapsed = perf_counter() - start
+        if ii.blocks:
+            print("Spilled", len(ii.blocks), "blocks")
         
-    # Sort index before saving
-    ii.sort()
-    
-    # Compute tf-idf vector representations for each doc
-    ii.compute_tfidf()
+        # Compare against a one-process build
+        if args.report and not args.memory_limit:
+            start = perf_counter()
+            serial = build_index(cf)
+            serial_elapsed = perf_counter() - start
+            print("Serial build: %.2fs" % serial_elapsed)
+            print("Parallel build (%d workers): %.2fs" % (args.workers,
+                elapsed))
+            print("Speedup: %.2fx" % (serial_elapsed / elapsed))
+            print("Parallel build matches serial build:",
+                same_index(ii, serial))
         
-    # Save off index
-    ii.save(save_location)
-    print("Index saved to", save_location + "!")
-    
+        # Compute tf-idf vector representations for each doc
+        with instrument.stage('index.tfidf'):
+            ii.compute_tfidf()
+            
+        # Save off index
+        with instrument.stage('index.save'):
+            ii.save(args.save_location, args.codec)
+        print("Index saved to", args.save_location + "!")
+        
+        # The document text goes with the index, so results can be shown
+        #   without parsing the collection again (see doc.py)
+        with instrument.stage('index.docstore'):
+            n = write_store(cf, args.save_location)
+        print("Document store of", n, "docs saved")
+        
+        # Query-time spelling correction, restricted to the index
+        #   vocabulary
+        if args.spelling:
+            import spelling
+            n = spelling.build(args.save_location, index_vocab=True)
+            print("Spelling table of", n, "words saved")
+        
+        # Memory-bounded builds report how much memory they really took
+        if args.report and args.memory_limit:
+            try:
+                from resource import getrusage, RUSAGE_SELF
+                print("Peak RSS:", getrusage(RUSAGE_SELF).ru_maxrss, "KB")
+            except ImportError:
+                print("Peak RSS: not available on this platform")
+
 
 if __name__ == '__main__':
     #test()  # Uncomment to run tests
@@ -0,0 +1,206 @@
+'''
+
+Per-stage timers and counters for the indexing and query paths
+
+    Code marks its stages and counts what it does:
+
+        with instrument.stage('vector.score'):
+            ...
+        instrument.count('postings.scanned', len(docs))
+
+    Both do nothing (beyond one check of a flag) until instrument.enable()
+    is called, so the marks stay in the code for good. Once enabled, each
+    stage adds up its calls and wall time, and each counter its total.
+    Stage times are inclusive: a stage run inside another is counted in
+    both, and names say what they are part of ('vector.score' is part of
+    'vector').
+
+    Stages and counters kept in another process (a worker of a Pool) can
+    be taken there with take() and added to this process with merge().
+
+    index.py, query.py and batch_eval.py take the same flags (see
+    add_arguments):
+
+        --stages            print the stage and counter breakdown at exit
+        --profile [FILE]    run under cProfile; save the stats to FILE, or
+                            print the top functions without one
+        --tracemalloc       print the peak heap and the lines that hold
+                            the most memory at exit
+
+'''
+
+import sys
+from time import perf_counter
+from collections import Counter
+from contextlib import contextmanager
+
+# Functions printed by --profile without a file
+PROFILE_LINES = 25
+
+# Allocation sites printed by --tracemalloc
+TRACEMALLOC_LINES = 10
+
+enabled = False
+
+# stage -> [calls, seconds]
+timers = {}
+
+counters = Counter()
+
+
+class _Timer:
+    ''' times one run of a stage '''
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = perf_counter() - self.start
+        entry = timers.get(self.name)
+        if entry is None:
+            timers[self.name] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+        return False
+
+
+class _NoTimer:
+    ''' what stage() gives while instrumentation is off '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+def stage(name):
+    ''' a context manager that times a stage, when enabled '''
+    return _Timer(name) if enabled else _NO_TIMER
+
+
+def count(name, n=1):
+    ''' add n to a counter, when enabled '''
+    if enabled:
+        counters[name] += n
+
+
+def timed(name, function):
+    ''' function, timed as a stage on every call, when enabled '''
+    if not enabled:
+        return function
+    def run(*args, **kwargs):
+        with _Timer(name):
+            return function(*args, **kwargs)
+    return run
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    timers.clear()
+    counters.clear()
+
+
+def take():
+    ''' (timers, counters) recorded so far, which are then reset '''
+    taken = ({name: list(entry) for name, entry in timers.items()},
+        dict(counters))
+    reset()
+    return taken
+
+
+def merge(taken):
+    ''' add the result of take() in another process to this one '''
+    other_timers, other_counters = taken
+    for name, (calls, seconds) in other_timers.items():
+        entry = timers.setdefault(name, [0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+    counters.update(other_counters)
+
+
+def report():
+    ''' the stages, by name, and the counters as text '''
+    lines = ["%-28s %10s %12s %12s" % ("stage", "calls", "total (ms)",
+        "mean (us)")]
+    for name in sorted(timers):
+        calls, seconds = timers[name]
+        lines.append("%-28s %10d %12.2f %12.2f" % (name, calls,
+            seconds * 1000, seconds / calls * 1e6))
+    if counters:
+        lines.append("")
+        lines.append("%-28s %10s" % ("counter", "total"))
+        for name in sorted(counters):
+            lines.append("%-28s %10d" % (name, counters[name]))
+    return "\n".join(lines)
+
+
+def add_arguments(parser):
+    ''' the --stages, --profile and --tracemalloc flags '''
+    parser.add_argument('--stages', action='store_true',
+        help="print time spent per stage, and counters, at exit")
+    parser.add_argument('--profile', nargs='?', const='-', default=None,
+        metavar='FILE', help="run under cProfile; save the stats to FILE, "
+            "or print the top functions")
+    parser.add_argument('--tracemalloc', action='store_true',
+        help="print the peak heap and the biggest allocation sites at exit")
+
+
+@contextmanager
+def session(args, out=sys.stdout):
+    ''' run a command's work with the instrumentation its flags ask for,
+        printing the results when it ends (even by an exception) '''
+    stages = getattr(args, 'stages', False)
+    profile = getattr(args, 'profile', None)
+    memory = getattr(args, 'tracemalloc', False)
+    if stages:
+        reset()
+        enable()
+    if memory:
+        import tracemalloc
+        tracemalloc.start()
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if stages:
+            enable(False)
+            print("\n" + report(), file=out)
+        if memory:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("\nHeap: %.1f MB now, %.1f MB at peak" % (current / 2**20,
+                peak / 2**20), file=out)
+            for stat in snapshot.statistics('lineno')[:TRACEMALLOC_LINES]:
+                print(stat, file=out)
+        if profiler is not None:
+            import pstats
+            if profile == '-':
+                print(file=out)
+                pstats.Stats(profiler, stream=out).sort_stats(
+                    'cumulative').print_stats(PROFILE_LINES)
+            else:
+                profiler.dump_stats(profile)
+                print("\nProfile saved to", profile, file=out)
@@ -0,0 +1,251 @@
+'''
+
+Sparse matrix scoring backend for vectorQuery
+
+    The index is held as a scipy.sparse CSR matrix with a row per term and
+    a column per docID, where
+
+        W[t, d] = tf(t, d) / len(d)
+
+    so each row is a term's posting list, already divided by the doc
+    lengths. A query becomes a sparse row vector q over the terms, with
+
+        q[t] = n(t) * log10(1 + n(t)) * idf(t)
+
+    for a word that appears n(t) times (the Python loop adds the weight
+    once per occurrence), and every doc is scored by the one product q W.
+    Only the rows of the query's terms are touched. The top k come out of
+    np.argpartition, and only those k are sorted.
+
+    A batch of queries is a sparse matrix Q with a row per query, scored
+    by the single product Q W: each idf is looked up once for the batch,
+    and the work per query is what is left once the Python overhead of a
+    product is paid only once.
+
+    The matrix is built from the index the first time it is needed and
+    kept with the index, so a process pays for it once. It is built again
+    when the index's version stamp changes (see resultcache.py), or its
+    number of docs or (in memory) of terms does, so an index without a
+    stamp is never scored against a stale matrix either.
+
+usage (compare rankings and latency with the Python backend, one query
+at a time and as a batch):
+    python matrix.py index_dir [k]
+
+'''
+
+import numpy as np
+from math import log10
+from collections import Counter
+from scipy.sparse import csr_matrix
+
+# Scores closer than this are treated as ties when comparing backends;
+#   the two add up the same numbers in a different order
+TOLERANCE = 1e-12
+
+
+def _stamp(index):
+    ''' what has to stay the same for a built matrix to still fit an index:
+        its version, its doc count, and its term count where that is cheap
+        (saved and segmented lexicons are not changed in place) '''
+    items = index.items
+    return (getattr(index, 'version', None), index.nDocs,
+        len(items) if isinstance(items, dict) else None)
+
+
+class TermDocMatrix:
+    ''' the CSR term-document weight matrix of an index '''
+
+    def __init__(self, index, doc_length):
+        self.index = index
+        self.term_ids = {}
+        indptr = [0]
+        indices = []
+        data = []
+        for term in index.items:
+            self.term_ids[term] = len(self.term_ids)
+            for doc, tf in index.items[term].iter_postings():
+                indices.append(doc)
+                data.append(tf / doc_length(doc))
+            indptr.append(len(indices))
+
+        n_cols = max(index.indexed_docs(), default=0) + 1
+        self.matrix = csr_matrix((np.array(data, dtype=np.float64),
+            np.array(indices, dtype=np.int32), np.array(indptr,
+            dtype=np.int64)), shape=(len(self.term_ids), n_cols))
+
+    @classmethod
+    def for_index(cls, index, doc_length):
+        ''' the index's matrix, built on first use and again whenever the
+            index changes '''
+        matrix = getattr(index, '_term_doc_matrix', None)
+        stamp = _stamp(index)
+        if matrix is None or matrix.stamp != stamp:
+            matrix = cls(index, doc_length)
+            matrix.stamp = stamp
+            index._term_doc_matrix = matrix
+        return matrix
+
+    def query_vector(self, terms):
+        ''' sparse 1 x terms row of query weights '''
+        return self.query_matrix([terms])
+
+    def query_matrix(self, term_lists):
+        ''' sparse queries x terms matrix, a row of weights per query '''
+        idf = {}
+        rows = []
+        cols = []
+        data = []
+        for row, terms in enumerate(term_lists):
+            counts = Counter(t for t in terms if t in self.term_ids)
+            for t, n in counts.items():
+                if t not in idf:
+                    idf[t] = self.index.idf(t)
+                rows.append(row)
+                cols.append(self.term_ids[t])
+                data.append(n * log10(1 + n) * idf[t])
+        return csr_matrix((data, (rows, cols)),
+            shape=(len(term_lists), self.matrix.shape[0]))
+
+    def top_k(self, terms, k):
+        ''' (docID, score) pairs of the k best docs, best first
+
+            Equal scores are ranked by docID, as in the Python backend,
+            including at the cutoff. The two backends add a doc's score
+            up in a different order, so scores that differ only by
+            rounding can still come out in another order (see
+            same_ranking). Returns the pairs and the number of docs that
+            got a score. '''
+        return self.top_k_batch([terms], k)[0]
+
+    def top_k_batch(self, term_lists, k):
+        ''' top_k of every query in a list, from one matrix product '''
+        scores = (self.query_matrix(term_lists) @ self.matrix).tocsr()
+        return [_best(scores.indices[start:end], scores.data[start:end], k)
+            for start, end in zip(scores.indptr[:-1], scores.indptr[1:])]
+
+
+def _best(docs, values, k):
+    ''' the k best of one query's scored docs, and how many there were '''
+    if k <= 0 or not len(docs):
+        return [], len(docs)
+    scored = len(docs)
+    if scored > k:
+        # Every doc tied with the k-th best, so the cutoff goes by docID
+        kth = -np.partition(-values, k - 1)[k - 1]
+        best = values >= kth
+        docs, values = docs[best], values[best]
+    order = np.lexsort((docs, -values))[:k]
+    return [(int(docs[i]), float(values[i])) for i in order], scored
+
+
+def same_ranking(expected, got, scores, tolerance=TOLERANCE):
+    ''' true if got is a correct top k, given the top k expected and the
+        scores of every doc from the same scorer as expected
+
+        Both must have the same score at every rank, and each doc in got
+        must really have its score; docs with tied scores can come in
+        either order, or either side of the cutoff. '''
+    def close(x, y):
+        return abs(x - y) <= tolerance * max(1.0, abs(x))
+    if len(expected) != len(got) or len(set(d for d, _ in got)) != len(got):
+        return False
+    return all(close(e_score, g_score) and g_doc in scores and
+            close(scores[g_doc], g_score)
+        for (_, e_score), (g_doc, g_score) in zip(expected, got))
+
+
+def compare(path, k=10):
+    ''' rank the Cranfield queries with both backends and report '''
+    from time import perf_counter
+    from segments import open_index
+    from cranqry import loadCranQry
+    from query import QueryProcessor
+    from resources import data_path
+
+    ii = open_index(path)
+    qc = loadCranQry(data_path("query.text"))
+
+    # Building the matrix is a one-off cost
+    start = perf_counter()
+    QueryProcessor("", ii, backend='scipy').vectorQuery(k)
+    print("Matrix built in %.1f ms" % ((perf_counter() - start) * 1000))
+
+    times = {'python': 0.0, 'scipy': 0.0}
+    differ = []
+    for qid in qc:
+        # Spelling correction would swamp the scoring; do it once
+        results = {}
+        terms = QueryProcessor(qc[qid].text, ii).preprocessing()
+        for backend in times:
+            qp = QueryProcessor(qc[qid].text, ii, backend=backend,
+                cache=False)
+            qp.preprocessing = lambda: list(terms)
+            start = perf_counter()
+            results[backend] = qp.vectorQuery(k)
+            times[backend] += perf_counter() - start
+
+        # Every doc's score from the Python backend, to check ties against
+        qp = QueryProcessor(qc[qid].text, ii, cache=False)
+        qp.preprocessing = lambda: list(terms)
+        scores = dict(qp.vectorQuery(ii.nDocs, prune=False))
+        if not same_ranking(results['python'], results['scipy'], scores):
+            differ.append(qid)
+
+    n = len(qc)
+    print("%d queries, top %d" % (n, k))
+    for backend in times:
+        print("%-8s %8.3f ms per query" % (backend, times[backend] / n * 1000))
+    print("Rankings match:", not differ, differ[:10] if differ else "")
+
+
+def compare_batch(path, k=10, repeat=3):
+    ''' all the Cranfield queries, one QueryProcessor at a time against
+        QueryProcessor.vectorQueries, both from the raw text '''
+    from time import perf_counter
+    from segments import open_index
+    from cranqry import loadCranQry
+    from query import QueryProcessor
+    from resources import data_path
+
+    ii = open_index(path)
+    qc = loadCranQry(data_path("query.text"))
+    texts = [qc[qid].text for qid in qc]
+
+    # Build the matrix and warm the spelling corrector first
+    loops = {}
+    for backend in ('python', 'scipy'):
+        loops[backend] = lambda backend=backend: [QueryProcessor(text, ii,
+            backend=backend, cache=False).vectorQuery(k) for text in texts]
+    loops['batch'] = lambda: QueryProcessor.vectorQueries(texts, ii, k,
+        cache=False)
+    results = {name: run() for name, run in loops.items()}
+
+    print("%d queries, top %d" % (len(texts), k))
+    for name, run in loops.items():
+        best = None
+        for _ in range(repeat):
+            start = perf_counter()
+            run()
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("%-8s %8.1f ms for all" % (name, best * 1000))
+
+    differ = []
+    for i, text in enumerate(texts):
+        scores = dict(QueryProcessor(text, ii, cache=False).vectorQuery(
+            ii.nDocs))
+        if not same_ranking(results['python'][i], results['batch'][i],
+                scores):
+            differ.append(list(qc)[i])
+    print("Batch rankings match:", not differ, differ[:10] if differ else "")
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) not in (2, 3):
+        print("Syntax: python matrix.py <index-location> [k]")
+    else:
+        compare(argv[1], *[int(a) for a in argv[2:]])
+        print()
+        compare_batch(argv[1], *[int(a) for a in argv[2:]])
@@ -1,6 +1,22 @@
 
 '''
-by Mathieu Blondel
+
+Ranking metrics
+
+    dcg_score and ndcg_score (by Mathieu Blondel) score one query.
+
+    The batch functions score many queries in a few NumPy operations.
+    Results are a 2-D int array with a row per query, holding the docIDs
+    it ranked, best first, padded with -1 when a query has fewer than the
+    others (see rankings_matrix). Relevance is a 2-D array of gains with
+    a row per query and a column per docID (see qrels_matrix). Ideal DCG
+    comes from each query's full row of gains, not from the docs it
+    happened to rank. load_qrels reads Cranfield's qrels, where every doc
+    listed is relevant, and graded ones, where only gains above 0 are.
+
+usage (metrics of a run, from a file of "query doc" pairs like qrels.text):
+    python metrics.py qrels.text run.text [k]
+
 '''
 
 import numpy as np
@@ -56,3 +72,190 @@ def ndcg_score(y_true, y_score, k=10, gains="exponential"):
     actual = dcg_score(y_true, y_score, k, gains)
     return actual / best if best != 0 else 0
 
+# Batch metrics: every query at once
+
+# docID in a rankings matrix where a query ranked nothing
+PAD = -1
+
+
+def load_qrels(filename, binary=None):
+    """Relevance judgements of a qrels file
+    Parameters
+    ----------
+    filename : str
+        Lines of "query_id doc_id [gain ...]". A line without a gain
+        lists a relevant doc, gain 1.
+    binary : bool
+        Whether every doc listed is relevant, gain 1, whatever its gain
+        (Cranfield's qrels list only relevant docs, all with gain 0).
+        If False, only docs with a gain above 0 are relevant, as in TREC
+        qrels. By default, binary if no line has a gain above 0.
+    Returns
+    -------
+    qrels : dict of {query_id: {doc_id: gain}}, of relevant docs only
+    """
+    judgements = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            gain = float(fields[2]) if len(fields) > 2 else 1
+            judgements.append((int(fields[0]), int(fields[1]), gain))
+    if binary is None:
+        binary = not any(gain > 0 for _, _, gain in judgements)
+
+    qrels = {}
+    for query, doc, gain in judgements:
+        if binary:
+            gain = 1
+        if gain > 0:
+            qrels.setdefault(query, {})[doc] = gain
+    return qrels
+
+
+def qrels_matrix(judgements, n_docs=None):
+    """Gains of every doc for every query
+    Parameters
+    ----------
+    judgements : list of dict {doc_id: gain}, one per query, in order
+    n_docs : int
+        Number of columns; at least one more than the largest docID.
+    Returns
+    -------
+    gains : array, shape = [n_queries, n_docs]
+    """
+    largest = max((max(j) for j in judgements if j), default=0)
+    n_docs = max(n_docs or 0, largest + 1)
+    gains = np.zeros((len(judgements), n_docs))
+    rows = [i for i, j in enumerate(judgements) for _ in j]
+    cols = [doc for j in judgements for doc in j]
+    gains[rows, cols] = [g for j in judgements for g in j.values()]
+    return gains
+
+
+def rankings_matrix(results, k=None):
+    """DocIDs each query ranked, as one array
+    Parameters
+    ----------
+    results : list of lists of docIDs, or of (docID, score) pairs
+    k : int
+        Columns to keep; defaults to the longest list.
+    Returns
+    -------
+    rankings : int array, shape = [n_queries, k], padded with PAD
+    """
+    docs = [[r[0] if isinstance(r, (tuple, list)) else r for r in result]
+        for result in results]
+    if k is None:
+        k = max((len(d) for d in docs), default=0)
+    rankings = np.full((len(docs), k), PAD, dtype=np.int64)
+    for i, d in enumerate(docs):
+        d = d[:k]
+        rankings[i, :len(d)] = d
+    return rankings
+
+
+def relevance(rankings, gains):
+    """Gain of the doc at each rank of each query, 0 for padding"""
+    rankings = np.asarray(rankings)
+    found = (rankings >= 0) & (rankings < gains.shape[1])
+    rows = np.arange(len(rankings))[:, None]
+    return np.where(found, gains[rows, np.where(found, rankings, 0)], 0)
+
+
+def _discounted(gains, k, kind):
+    if kind == "exponential":
+        gains = 2 ** gains - 1
+    elif kind != "linear":
+        raise ValueError("Invalid gains option.")
+    # highest rank is 1 so +2 instead of +1
+    discounts = np.log2(np.arange(gains.shape[1]) + 2)
+    return (gains[:, :k] / discounts[:k]).sum(axis=1)
+
+
+def ndcg_at_k(rankings, gains, k=10, kind="exponential"):
+    """NDCG@k of every query
+    Parameters
+    ----------
+    rankings : int array, shape = [n_queries, n_ranked]
+    gains : array, shape = [n_queries, n_docs]
+    k : int
+        Rank.
+    kind : str
+        Whether gains should be "exponential" (default) or "linear".
+    Returns
+    -------
+    NDCG @k : array, shape = [n_queries]; 0 for a query with no relevant
+        docs
+    """
+    actual = _discounted(relevance(rankings, gains), k, kind)
+    # The ideal ranking puts each query's k best gains first
+    k_ideal = min(k, gains.shape[1])
+    best = -np.sort(np.partition(-gains, k_ideal - 1, axis=1)[:, :k_ideal],
+        axis=1)
+    ideal = _discounted(best, k, kind)
+    return np.divide(actual, ideal, out=np.zeros_like(actual),
+        where=ideal > 0)
+
+
+def precision_at_k(rankings, gains, k=10):
+    """Fraction of the top k of every query that is relevant"""
+    hits = relevance(rankings, gains)[:, :k] > 0
+    return hits.sum(axis=1) / k
+
+
+def recall_at_k(rankings, gains, k=10):
+    """Fraction of every query's relevant docs in its top k; 0 for a
+    query with no relevant docs"""
+    hits = (relevance(rankings, gains)[:, :k] > 0).sum(axis=1)
+    n_relevant = (gains > 0).sum(axis=1)
+    return np.divide(hits, n_relevant, out=np.zeros(len(hits)),
+        where=n_relevant > 0)
+
+
+def average_precision(rankings, gains):
+    """Average precision of every query, over the ranks it has
+
+    The precision at each relevant doc ranked, summed and divided by all
+    of the query's relevant docs, so relevant docs never ranked count as
+    0. The mean over queries is MAP."""
+    hits = relevance(rankings, gains) > 0
+    precision = np.cumsum(hits, axis=1) / np.arange(1, hits.shape[1] + 1)
+    n_relevant = (gains > 0).sum(axis=1)
+    return np.divide((precision * hits).sum(axis=1), n_relevant,
+        out=np.zeros(len(hits)), where=n_relevant > 0)
+
+
+def evaluate(rankings, gains, k=10, kind="exponential"):
+    """Every metric of every query
+    Returns
+    -------
+    metrics : dict of arrays, shape = [n_queries]: 'ndcg', 'ap' (its mean
+        is MAP), 'precision' and 'recall', the others at rank k
+    """
+    return {'ndcg': ndcg_at_k(rankings, gains, k, kind),
+        'ap': average_precision(rankings, gains),
+        'precision': precision_at_k(rankings, gains, k),
+        'recall': recall_at_k(rankings, gains, k)}
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) not in (3, 4):
+        print("Syntax: python metrics.py <qrels> <run> [k]")
+    else:
+        k = int(argv[3]) if len(argv) == 4 else 10
+        qrels = load_qrels(argv[1])
+        run = {}
+        with open(argv[2]) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2:
+                    run.setdefault(int(fields[0]), []).append(int(fields[1]))
+        queries = sorted(qrels)
+        gains = qrels_matrix([qrels[q] for q in queries])
+        scores = evaluate(rankings_matrix([run.get(q, []) for q in queries],
+            k), gains, k)
+        for name in ('ndcg', 'ap', 'precision', 'recall'):
+            print("%-10s %.4f" % (name, scores[name].mean()))
@@ -5,16 +5,18 @@ Peter Norvig's python implementation of Spelling Corrector
 
 
 
-import re
-from collections import Counter
+import resources
+from resources import words
 
-def words(text): return re.findall(r'\w+', text.lower())
+# WORDS, the word counts of big.txt, is loaded on first use
+def __getattr__(name):
+    if name == 'WORDS':
+        return resources.word_counts()
+    raise AttributeError(name)
 
-WORDS = Counter(words(open('big.txt').read()))
-
-def P(word, N=sum(WORDS.values())):
+def P(word, N=None):
     "Probability of `word`."
-    return WORDS[word] / N
+    return resources.word_counts()[word] / (N or resources.word_total())
 
 def correction(word):
     "Most probable spelling correction for word."
@@ -26,6 +28,7 @@ def candidates(word):
 
 def known(words):
     "The subset of `words` that appear in the dictionary of WORDS."
+    WORDS = resources.word_counts()
     return set(w for w in words if w in WORDS)
 
 def edits1(word):
@@ -0,0 +1,256 @@
+'''
+
+Phrase and proximity matching over the positional postings
+
+    Every posting keeps the positions of its term in the doc, counted in
+    tokens with stopwords included, so
+
+        "boundary layer"    boundary at some p and layer at p + 1
+        "effect of heat"    effect at p and heat at p + 2 (the stopword
+                            still takes up a position)
+        a NEAR/k b          a and b at most k positions apart, in
+                            either order
+
+    Operands of NEAR can be words, phrases or other NEARs; a match is a
+    span of positions (first, last), and two spans are k apart when the
+    gap between them is at most k.
+
+    match() works in two steps. Candidate docs are the docs that have
+    every word of the expression, found by intersecting the docID lists
+    smallest first. Only then are positions read, for those docs alone:
+    a phrase starts from the rarest word's positions in the doc and keeps
+    the starts every other word lines up with, each step a merge of two
+    sorted lists that gallops when one is much longer (see setops.py).
+    NEAR walks the two span lists in order, with a galloping search for
+    the first span of one list that can be close to the current span of
+    the other.
+
+usage (latency of phrases taken from the Cranfield queries):
+    python positional.py index_dir [max-words]
+
+'''
+
+from bisect import bisect_left
+from setops import intersect, _gallop, GALLOP_RATIO
+from postings import CompactPostings
+
+
+class Phrase:
+    ''' words at fixed offsets from each other; terms is a list of
+        (offset, term), in increasing offset '''
+
+    def __init__(self, terms):
+        self.terms = terms
+
+
+class Near:
+    ''' two operands at most k positions apart '''
+
+    def __init__(self, left, right, k):
+        self.left = left
+        self.right = right
+        self.k = k
+
+
+def words(node):
+    ''' every term a phrase or NEAR expression needs '''
+    if isinstance(node, Phrase):
+        return [term for _, term in node.terms]
+    if isinstance(node, Near):
+        return words(node.left) + words(node.right)
+    return [node.term]
+
+
+def _postings(item):
+    postings = item.posting
+    if isinstance(postings, dict):
+        postings = CompactPostings.from_dict(postings)
+    return postings
+
+
+def _align(starts, positions, offset):
+    ''' the starts s with s + offset in positions, both sorted '''
+    out = []
+    n, m = len(starts), len(positions)
+    if m > GALLOP_RATIO * n:
+        j = 0
+        for s in starts:
+            j = _gallop(positions, s + offset, j)
+            if j == m: break
+            if positions[j] == s + offset:
+                out.append(s)
+    elif n > GALLOP_RATIO * m:
+        i = 0
+        for p in positions:
+            i = _gallop(starts, p - offset, i)
+            if i == n: break
+            if starts[i] == p - offset:
+                out.append(starts[i])
+    else:
+        j = 0
+        for s in starts:
+            target = s + offset
+            while j < m and positions[j] < target:
+                j += 1
+            if j == m: break
+            if positions[j] == target:
+                out.append(s)
+    return out
+
+
+def _phrase_spans(node, positions):
+    # Start from the word with the fewest positions in the doc
+    terms = node.terms
+    r = 0
+    for j in range(1, len(terms)):
+        if len(positions[terms[j][1]]) < len(positions[terms[r][1]]):
+            r = j
+    offset, term = terms[r]
+    starts = [p - offset for p in positions[term]]
+    for j, (offset, term) in enumerate(terms):
+        if not starts:
+            return []
+        if j != r:
+            starts = _align(starts, positions[term], offset)
+    last = terms[-1][0]
+    return [(s, s + last) for s in starts]
+
+
+def _near_spans(node, positions):
+    a = spans(node.left, positions)
+    b = spans(node.right, positions)
+    if not a or not b:
+        return []
+    k = node.k
+    # A span of b can only be close to a span of a if it starts no
+    #   earlier than this many positions before it
+    reach = k + max(last - first for first, last in b)
+    b_starts = [first for first, _ in b]
+    out = []
+    j = 0
+    for first, last in a:
+        j = _gallop(b_starts, first - reach, j)
+        i = j
+        while i < len(b) and b[i][0] <= last + k:
+            b_first, b_last = b[i]
+            if max(first, b_first) - min(last, b_last) <= k:
+                out.append((min(first, b_first), max(last, b_last)))
+            i += 1
+    return sorted(set(out))
+
+
+def spans(node, positions):
+    ''' sorted (first, last) positions of every match of node in a doc,
+        given the positions of each of its words in that doc '''
+    if isinstance(node, Phrase):
+        return _phrase_spans(node, positions)
+    if isinstance(node, Near):
+        return _near_spans(node, positions)
+    return [(p, p) for p in positions[node.term]]
+
+
+def match(node, index):
+    ''' sorted docIDs where a phrase or NEAR expression matches '''
+    postings = {}
+    for term in words(node):
+        if term not in postings:
+            item = index.find(term)
+            if item is None:
+                return []
+            postings[term] = _postings(item)
+
+    # Narrow down by docID before reading any positions
+    lists = sorted(postings.values(), key=len)
+    candidates = lists[0].docids
+    for other in lists[1:]:
+        if not candidates:
+            return []
+        candidates = intersect(candidates, other.docids)
+
+    out = []
+    lists = [(term, p.docids, p.offsets, p.positions)
+        for term, p in postings.items()]
+    cursor = [0] * len(lists)
+    for doc in candidates:
+        positions = {}
+        for n, (term, docids, offsets, term_positions) in enumerate(lists):
+            i = bisect_left(docids, doc, cursor[n])
+            cursor[n] = i
+            positions[term] = term_positions[offsets[i] : offsets[i + 1]]
+        if spans(node, positions):
+            out.append(doc)
+    return out
+
+
+def _scan(node, index):
+    ''' match() the plain way: every position of every candidate doc
+        checked against sets, for the benchmark '''
+    items = {term: index.find(term) for term in words(node)}
+    if None in items.values():
+        return []
+    docs = None
+    for item in items.values():
+        item_docs = set(item.posting)
+        docs = item_docs if docs is None else docs & item_docs
+    out = []
+    for doc in sorted(docs):
+        positions = {term: set(item.posting[doc].positions)
+            for term, item in items.items()}
+        first_offset, first = node.terms[0]
+        if any(all(p - first_offset + offset in positions[term]
+                for offset, term in node.terms)
+               for p in positions[first]):
+            out.append(doc)
+    return out
+
+
+def benchmark(path, max_words=4, repeat=5):
+    ''' time every phrase of 2 to max_words consecutive words in the
+        Cranfield queries, against a set-based scan '''
+    from time import perf_counter
+    from segments import open_index
+    from cranqry import loadCranQry
+    from resources import data_path
+
+    ii = open_index(path)
+    qc = loadCranQry(data_path("query.text"))
+    analyzer = ii.analyzer
+
+    # Phrases of indexed words that do not start or end with a stopword
+    phrases = {}
+    for qid in qc:
+        terms = list(analyzer.terms(qc[qid].text))
+        for n in range(2, max_words + 1):
+            for i in range(len(terms) - n + 1):
+                window = terms[i : i + n]
+                if window[0] and window[-1] and \
+                   all(t in ii.items for t in window if t):
+                    phrases.setdefault(n, set()).add(tuple(window))
+
+    print("%-8s %8s %10s %14s %14s" % ("words", "phrases", "matches",
+        "scan (ms)", "match (ms)"))
+    for n in sorted(phrases):
+        nodes = [Phrase([(i, t) for i, t in enumerate(window) if t])
+            for window in sorted(phrases[n])]
+        times = []
+        results = []
+        for run in (_scan, match):
+            best = None
+            for _ in range(repeat):
+                start = perf_counter()
+                found = [run(node, ii) for node in nodes]
+                elapsed = perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best / len(nodes) * 1000)
+            results.append(found)
+        print("%-8d %8d %10d %14.3f %14.3f%s" % (n, len(nodes),
+            sum(map(len, results[1])), times[0], times[1],
+            "" if results[0] == results[1] else "  RESULTS DIFFER"))
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) not in (2, 3):
+        print("Syntax: python positional.py <index-location> [max-words]")
+    else:
+        benchmark(argv[1], *[int(a) for a in argv[2:]])
@@ -0,0 +1,149 @@
+'''
+
+Compact, array-backed posting lists for a finished index
+
+    While indexing, an IndexItem keeps a dict of docID -> Posting, which
+    is easy to add to but costs a Python object per posting and per
+    position. Once the index is sorted each term's postings are packed
+    into four flat arrays instead:
+
+        docids     sorted docIDs
+        tfs        term frequency of each docID
+        positions  every position of every posting, in docID order
+        offsets    where each docID's positions start (df + 1 entries)
+
+    CompactPostings wraps the arrays in a read-only mapping, so code
+    written against the dict (posting[doc].term_freq(), doc in posting,
+    iterating docIDs) keeps working.
+
+usage (memory report):
+    python postings.py cran.all
+
+'''
+
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+
+
+class CompactPosting:
+    ''' one doc's slice of a CompactPostings, shaped like a Posting '''
+
+    def __init__(self, docID, positions):
+        self.docID = docID
+        self.positions = positions
+
+    def term_freq(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return str(self.positions)
+
+
+class CompactPostings(Mapping):
+    ''' read-only docID -> posting mapping backed by flat arrays '''
+
+    def __init__(self, docids, tfs, positions, offsets=None):
+        self.docids = docids
+        self.tfs = tfs
+        self.positions = positions
+
+        # Offsets follow from the term frequencies when not given
+        if offsets is None:
+            offsets = array('I', [0])
+            for tf in tfs:
+                offsets.append(offsets[-1] + tf)
+        self.offsets = offsets
+
+    @classmethod
+    def from_dict(cls, posting):
+        ''' pack a dict of docID -> Posting into arrays '''
+        docids = array('I', sorted(posting))
+        tfs = array('I')
+        positions = array('I')
+        for doc in docids:
+            doc_positions = sorted(posting[doc].positions)
+            tfs.append(len(doc_positions))
+            positions.extend(doc_positions)
+        return cls(docids, tfs, positions)
+
+    def extend(self, other):
+        ''' append another list's postings, all with larger docIDs '''
+        base = self.offsets[-1]
+        self.docids.extend(other.docids)
+        self.tfs.extend(other.tfs)
+        self.positions.extend(other.positions)
+        self.offsets.extend(base + off for off in other.offsets[1:])
+
+    def _find(self, doc):
+        ''' index of doc in docids, or -1 '''
+        i = bisect_left(self.docids, doc)
+        if i < len(self.docids) and self.docids[i] == doc:
+            return i
+        return -1
+
+    def get_positions(self, i):
+        ''' positions of the i-th posting, as a list '''
+        return self.positions[self.offsets[i] : self.offsets[i + 1]].tolist()
+
+    def __getitem__(self, doc):
+        i = self._find(doc) if isinstance(doc, int) else -1
+        if i < 0:
+            raise KeyError(doc)
+        return CompactPosting(doc, self.get_positions(i))
+
+    def __contains__(self, doc):
+        return isinstance(doc, int) and self._find(doc) >= 0
+
+    def __len__(self):
+        return len(self.docids)
+
+    def __iter__(self):
+        return iter(self.docids)
+
+    def items(self):
+        ''' (docID, posting) pairs in docID order, without searching '''
+        return ((doc, CompactPosting(doc, self.get_positions(i)))
+            for i, doc in enumerate(self.docids))
+
+    def iter_postings(self):
+        ''' (docID, tf) pairs in docID order '''
+        return zip(self.docids, self.tfs)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def memory_report(filename):
+    ''' print traced memory of an index before and after compaction '''
+    import gc
+    import tracemalloc
+    from cran import CranFile
+    from index import InvertedIndex
+
+    docs = CranFile(filename).docs
+
+    tracemalloc.start()
+    ii = InvertedIndex()
+    for doc in docs:
+        ii.indexDoc(doc)
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+
+    # sort() packs every term's postings into arrays
+    ii.sort()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("Index memory with Posting objects:", before, "bytes")
+    print("Index memory with compact arrays: ", after, "bytes")
+    print("Saved: %.1f%%" % (100 * (before - after) / before))
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) != 2:
+        print("Syntax: python postings.py <cran.all path>")
+    else:
+        memory_report(argv[1])
@@ -4,24 +4,42 @@ query processing
 
 '''
 
-from norvig_spell import correction
-from index import InvertedIndex, IndexItem, Posting
+import spelling
+from index import InvertedIndex, IndexItem, Posting, next_version
+from segments import open_index
 from cran import CranFile
+from doc import Collection, has_store
 from cranqry import loadCranQry
 from math import log10, sqrt
 from collections import Counter
 from sys import argv
-import util
+import os
+import argparse
+import boolparse
+import resultcache
+import instrument
+from resources import data_path
+import topk
+
+# Ways vectorQuery can score: Python loops, or a scipy.sparse matrix
+#   product (see matrix.py)
+BACKENDS = ('python', 'scipy')
 
 class QueryProcessor:
 
-    def __init__(self, query, index, collection):
-        ''' index is the inverted index; collection is the document collection'''
+    def __init__(self, query, index, collection=None, backend='python',
+                 cache=True):
+        ''' index is the inverted index; collection is the document collection (a CranFile or doc.Collection), only needed for indexes saved without doc lengths; backend is one of BACKENDS, for vectorQuery; with cache, results are kept in the index's ResultCache (see resultcache.py)'''
+        if backend not in BACKENDS:
+            raise ValueError("Unknown scoring backend " + repr(backend))
         self.raw_query = query
         self.index = index
         self.docs = collection
+        self.backend = backend
+        self.cache = cache
+        self._analyzed = {} # text -> terms, so each mode analyzes once
 
-    def preprocessing(self):
+    def preprocessing(self, text=None):
         ''' apply the same preprocessing steps used by indexing,
             also use the provided spelling corrector. Note that
             spelling corrector should be applied before stopword
@@ -29,26 +47,50 @@ class QueryProcessor:
 
         #ToDo: return a list of terms
         
-        # Tokenize and lowercase doc into list form
-        token_list = util.tokenize_doc(self.raw_query)
-            
-        # Helper function to replace stopwords with empty string
-        def remove_stop_word(tok):
-            return "" if util.isStopWord(tok) else tok
-            
-        # Correct spelling of each word
-        tokens_corrected_spell = list(map(lambda tok: correction(tok),
-            token_list))
-            
-        # Remove the stopwords from both positional list and token list
-        token_list_no_stopword = list(map(remove_stop_word, 
-            tokens_corrected_spell))
+        # booleanQuery and vectorQuery on one processor share the terms
+        text = self.raw_query if text is None else text
+        key = ' '.join(text.split())
+        if key in self._analyzed:
+            instrument.count('query.preprocess_reused')
+            return list(self._analyzed[key])
         
-        # Stem the words
-        stemmed_token_list = list(map(lambda tok: util.stemming(tok),token_list_no_stopword))
+        with instrument.stage('query.preprocess'):
+            # Correct spelling of each word, before its stopword check and
+            #   stemming; words the index knows are left alone (see
+            #   spelling.py)
+            correction = instrument.timed('query.preprocess.spelling',
+                spelling.for_index(self.index).correction)
+            
+            # Tokenize, lowercase, drop stopwords (now "") and stem, as the
+            #   index did; see util.Analyzer
+            stemmed_token_list = list(self.index.analyzer.terms(text,
+                correction))
         
-        return stemmed_token_list
+        self._analyzed[key] = stemmed_token_list
+        return list(stemmed_token_list)
+
+    def _cached(self, key, run):
+        ''' run(), or its result from the last time a query came out of
+            preprocessing as key, while the index is unchanged '''
+        if not self.cache:
+            return run()
+        cache = resultcache.for_index(self.index)
+        version = getattr(self.index, 'version', None)
+        result = cache.get(version, key)
+        if result is None:
+            instrument.count('cache.misses')
+            result = run()
+            cache.put(version, key, result)
+        else:
+            instrument.count('cache.hits')
+        return result
+
 
+    def parse_boolean(self):
+        ''' expression tree of the query, each word preprocessed like
+            the index (see boolparse.py) '''
+        with instrument.stage('boolean.parse'):
+            return boolparse.parse(self.raw_query, self.preprocessing)
 
     def booleanQuery(self):
         ''' boolean query processing; note that a query like "A B C" is transformed to "A AND B AND C" for retrieving posting lists and merge them'''
@@ -56,121 +98,39 @@ class QueryProcessor:
         
         # Ref: https://nlp.stanford.edu/IR-book/html/htmledition/processing-boolean-queries-1.html
         
-        # Parse position of OR and NOT
-        #   We must do this before stopwords removed
-        or_list = list(map(lambda t: t.lower() == "or", self.raw_query.split()))
-        or_positions = []
-        for idx, bool in enumerate(or_list):
-            if bool: or_positions.append(idx)
-            
-        not_list = list(map(lambda t: t.lower() == "not", self.raw_query.split()))
-        not_positions = []
-        for idx, bool in enumerate(not_list):
-            if bool: not_positions.append(idx)
-        
-        # Parse out parenthesis positions
-        open_paren_list = list(map(lambda t: '(' in t, self.raw_query.split()))
-        close_paren_list = list(map(lambda t: ')' in t, self.raw_query.split()))
-        if len(open_paren_list) is not len(close_paren_list):
-            print("Error: Parenthesis mismatch.")
-            return
-        open_paren_positions = []
-        close_paren_positions = []
-        for idx, bool in enumerate(open_paren_list):
-            if bool: open_paren_positions.append(idx)
-        for idx, bool in enumerate(close_paren_list):
-            if bool: close_paren_positions.append(idx)
-        
-        # Get preprocessed query
-        clean_query = self.preprocessing()
-            
-        # Handle precedence of parens
-        for idx, pos in enumerate(open_paren_positions):
-            # Get the actual subquery within parens
-            subquery = clean_query[open_paren_positions[idx] : close_paren_positions[idx]+1]
-            
-            # Run bool query on subquery
-            subquery_result = self.bool_query_helper(subquery, not_positions, or_positions)
-            
-            # Replace subquery with completed postings
-            clean_query[open_paren_positions[idx]] = subquery_result
-            
-            # Replace rest of subquery with empty strings (will be skipped)
-            for i, w in enumerate(clean_query[open_paren_positions[idx]+1 : close_paren_positions[idx]+1]):
-                clean_query[i+open_paren_positions[idx]+1] = ''
-                
-        # Process the remainder of the query
-        answer = self.bool_query_helper(clean_query, not_positions, or_positions)
-            
-        return answer
-        
-        
-    def bool_query_helper(self, query, not_positions, or_positions):
-        # Mark whether this is the first word in the query
-        first_word = True
-        
-        # Get posting for first term to start the list
-        master_postings = []
-        
-        # Get postings for rest of query terms
-        for idx, word in enumerate(query):
-            # Skip any empty stopword positions
-            if word == '': continue
-            
-            # Merge in any existing postings
-            if type(word) is type([]):
-                # If a not query
-                if idx-1 in not_positions:
-                    word = [n for n in list(range(1, self.index.nDocs+1))
-                        if n not in word]
-            
-                # If master_postings empty or this is an or query
-                if first_word or idx-1 in or_positions:
-                    master_postings.extend(word)
-                    master_postings = sorted(list(set(master_postings)))
-                    first_word = False
-                    continue
-                    
-                # Otherwise, just merge the posting lists
-                master_postings = [posting for posting in word
-                    if posting in master_postings]
-                
-                continue
-            
-            # Get the containing index item
-            index_item = self.index.find(word)
-            
-            # Get docs where the word is posted
-            if index_item:
-                current_postings = index_item.sorted_postings[:]
-            else: current_postings = []
-            
-            # If an or query, just append current to master
-            if idx-1 in or_positions:
-                master_postings.extend(current_postings)
-                master_postings = sorted(list(set(master_postings)))
-                continue
-            
-            # Negate if last position is a not
-            if idx-1 in not_positions:
-                current_postings = [n for n in list(range(1, self.index.nDocs+1))
-                    if n not in current_postings]
-                    
-            # Handle case where this is the first thing in the list
-            if first_word:
-                master_postings = current_postings
-                first_word = False
-                continue
-            
-            # Merge the current postings into master postings
-            master_postings = [posting for posting in current_postings
-                if posting in master_postings]
-            
-        return master_postings
+        # Parse into a tree (NOT > AND > OR, nested parens), then let the
+        #   planner order the operands by posting list length
+        with instrument.stage('boolean'):
+            tree = self.parse_boolean()
+            return self._cached(('boolean', boolparse.key(tree)),
+                lambda: boolparse.run(tree, self.index))
+
+    def phraseQuery(self):
+        ''' docIDs with the whole query as a phrase, its words next to each other in order (see positional.py); booleanQuery takes "quoted phrases" and a NEAR/k b as well'''
+        phrase = '"%s"' % self.raw_query.replace('"', ' ')
+        with instrument.stage('boolean'):
+            with instrument.stage('boolean.parse'):
+                tree = boolparse.parse(phrase, self.preprocessing)
+            return self._cached(('boolean', boolparse.key(tree)),
+                lambda: boolparse.run(tree, self.index))
+
+    def explain(self):
+        ''' the plan booleanQuery would use, with estimated costs '''
+        return boolparse.explain(self.parse_boolean(), self.index)
 
 
-    def vectorQuery(self, k):
-        ''' vector query processing, using the cosine similarity. '''
+    def doc_length(self, doc):
+        ''' number of words in a doc's body, which scores are divided by '''
+        # Indexes store the lengths; older ones need the collection
+        if self.index.doc_lengths:
+            return self.index.doc_lengths[doc]
+        if self.docs is None:
+            raise ValueError("The index has no doc lengths; rebuild it or "
+                "give QueryProcessor the collection")
+        return len(self.docs.find(doc).body.split())
+
+    def vectorQuery(self, k, prune=False):
+        ''' vector query processing, using the cosine similarity. With prune, the top k are found with MaxScore (see topk.py), which gives the same results while scoring fewer docs; the scipy backend ignores it'''
         #ToDo: return top k pairs of (docID, similarity), ranked by their cosine similarity with the query in the descending order
         # You can use term frequency or TFIDF to construct the vectors
         
@@ -182,27 +142,37 @@ class QueryProcessor:
             # Hold on to all doc ids that contain (most?) words in query
             # Compute cosine sim and rank results
             
-        # Get preprocessed query
-        clean_query = self.preprocessing()
+        with instrument.stage('vector'):
+            # Get preprocessed query
+            clean_query = self.preprocessing()
+            
+            # Nothing is scored when the same terms were asked for before
+            key = ('vector', self.backend, tuple(t for t in clean_query if t),
+                k)
+            self.docs_scored = 0
+            return self._cached(key, lambda: self._vector_query(clean_query,
+                k, prune))
+
+    def _vector_query(self, clean_query, k, prune):
+        ''' vectorQuery's top k, scored '''
+        # Score every doc with one sparse matrix product
+        if self.backend == 'scipy':
+            # numpy and scipy are only imported when this backend is used
+            from matrix import TermDocMatrix
+            with instrument.stage('vector.score'):
+                result, self.docs_scored = TermDocMatrix.for_index(
+                    self.index, self.doc_length).top_k(clean_query, k)
+            instrument.count('vector.candidates', self.docs_scored)
+            return result
         
-        # Get IndexItems for each term in the query
-        #   Hold on to these in a list so we make sure each term in doc
+        # Skip docs that cannot make the top k, if the index has the bounds
+        if prune:
+            with instrument.stage('vector.score'):
+                result = self._vector_topk(clean_query, k)
+            if result is not None:
+                instrument.count('vector.candidates', self.docs_scored)
+                return result
         
-        # Hold on to the number of times each word appears in a doc
-        doc_dict = {}
-        for word in clean_query:
-            # Skip any empty stopword positions
-            if word == '': continue
-            
-            # Add in the docs
-            word_lookup = self.index.find(word)
-            if word_lookup is None: continue
-            
-            for doc in word_lookup.posting:
-                if doc not in doc_dict:
-                    doc_dict[doc] = 1
-                else: doc_dict[doc] += 1
-            
         # Compute the vector representation for each doc, using tf-idf for
         #   EVERY possible word
         # --> This is pre-computed in the inverted index
@@ -212,46 +182,110 @@ class QueryProcessor:
         # Ref: https://nlp.stanford.edu/IR-book/html/htmledition/computing-vector-scores-1.html
         scores = {}
         word_count_query = Counter(clean_query)
-        for word in clean_query:
-            # Skip any empty stopword positions
-            if word == '': continue
-        
-            # Get word tf-idf
-            tf = word_count_query[word]
-            idf = self.index.idf(word)
-            tfidf = log10(1+tf) * idf
-            
-            # Count up the scores for doc weights
-            word_lookup = self.index.find(word)
-            if word_lookup is None: continue
+        with instrument.stage('vector.score'):
+            for word in clean_query:
+                # Skip any empty stopword positions
+                if word == '': continue
             
-            for doc in doc_dict:
-                # Get the posting for the word
-                cur_posting = word_lookup.posting
+                # Get word tf-idf
+                tf = word_count_query[word]
+                idf = self.index.idf(word)
+                tfidf = log10(1+tf) * idf
                 
-                # Calculate the score
-                if doc not in cur_posting:
-                    score = 0
-                else:
-                    score = tfidf * cur_posting[doc].term_freq()
+                # Count up the scores for doc weights
+                word_lookup = self.index.find(word)
+                if word_lookup is None: continue
                 
-                # Add up the scores
-                if doc in scores:
-                    scores[doc] += score
-                else:
-                    scores[doc] = score
+                # Docs without the word score 0 for it; only the word's own
+                #   postings need to be streamed
+                for doc, tf in word_lookup.iter_postings():
+                    score = tfidf * tf
+                    
+                    # Add up the scores
+                    if doc in scores:
+                        scores[doc] += score
+                    else:
+                        scores[doc] = score
+                instrument.count('postings.scanned',
+                    word_lookup.doc_freq())
                     
-        # Normalize scores by doc length
-        for doc in scores:
-            scores[doc] /= len(self.docs.docs[doc-1].body.split())
+            # Normalize scores by doc length
+            for doc in scores:
+                scores[doc] /= self.doc_length(doc)
+        self.docs_scored = len(scores)
+        instrument.count('vector.candidates', self.docs_scored)
             
-        # Sort the scores by score
-        sorted_scores = sorted(scores.items(), reverse=True, key=lambda x: x[1])
+        # Sort the scores by score, breaking ties by docID
+        with instrument.stage('vector.sort'):
+            sorted_scores = sorted(scores.items(),
+                key=lambda x: (-x[1], x[0]))
 
         # Return top k scores
         return sorted_scores[:k]
 
 
+    @classmethod
+    def vectorQueries(cls, queries, index, k, collection=None, cache=True):
+        ''' vectorQuery for a list of queries at once: top k (docID, similarity) pairs of each, in order. The queries are scored with one sparse matrix product (see matrix.py), so results rank like the scipy backend'''
+        from matrix import TermDocMatrix
+        
+        processors = [cls(query, index, collection, backend='scipy',
+            cache=cache) for query in queries]
+        if not processors:
+            return []
+        keys = [('vector', 'scipy', tuple(t for t in qp.preprocessing() if t),
+            k) for qp in processors]
+        
+        # Queries in the result cache are not scored, and queries that
+        #   preprocess the same are scored once
+        results = {}
+        if cache:
+            results_cache = resultcache.for_index(index)
+            version = getattr(index, 'version', None)
+            for key in set(keys):
+                result = results_cache.get(version, key)
+                if result is not None:
+                    results[key] = result
+            instrument.count('cache.hits', len(results))
+        todo = [key for key in dict.fromkeys(keys) if key not in results]
+        if cache:
+            instrument.count('cache.misses', len(todo))
+        if todo:
+            with instrument.stage('vector.batch.score'):
+                matrix = TermDocMatrix.for_index(index,
+                    processors[0].doc_length)
+                scored = matrix.top_k_batch([key[2] for key in todo], k)
+            for key, (result, candidates) in zip(todo, scored):
+                instrument.count('vector.candidates', candidates)
+                results[key] = result
+                if cache:
+                    results_cache.put(version, key, result)
+        return [list(results[key]) for key in keys]
+
+    def _vector_topk(self, clean_query, k):
+        ''' vectorQuery's top k by MaxScore, or None without score bounds '''
+        word_count_query = Counter(clean_query)
+        cursors = {}
+        for word in word_count_query:
+            # Skip any empty stopword positions and unknown words
+            if word == '': continue
+            word_lookup = self.index.find(word)
+            if word_lookup is None: continue
+            
+            bound = self.index.max_score(word)
+            if bound is None:
+                return None
+            tf = word_count_query[word]
+            cursors[word] = topk.cursor(word_lookup,
+                log10(1+tf) * self.index.idf(word), tf, bound)
+        
+        # One cursor per word of the query, so scores add up in query order
+        order = [cursors[word] for word in clean_query if word in cursors]
+        result, self.docs_scored = topk.maxscore(list(cursors.values()),
+            order, k, self.doc_length)
+        return result
+
+
 def test(index_loc, cran_loc, qrels_loc):
     ''' test your code thoroughly. put the testing cases here'''
     
@@ -329,29 +363,29 @@ def test(index_loc, cran_loc, qrels_loc):
     diam_postings = ii.find("diamet").sorted_postings[:]
     slip_not_diam = [t for t in slip_postings if t not in diam_postings]
     print("Bool query successfully handles NOT ('slipstream and not diameter'):", 
-        QueryProcessor("slipstream and not diameter", ii, cf).booleanQuery() \
+        QueryProcessor("slipstream and not diameter", ii, cf, cache=False).booleanQuery() \
           == slip_not_diam)
           
     # Ensure AND/OR order doesn't matter
     print("Bool query can handle query regardless of AND order ('a and b' = 'b and a'):",
-        QueryProcessor("slipstream and diameter", ii, cf).booleanQuery() \
-          == QueryProcessor("diameter and slipstream", ii, cf).booleanQuery())
+        QueryProcessor("slipstream and diameter", ii, cf, cache=False).booleanQuery() \
+          == QueryProcessor("diameter and slipstream", ii, cf, cache=False).booleanQuery())
     print("Bool query can handle query regardless of OR order ('a or b' = 'b or a'):",
-        QueryProcessor("slipstream or diameter", ii, cf).booleanQuery() \
-          == QueryProcessor("diameter or slipstream", ii, cf).booleanQuery())
+        QueryProcessor("slipstream or diameter", ii, cf, cache=False).booleanQuery() \
+          == QueryProcessor("diameter or slipstream", ii, cf, cache=False).booleanQuery())
           
     # Ensure that the presence of parens does not change query results
     print("Bool query can handle query regardless of parens ('slipstream and diameter'):",
-        QueryProcessor("slipstream and diameter", ii, cf).booleanQuery() \
-          == QueryProcessor("(slipstream and diameter)", ii, cf).booleanQuery())
+        QueryProcessor("slipstream and diameter", ii, cf, cache=False).booleanQuery() \
+          == QueryProcessor("(slipstream and diameter)", ii, cf, cache=False).booleanQuery())
           
     # Ensure parentheses do not change order of processing for AND-AND and OR-OR queries
     print("Bool query AND is accociative ('(a and b) and c' = 'a and (b and c)'):",
-        QueryProcessor("(slipstream and diameter) and thrust", ii, cf).booleanQuery() \
-          == QueryProcessor("slipstream and (diameter and thrust)", ii, cf).booleanQuery())
+        QueryProcessor("(slipstream and diameter) and thrust", ii, cf, cache=False).booleanQuery() \
+          == QueryProcessor("slipstream and (diameter and thrust)", ii, cf, cache=False).booleanQuery())
     print("Bool query OR is accociative ('(a or b) or c' = 'a or (b or c)'):",
-        QueryProcessor("(slipstream or diameter) or thrust", ii, cf).booleanQuery() \
-          == QueryProcessor("slipstream or (diameter or thrust)", ii, cf).booleanQuery())
+        QueryProcessor("(slipstream or diameter) or thrust", ii, cf, cache=False).booleanQuery() \
+          == QueryProcessor("slipstream or (diameter or thrust)", ii, cf, cache=False).booleanQuery())
           
     # Ensure parentheses properly group items
     #   Tested by doing the query "manually" by adding/orring the correct terms
@@ -363,7 +397,22 @@ def test(index_loc, cran_loc, qrels_loc):
     print("Bool query parens successfully group conflicting operators:", 
         QueryProcessor("(conduction and cylinder and gas) or (radiation and gas) or hugoniot", ii, cf).booleanQuery() \
           == sorted(list(set(expected_result))))
-          
+
+    # Phrases and NEAR narrow the AND of their words by positions
+    phrase = QueryProcessor('"boundary layer"', ii, cf).booleanQuery()
+    both = QueryProcessor("boundary and layer", ii, cf).booleanQuery()
+    print("Phrase query results all have both words:",
+        0 < len(phrase) < len(both) and set(phrase) <= set(both))
+    boundary, layer = ii.find("boundari").posting, ii.find("layer").posting
+    print("Phrase query results have the words next to each other:",
+        all(any(p + 1 in layer[d].positions for p in boundary[d].positions)
+            for d in phrase))
+    print("Phrase query is NEAR/1 in order:", set(phrase) <=
+        set(QueryProcessor("boundary near/1 layer", ii, cf).booleanQuery()))
+    print("phraseQuery matches a quoted boolean query:",
+        QueryProcessor("boundary layer", ii, cf,
+            cache=False).phraseQuery() == phrase)
+
     ##### VECTOR QUERY TESTS #####
     
     # For this, just ensure that most of the results are in the expected list
@@ -376,7 +425,7 @@ def test(index_loc, cran_loc, qrels_loc):
     #   As long as one-fifth of t-10 are in gt_result, call it a pass
     # Note that queries with larger answer sets were chosen to
     #   ensure there were enough to get to one-fifth of ten
-    qc = loadCranQry("query.text")
+    qc = loadCranQry(data_path("query.text"))
     poss_queries = list(qc)
     
     # Query 001
@@ -413,6 +462,63 @@ def test(index_loc, cran_loc, qrels_loc):
     correct_vector = list(map(lambda x: x in gt_result, [x[0] for x in result]))
     print("Vector query is at least one-fifth correct for query 291:", sum(
         correct_vector) > 2)
+        
+    # The sparse matrix backend must rank like the Python loops; scores
+    #   can only differ in the last bits, so ties may swap
+    from matrix import same_ranking
+    for qid in ["001", "128", "226"]:
+        all_scores = dict(QueryProcessor(qc[qid].text, ii, cf, cache=False).vectorQuery(
+            ii.nDocs, prune=False))
+        print("Sparse matrix backend ranks like the Python backend for query "
+            + qid + ":", same_ranking(
+                QueryProcessor(qc[qid].text, ii, cf, cache=False).vectorQuery(10),
+                QueryProcessor(qc[qid].text, ii, cf,
+                    backend='scipy', cache=False).vectorQuery(10), all_scores))
+        
+    texts = [qc[qid].text for qid in ["001", "128", "226"]]
+    print("Batch vector queries rank like one query at a time:", all(
+        same_ranking(QueryProcessor(text, ii, cf, cache=False).vectorQuery(10),
+            batch, dict(QueryProcessor(text, ii, cf,
+            cache=False).vectorQuery(ii.nDocs)))
+        for text, batch in zip(texts, QueryProcessor.vectorQueries(texts, ii,
+            10, cf, cache=False))))
+        
+    # MaxScore pruning must not change the top k
+    print("MaxScore top-k matches exhaustive scoring:",
+        all(QueryProcessor(qc[qid].text, ii, cache=False).vectorQuery(10, prune=True) == \
+            QueryProcessor(qc[qid].text, ii, cache=False).vectorQuery(10)
+            for qid in ["001", "128", "226"]))
+        
+    # The index holds the doc lengths, so the collection is not needed
+    print("Index doc lengths match the collection:",
+        all(ii.doc_lengths[int(d.docID)] == len(d.body.split())
+            for d in cf.docs))
+    print("Vector query runs without the collection:",
+        QueryProcessor(qc["001"].text, ii, cache=False).vectorQuery(10) == \
+            QueryProcessor(qc["001"].text, ii, cf, cache=False).vectorQuery(10))
+
+    ##### RESULT CACHE TESTS #####
+    print("\nRESULT CACHE TESTS")
+
+    # Queries that preprocess the same share one entry; any change to
+    #   the index empties the cache
+    cache = resultcache.for_index(ii)
+    cache.clear()
+    hits = cache.hits
+    fresh = QueryProcessor("Slipstream and the DIAMETER", ii, cf).booleanQuery()
+    print("Cached boolean results match uncached ones:",
+        QueryProcessor("diameter and slipstream", ii, cf).booleanQuery()
+          == fresh and cache.hits == hits + 1)
+    hits = cache.hits
+    fresh = QueryProcessor(qc["001"].text, ii, cf).vectorQuery(10)
+    print("Cached vector results match uncached ones:",
+        QueryProcessor(qc["001"].text + " ?", ii, cf).vectorQuery(10)
+          == fresh and cache.hits == hits + 1)
+    ii.version = next_version()
+    misses = cache.misses
+    QueryProcessor(qc["001"].text, ii, cf).vectorQuery(10)
+    print("A new index version invalidates the cache:",
+        cache.misses == misses + 1 and len(cache.entries) == 1)
 
 def query():
     ''' the main query processing program, using QueryProcessor'''
@@ -422,58 +528,124 @@ def query():
     # for booleanQuery, the program will print the total number of documents and the list of docuement IDs
     # for vectorQuery, the program will output the top 3 most similar documents
     
-    # Ensure args are valid
-    if len(argv) is not 5:
-        print("Syntax: python query.py <index-file-path> <processing-algorithm> <query.txt path> <query-id>")
-        return
-
-    # Grab arguments
-    index_file_loc = argv[1]
-    processing_algo = argv[2]
-    query_file_path = argv[3]
-    query_id = argv[4]
-    
-    # Grab index file to restore II
-    ii = InvertedIndex()
-    ii.load(index_file_loc)
-    
-    # Get the document collection
-    cf = CranFile("cran.all")
-    
-    # Get the query collection
-    qc = loadCranQry(query_file_path)
-    
-    # Get the query
-    if 0 < int(query_id) < 10:
-        query_id = '00' + str(int(query_id))
-    elif 9 < int(query_id) < 100:
-        query_id = '0' + str(int(query_id))
-    try: 
-        query = qc[query_id].text
-    except KeyError:
-        print("Invalid query id", query_id)
-        return
-    
-    # Initialize a query processor
-    qp = QueryProcessor(query, ii, cf)
-    
-    # Do query
-    if int(processing_algo) is 0:
-        result = qp.booleanQuery()
-        if result:
-            print("Results:", ", ".join(str(x) for x in qp.booleanQuery()))
+    parser = argparse.ArgumentParser(
+        description="Run a query from query.text against a saved index")
+    parser.add_argument('index_file_loc', metavar='index-file-path')
+    parser.add_argument('processing_algo', metavar='processing-algorithm',
+        type=int, help="0 (boolean), 1 (vector) or 2 (phrase)")
+    parser.add_argument('query_file_path', metavar='query.txt-path',
+        nargs='?')
+    parser.add_argument('query_id', metavar='query-id', nargs='?')
+    parser.add_argument('--text',
+        help="run this query instead of one from query.text; boolean "
+            "queries can use \"phrases\" and a NEAR/k b")
+    parser.add_argument('--explain', action='store_true',
+        help="print the boolean query plan and its estimated costs")
+    parser.add_argument('--backend', choices=BACKENDS, default='python',
+        help="how vector queries are scored (default: python)")
+    parser.add_argument('--titles', action='store_true',
+        help="print the title of each result, from the index's document "
+            "store")
+    parser.add_argument('--server', metavar='ADDRESS',
+        help="send the query to a running server.py (host:port or a Unix "
+            "socket path) instead of loading the index")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv[1:])
+    if args.text is None and args.query_id is None:
+        parser.error("give query.txt-path and query-id, or --text")
+
+    # Stage timings, a profile or heap snapshots, if asked for
+    with instrument.session(args):
+        # Grab arguments
+        index_file_loc = args.index_file_loc
+        processing_algo = args.processing_algo
+        query_file_path = args.query_file_path
+        query_id = args.query_id
+        
+        # Get the query collection
+        qc = loadCranQry(query_file_path) if args.text is None else {}
+        
+        # Get the query
+        if args.text is not None:
+            query = args.text
+        else:
+            if 0 < int(query_id) < 10:
+                query_id = '00' + str(int(query_id))
+            elif 9 < int(query_id) < 100:
+                query_id = '0' + str(int(query_id))
+            try: 
+                query = qc[query_id].text
+            except KeyError:
+                print("Invalid query id", query_id)
+                return
+        
+        if processing_algo not in (0, 1, 2):
+            print("Invalid processing algorithm", str(processing_algo) +
+                ". Use 0 (boolean), 1 (vector) or 2 (phrase).")
+            return
+        mode = ('boolean', 'vector', 'phrase')[processing_algo]
+        
+        if args.server:
+            # A running server.py has the index loaded already
+            import server
+            try:
+                answer = server.request(args.server, '/query', q=query,
+                    mode=mode, k=3, backend=args.backend,
+                    titles=int(args.titles), explain=int(args.explain),
+                    index=os.path.abspath(index_file_loc))
+            except (ValueError, OSError) as e:
+                print("Query server error:", e)
+                return
+            plan, result = answer.get('plan'), answer['results']
+            titles = answer.get('titles')
+        else:
+            # Grab index file to restore II (plain or segmented)
+            ii = open_index(index_file_loc)
+            
+            # Doc lengths come from the index; only indexes saved without them
+            #   need the document collection, read from the index's document
+            #   store when it has one
+            if has_store(index_file_loc):
+                cf = Collection.open(index_file_loc)
+            elif ii.doc_lengths and not args.titles:
+                cf = None
+            else:
+                cf = CranFile(data_path("cran.all"))
+            
+            # Initialize a query processor
+            qp = QueryProcessor(query, ii, cf, backend=args.backend)
+            
+            # Do query
+            plan = qp.explain() if args.explain else None
+            if mode == 'vector':
+                result = qp.vectorQuery(k=3)
+            else:
+                result = qp.booleanQuery() if mode == 'boolean' \
+                    else qp.phraseQuery()
+            titles = None
+            if args.titles:
+                docs = [r[0] for r in result] if mode == 'vector' else result
+                titles = [" ".join(cf.find(doc).title.split()) for doc in docs]
+        
+        if plan is not None:
+            print(plan)
+            print()
+        if mode != 'vector':
+            if result:
+                print("Results:", ", ".join(str(x) for x in result))
+            else:
+                print("Results: None")
+            if titles is not None:
+                for doc, title in zip(result, titles):
+                    print("Doc", doc, title)
         else:
-            print("Results: None")
-    elif int(processing_algo) is 1:
-        result = qp.vectorQuery(k=3)
-        print("Results:")
-        for r in result:
-            print("Doc", r[0], "Score", r[1])
-    else:
-        print("Invalid processing algorithm", processing_algo +
-            ". Use 0 (boolean) or 1 (vector).")
+            print("Results:")
+            for i, r in enumerate(result):
+                print("Doc", r[0], "Score", r[1])
+                if titles is not None:
+                    print("   ", titles[i])
 
 
 if __name__ == '__main__':
-    #test("TEST.pkl", "cran.all", "qrels.text")
+    #test("test_index", "cran.all", "qrels.text")
     query()
@@ -0,0 +1,192 @@
+'''
+
+Data files shared by indexing and querying, loaded on first use
+
+    big.txt (word counts for spelling correction), stopwords and the
+    Porter stemmer used to be loaded when util.py and norvig_spell.py were
+    imported, from the current directory. Now nothing is read until a
+    function below is first called, and files are found next to this
+    module (or in $CRAN_DATA), wherever the tools are run from.
+
+    Loading can be sped up with prebuilt artifacts, written by
+    'python resources.py build' next to the data:
+
+        big.txt.counts   every word of big.txt and its count, one
+                         "word<TAB>count" per line
+        stems.txt        "word<TAB>stem" for every word of big.txt,
+                         cran.all and query.text, so most stemming needs
+                         no NLTK at all (and no NLTK import)
+
+    An artifact is only used while it is newer than the files it was
+    built from. Set CRAN_ARTIFACTS=0 to ignore them. Neither big.txt nor
+    the artifacts are versioned; see README.md for setting them up.
+
+usage:
+    python resources.py build
+    python resources.py startup [<index-dir>]
+
+'''
+
+import os
+import re
+from collections import Counter
+
+DATA_DIR = os.environ.get('CRAN_DATA',
+    os.path.dirname(os.path.abspath(__file__)))
+
+_loaded = {}
+
+
+def data_path(name):
+    ''' full path of a data file '''
+    return os.path.join(DATA_DIR, name)
+
+
+def _artifact(name, *sources):
+    ''' path of a prebuilt artifact, if it is there and up to date '''
+    if os.environ.get('CRAN_ARTIFACTS', '1') == '0':
+        return None
+    path = data_path(name)
+    if not os.path.isfile(path):
+        return None
+    built = os.path.getmtime(path)
+    for source in sources:
+        if os.path.isfile(data_path(source)) and \
+           os.path.getmtime(data_path(source)) > built:
+            return None
+    return path
+
+
+def _read_pairs(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+def words(text):
+    ''' the words of a text, as norvig_spell splits them '''
+    return re.findall(r'\w+', text.lower())
+
+
+def word_counts():
+    ''' Counter of the words of big.txt '''
+    if 'words' not in _loaded:
+        path = _artifact('big.txt.counts', 'big.txt')
+        if path:
+            _loaded['words'] = Counter({word: int(n)
+                for word, n in _read_pairs(path)})
+        else:
+            with open(data_path('big.txt')) as f:
+                _loaded['words'] = Counter(words(f.read()))
+    return _loaded['words']
+
+
+def word_total():
+    ''' the number of words in big.txt, counted once '''
+    if 'word_total' not in _loaded:
+        _loaded['word_total'] = sum(word_counts().values())
+    return _loaded['word_total']
+
+
+def stopwords():
+    ''' the text of the stopword list '''
+    if 'stopwords' not in _loaded:
+        with open(data_path('stopwords')) as f:
+            _loaded['stopwords'] = f.read()
+    return _loaded['stopwords']
+
+
+def stemmer():
+    ''' the NLTK Porter stemmer; NLTK is only imported here '''
+    if 'stemmer' not in _loaded:
+        from nltk.stem.porter import PorterStemmer
+        _loaded['stemmer'] = PorterStemmer()
+    return _loaded['stemmer']
+
+
+def stem_table():
+    ''' {word: stem} from the prebuilt artifact, or {} without one '''
+    if 'stems' not in _loaded:
+        path = _artifact('stems.txt', 'big.txt', 'cran.all', 'query.text')
+        _loaded['stems'] = dict(_read_pairs(path)) if path else {}
+    return _loaded['stems']
+
+
+def build():
+    ''' write the prebuilt artifacts next to the data files '''
+    import util
+
+    counts = word_counts()
+    with open(data_path('big.txt.counts'), 'w', encoding='utf-8') as out:
+        for word, n in counts.items():
+            out.write('%s\t%d\n' % (word, n))
+
+    # Words as the index and queries see them: tokenize_doc, not \w+
+    vocab = set(counts)
+    for name in ('cran.all', 'query.text'):
+        with open(data_path(name)) as f:
+            vocab.update(util.tokenize_doc(f.read()))
+    vocab.discard('')
+    stem = stemmer().stem
+    with open(data_path('stems.txt'), 'w', encoding='utf-8') as out:
+        for word in sorted(vocab):
+            out.write('%s\t%s\n' % (word, stem(word)))
+    return len(counts), len(vocab)
+
+
+def startup(index_dir=None, repeat=3):
+    ''' wall time of each command-line tool, run from another directory,
+        with and without the prebuilt artifacts '''
+    import sys
+    import subprocess
+    import tempfile
+    from time import perf_counter
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = [
+        ("index.py --help", ['index.py', '--help']),
+        ("query.py --help", ['query.py', '--help']),
+        ("batch_eval.py (usage)", ['batch_eval.py']),
+    ]
+    if index_dir:
+        index_dir = os.path.abspath(index_dir)
+        query_file = data_path('query.text')
+        commands += [
+            ("query.py boolean", ['query.py', index_dir, '0', query_file,
+                '1']),
+            ("query.py vector", ['query.py', index_dir, '1', query_file,
+                '1']),
+        ]
+
+    print("%-24s %14s %14s" % ("", "artifacts (s)", "without (s)"))
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, args in commands:
+            times = []
+            for use in ('1', '0'):
+                env = dict(os.environ, CRAN_ARTIFACTS=use)
+                best = None
+                for _ in range(repeat):
+                    start = perf_counter()
+                    done = subprocess.run([sys.executable, '-W', 'ignore',
+                        os.path.join(here, args[0])] + args[1:], cwd=cwd,
+                        env=env, stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE)
+                    elapsed = perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                if done.returncode:
+                    print(name, "failed:",
+                        done.stderr.decode().strip().splitlines()[-1])
+                times.append(best)
+            print("%-24s %14.2f %14.2f" % (name, times[0], times[1]))
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) >= 2 and argv[1] == 'build':
+        n_words, n_stems = build()
+        print("Wrote counts of", n_words, "words and stems of", n_stems,
+            "words to", DATA_DIR)
+    elif len(argv) in (2, 3) and argv[1] == 'startup':
+        startup(*argv[2:])
+    else:
+        print("Syntax: python resources.py build")
+        print("        python resources.py startup [<index-dir>]")
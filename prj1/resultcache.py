@@ -0,0 +1,109 @@
+'''
+
+Query result cache
+
+    Queries repeat, and many that differ as text (case, punctuation,
+    stopwords, a misspelling, the order of ANDed words) come out of
+    preprocessing the same. QueryProcessor looks results up by what the
+    query turned into:
+
+        boolean    the parsed tree (boolparse.key), AND and OR operands
+                   in any order
+        vector     the terms, backend and k
+
+    so spelling correction and stemming still run, but posting lists are
+    not read and nothing is scored on a hit.
+
+    Each index has one cache, kept on the index. Every change to an index
+    (indexing a doc, merging, loading, a segment added or deleted) gives
+    it a new version stamp, and the cache empties itself when it sees a
+    stamp it has not seen before. Entries are dropped least recently used
+    first, once there are more than max_entries of them or they hold more
+    than max_items docIDs between them.
+
+'''
+
+from collections import OrderedDict
+
+MAX_ENTRIES = 1024
+
+# docIDs (or (docID, score) pairs) held over all entries
+MAX_ITEMS = 1 << 18
+
+
+class ResultCache:
+    ''' LRU cache of query results for one index '''
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_items=MAX_ITEMS):
+        self.max_entries = max_entries
+        self.max_items = max_items
+        self.entries = OrderedDict() # key -> tuple of results
+        self.items = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check(self, version):
+        ''' drop everything cached for another version of the index '''
+        if version != self.version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.items = 0
+            self.version = version
+
+    def get(self, version, key):
+        ''' a copy of the cached results, or None '''
+        self._check(version)
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return list(result)
+
+    def put(self, version, key, result):
+        self._check(version)
+        result = tuple(result)
+        if len(result) > self.max_items:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.items -= len(old)
+        self.entries[key] = result
+        self.items += len(result)
+        while len(self.entries) > self.max_entries or \
+              self.items > self.max_items:
+            _, dropped = self.entries.popitem(last=False)
+            self.items -= len(dropped)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.items = 0
+
+    def stats(self):
+        ''' the counters, as a dict '''
+        return {'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'entries': len(self.entries), 'items': self.items}
+
+    def __repr__(self):
+        lookups = self.hits + self.misses
+        return "%d hits, %d misses (%.0f%% hit rate), %d evictions, " \
+            "%d invalidations, %d entries" % (self.hits, self.misses,
+            100 * self.hits / lookups if lookups else 0, self.evictions,
+            self.invalidations, len(self.entries))
+
+
+def for_index(index):
+    ''' the ResultCache of an index, made on first use '''
+    cache = getattr(index, '_result_cache', None)
+    if cache is None:
+        cache = ResultCache()
+        index._result_cache = cache
+    return cache
@@ -0,0 +1,516 @@
+'''
+
+Segmented index: add, update and delete documents without a full rebuild
+
+    A segmented index is a directory of ordinary saved indexes (segments)
+    plus a manifest:
+
+        segments         names of the live segments, oldest first
+        seg_000001/      a saved InvertedIndex (see diskindex.py)
+        seg_000001.del   docIDs deleted from that segment, one per line
+
+    and, shared by every segment, as in a plain saved index:
+
+        docs/            the document store (see doc.py), if there is one
+        spelling/        the spelling table (see spelling.py), if any
+        stems            the stem memo (see util.Analyzer)
+
+    Segments are never changed once written. Adding documents indexes them
+    into a new segment (and adds them to the document store); updating a
+    document adds its new version and deletes (tombstones) the old one;
+    deleting only writes a tombstone. merge() folds every segment into one
+    and drops the tombstoned docs.
+
+    SegmentedIndex has the same query-side interface as InvertedIndex
+    (nDocs, items, find, idf, max_score, doc_tfidf, doc_norms), so QueryProcessor can
+    use either. Document frequencies skip tombstoned docs, and doc vectors
+    are weighted with the idf of the whole index when asked for, from the
+    term frequencies each segment stores; nothing is recomputed up front.
+
+    Query cost: each term lookup is a binary search in every segment, and
+    a term's postings are a k-way merge over the segments that hold it, so
+    lookups grow linearly with the number of segments. A term is looked up
+    once per change to the index: its merged item (document frequency and
+    decoded postings included) is kept until documents are added, deleted
+    or merged. Adding documents merges automatically once there are more
+    than max_segments segments.
+
+    Opening a directory that holds a plain saved index (as written by
+    index.py) turns it into a segmented index of one segment, so documents
+    can be added to it in place: its postings files move into the segment,
+    and the shared files stay where they are.
+
+usage:
+    python segments.py <index-dir> add <cran.all path>
+    python segments.py <index-dir> delete <docID> ...
+    python segments.py <index-dir> merge
+    python segments.py <index-dir> info
+
+'''
+
+import os
+import shutil
+import heapq
+from array import array
+from math import log10, sqrt
+from operator import itemgetter
+from collections.abc import Mapping
+import util
+import diskindex
+from util import STEM_FILE
+from doc import has_store, add_to_store
+from index import InvertedIndex, IndexItem, index_docs, next_version
+from postings import CompactPostings
+
+MANIFEST = 'segments'
+
+# Files of a saved index that belong to the whole segmented index
+SHARED = ('docs', 'spelling', STEM_FILE)
+
+
+def is_segmented(path):
+    ''' true if path holds a segmented index '''
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def _write_manifest(path, names):
+    tmp = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp, 'w') as out:
+        for name in names:
+            out.write(name + '\n')
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+def open_index(path):
+    ''' load a saved index, segmented or not '''
+    if is_segmented(path):
+        return SegmentedIndex(path)
+    ii = InvertedIndex()
+    ii.load(path)
+    return ii
+
+
+class Segment:
+    ''' one saved index of a segmented index, plus its tombstones '''
+
+    def __init__(self, path, name):
+        self.name = name
+        self.index = InvertedIndex()
+        self.index.load(os.path.join(path, name))
+
+        self.deleted = set()
+        del_file = os.path.join(path, name + '.del')
+        if os.path.isfile(del_file):
+            with open(del_file) as f:
+                self.deleted = set(int(line) for line in f if line.strip())
+
+    def live_docs(self):
+        return [doc for doc in self.index.indexed_docs()
+            if doc not in self.deleted]
+
+    def save_deleted(self, path):
+        with open(os.path.join(path, self.name + '.del'), 'w') as out:
+            for doc in sorted(self.deleted):
+                out.write(str(doc) + '\n')
+
+
+class SegmentedItem:
+    ''' a term's postings across every segment, without tombstoned docs '''
+
+    def __init__(self, term, parts):
+        self.term = term
+        self.parts = parts # (segment item, tombstones), oldest first
+        self._df = None
+        self._posting = None
+
+    def _live_postings(self, item, deleted):
+        if not deleted:
+            return item.iter_postings()
+        return ((doc, tf) for doc, tf in item.iter_postings()
+            if doc not in deleted)
+
+    def _live_positions(self, item, deleted):
+        return ((doc, posting.positions) for doc, posting
+            in item.posting.items() if doc not in deleted)
+
+    def doc_freq(self):
+        ''' number of live docs with the term '''
+        if self._df is None:
+            self._df = sum(item.doc_freq() if not deleted else
+                    sum(1 for _ in self._live_postings(item, deleted))
+                for item, deleted in self.parts)
+        return self._df
+
+    def iter_postings(self):
+        ''' stream (docID, tf) pairs in docID order over all segments '''
+        return heapq.merge(*[self._live_postings(item, deleted)
+            for item, deleted in self.parts], key=itemgetter(0))
+
+    def iter_docids(self):
+        return (doc for doc, _ in self.iter_postings())
+
+    def postings_arrays(self):
+        ''' (docIDs, tfs) arrays without merging, when one segment holds
+            every live posting, or once the postings are merged '''
+        if self._posting is not None:
+            return self._posting.docids, self._posting.tfs
+        if len(self.parts) == 1 and not self.parts[0][1]:
+            return self.parts[0][0].postings_arrays()
+        return None
+
+    @property
+    def sorted_postings(self):
+        return array('I', self.iter_docids())
+
+    @property
+    def posting(self):
+        ''' CompactPostings of the live postings, merged on first access '''
+        if self._posting is None:
+            merged = heapq.merge(*[self._live_positions(item, deleted)
+                for item, deleted in self.parts], key=itemgetter(0))
+            docids = array('I')
+            tfs = array('I')
+            positions = array('I')
+            for doc, doc_positions in merged:
+                docids.append(doc)
+                tfs.append(len(doc_positions))
+                positions.extend(doc_positions)
+            self._posting = CompactPostings(docids, tfs, positions)
+        return self._posting
+
+
+class SegmentedLexicon(Mapping):
+    ''' term -> SegmentedItem over every segment '''
+
+    def __init__(self, index):
+        self.index = index
+        self._cache = {} # term -> SegmentedItem, or None if not live
+
+    def _lookup(self, term):
+        if term not in self._cache:
+            parts = [(seg.index.items[term], seg.deleted)
+                for seg in self.index.segments if term in seg.index.items]
+            item = SegmentedItem(term, parts)
+            self._cache[term] = item if parts and item.doc_freq() else None
+        return self._cache[term]
+
+    def __getitem__(self, term):
+        item = self._lookup(term)
+        if item is None:
+            raise KeyError(term)
+        return item
+
+    def __contains__(self, term):
+        return self._lookup(term) is not None
+
+    def get(self, term, default=None):
+        item = self._lookup(term)
+        return default if item is None else item
+
+    def clear(self):
+        ''' forget every term looked up, after the segments change '''
+        self._cache.clear()
+
+    def __iter__(self):
+        # Segment lexicons are sorted the same way, so merge them
+        last = None
+        for term in heapq.merge(*[seg.index.items
+                for seg in self.index.segments],
+                key=lambda t: t.encode('utf-8')):
+            if term != last and term in self:
+                yield term
+            last = term
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class SegmentedDocVectors(Mapping):
+    ''' docID -> {term: weight}, weighted with the current idfs '''
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, doc):
+        return self.index.doc_vector(doc)[0]
+
+    def __iter__(self):
+        return iter(sorted(self.index.doc_segment))
+
+    def __len__(self):
+        return len(self.index.doc_segment)
+
+
+class SegmentedDocNorms(SegmentedDocVectors):
+    ''' docID -> length of its (un-normalized) tf-idf vector '''
+
+    def __getitem__(self, doc):
+        return self.index.doc_vector(doc)[1]
+
+
+class SegmentedIndex:
+
+    def __init__(self, path, codec='raw', max_segments=8):
+        self.path = path
+        self.codec = codec
+        self.max_segments = max_segments
+        self.analyzer = util.default_analyzer()
+        os.makedirs(path, exist_ok=True)
+        self.analyzer.load(path)
+
+        names = []
+        if not is_segmented(path):
+            names = self._adopt()
+        else:
+            with open(os.path.join(path, MANIFEST)) as f:
+                names = [line.strip() for line in f if line.strip()]
+        self.segments = [Segment(path, name) for name in names]
+
+        self.items = SegmentedLexicon(self)
+        self.doc_tfidf = SegmentedDocVectors(self)
+        self.doc_norms = SegmentedDocNorms(self)
+        self._refresh()
+
+    def _refresh(self):
+        ''' rebuild the docID -> segment map after a change '''
+        self.doc_segment = {}
+        self.doc_lengths = {}
+        for seg in self.segments:
+            for doc in seg.live_docs():
+                self.doc_segment[doc] = seg
+                if doc in seg.index.doc_lengths:
+                    self.doc_lengths[doc] = seg.index.doc_lengths[doc]
+        self.nDocs = len(self.doc_segment)
+        self.doc_ids = array('I', sorted(self.doc_segment))
+        self._vectors = {}
+        self.items.clear()
+        self.version = next_version()
+
+    def _adopt(self):
+        ''' names of the segments of a directory without a manifest: none
+            if it is empty, or one holding the plain index saved there '''
+        if not os.listdir(self.path):
+            return []
+        if not diskindex.is_disk_index(self.path):
+            raise ValueError(self.path + " holds neither a saved index nor "
+                "a segmented index")
+
+        # Move the postings files into the first segment, then record it
+        #   in the manifest; the doc store, spelling table and stems are
+        #   shared, so they stay at the top
+        name = 'seg_%06d' % 1
+        moving = os.path.join(self.path, name + '.adopt')
+        os.makedirs(moving)
+        for entry in os.listdir(self.path):
+            if entry not in SHARED and entry != name + '.adopt':
+                os.rename(os.path.join(self.path, entry),
+                    os.path.join(moving, entry))
+        os.rename(moving, os.path.join(self.path, name))
+        _write_manifest(self.path, [name])
+        return [name]
+
+    def indexed_docs(self):
+        return self.doc_ids
+
+    def find(self, term):
+        return self.items.get(term)
+
+    def idf(self, term):
+        ''' idf over the live docs of every segment '''
+        item = self.find(term)
+        return log10(self.nDocs / item.doc_freq()) if item else 0
+
+    def max_score(self, term):
+        ''' largest tf / doc length of a term over every segment '''
+        # Tombstoned docs can only make the true bound smaller
+        bounds = [seg.index.max_score(term) for seg in self.segments
+            if term in seg.index.items]
+        if None in bounds:
+            return None
+        return max(bounds, default=0.0)
+
+    def doc_vector(self, doc):
+        ''' (normalized tf-idf vector, vector length) of a live doc '''
+        if doc not in self._vectors:
+            if doc not in self.doc_segment:
+                raise KeyError(doc)
+            seg = self.doc_segment[doc]
+            vector = {}
+            for term, tf in seg.index.doc_tfidf.term_freqs(doc).items():
+                weight = log10(1 + tf) * self.idf(term)
+                if weight: vector[term] = weight
+            norm = sqrt(sum(w * w for w in vector.values()))
+            for term in vector:
+                vector[term] /= norm
+            self._vectors[doc] = (vector, norm)
+        return self._vectors[doc]
+
+    def _save_manifest(self):
+        _write_manifest(self.path, [seg.name for seg in self.segments])
+
+    def _next_name(self):
+        taken = [int(seg.name.split('_')[1]) for seg in self.segments]
+        return 'seg_%06d' % (max(taken, default=0) + 1)
+
+    def _add_segment(self, ii):
+        ''' save an in-memory index as the newest segment '''
+        name = self._next_name()
+        ii.save(os.path.join(self.path, name), self.codec)
+        self.segments.append(Segment(self.path, name))
+
+    def add_documents(self, docs):
+        ''' add docs; a doc whose docID is already live replaces it '''
+        if not docs: return
+        ii = index_docs(docs)
+        ii.compute_tfidf()
+
+        # New docs go in the store too, so their titles are found
+        if has_store(self.path):
+            add_to_store(docs, self.path)
+
+        # Older copies of the same docs are tombstoned
+        self._tombstone(ii.doc_ids)
+        self._add_segment(ii)
+        self._save_manifest()
+        self._refresh()
+
+        if len(self.segments) > self.max_segments:
+            self.merge()
+
+    def delete_documents(self, doc_ids):
+        ''' tombstone docs by docID '''
+        self._tombstone(doc_ids)
+        self._refresh()
+
+    def _tombstone(self, doc_ids):
+        changed = set()
+        for doc in doc_ids:
+            seg = self.doc_segment.get(int(doc))
+            if seg is not None:
+                seg.deleted.add(int(doc))
+                changed.add(seg)
+        for seg in changed:
+            seg.save_deleted(self.path)
+
+    def merge(self):
+        ''' compact every segment into one, dropping tombstoned docs '''
+        if len(self.segments) < 2 and \
+           not any(seg.deleted for seg in self.segments):
+            return
+
+        merged = InvertedIndex()
+        merged.doc_ids = array('I', self.doc_ids)
+        merged.nDocs = len(merged.doc_ids)
+        if len(self.doc_lengths) == merged.nDocs:
+            merged.doc_lengths = dict(self.doc_lengths)
+        for term in self.items:
+            # The live postings are already packed and sorted
+            merged.items[term] = IndexItem(term)
+            merged.items[term].posting = self.items[term].posting
+        merged.sort()
+        merged.compute_tfidf()
+
+        old = self.segments
+        name = self._next_name()
+        merged.save(os.path.join(self.path, name), self.codec)
+        self.segments = [Segment(self.path, name)]
+        self._save_manifest()
+        for seg in old:
+            seg.index = None
+            shutil.rmtree(os.path.join(self.path, seg.name),
+                ignore_errors=True)
+            del_file = os.path.join(self.path, seg.name + '.del')
+            if os.path.isfile(del_file):
+                os.remove(del_file)
+        self._refresh()
+
+
+def test():
+    ''' add to, update and delete from a copy of a saved Cranfield index '''
+    from cran import CranFile
+    from doc import Document, Collection, write_store
+    from index import build_index
+    from resources import data_path
+    import spelling
+
+    cf = CranFile(data_path("cran.all"))
+    docs = list(cf.docs)
+    path = "test_segments"
+    shutil.rmtree(path, ignore_errors=True)
+    ii = build_index(docs)
+    ii.compute_tfidf()
+    ii.save(path)
+    write_store(docs, path)
+    spelling.build(path, index_vocab=True)
+
+    # A plain saved index becomes the first segment
+    si = SegmentedIndex(path)
+    print("Saved index adopted as one segment:", is_segmented(path) and
+        len(si.segments) == 1 and si.nDocs == ii.nDocs)
+    print("Doc store and spelling table stay with the index:",
+        has_store(path) and spelling.has_table(path))
+    print("Adopted index finds what the saved index does:",
+        si.find("experiment").doc_freq() == ii.find("experiment").doc_freq())
+
+    first = docs[0]
+    si.add_documents([Document(str(ii.nDocs + 1), "an added doc",
+        first.author, first.body)])
+    print("Added doc is counted:", si.nDocs == 1401)
+    print("Added doc is in the doc store:",
+        Collection.open(path).find(1401).title == "an added doc")
+    print("Reopened index keeps every doc:", open_index(path).nDocs == 1401)
+    print("Added doc is in the postings:",
+        1401 in si.find("experiment").sorted_postings)
+
+    # Lookups are kept until the index changes
+    item = si.find("experiment")
+    print("Term lookups are reused:", si.find("experiment") is item and
+        item.posting is item.posting)
+    si.delete_documents([1401])
+    print("Deleted doc is dropped:", si.nDocs == 1400 and
+        1401 not in si.find("experiment").sorted_postings)
+    si.merge()
+    print("Merging keeps the shared files:", len(si.segments) == 1 and
+        has_store(path) and spelling.has_table(path) and
+        Collection.open(path).find(5).title == docs[4].title)
+
+    # Anything else in the directory is left alone
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    open(os.path.join(path, "notes.txt"), 'w').close()
+    try:
+        SegmentedIndex(path)
+        print("A directory without an index is refused: False")
+    except ValueError:
+        print("A directory without an index is refused:",
+            os.listdir(path) == ["notes.txt"])
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def main(argv):
+    if len(argv) < 3 or argv[2] not in ('add', 'delete', 'merge', 'info'):
+        print("Syntax: python segments.py <index-dir> add <cran.all path>")
+        print("        python segments.py <index-dir> delete <docID> ...")
+        print("        python segments.py <index-dir> merge")
+        print("        python segments.py <index-dir> info")
+        return
+
+    si = SegmentedIndex(argv[1])
+    if argv[2] == 'add':
+        from cran import CranFile
+        si.add_documents(CranFile(argv[3]).docs)
+    elif argv[2] == 'delete':
+        si.delete_documents(int(doc) for doc in argv[3:])
+    elif argv[2] == 'merge':
+        si.merge()
+
+    print("Segments:", len(si.segments))
+    for seg in si.segments:
+        print(" ", seg.name, len(seg.index.indexed_docs()), "docs,",
+            len(seg.deleted), "deleted")
+    print("Live docs:", si.nDocs)
+
+
+if __name__ == '__main__':
+    from sys import argv
+    main(argv)
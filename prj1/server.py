@@ -0,0 +1,381 @@
+'''
+
+Query service: a long-running process that answers queries over a warm
+index
+
+    Starting query.py costs far more than answering one query: the index,
+    the spelling tables, the stem memo and the collection are all loaded
+    first. The server pays for that once. It listens on a local TCP port
+    ("host:port") or a Unix socket (a path) and answers HTTP GETs:
+
+        /query?q=<text>&mode=boolean|vector|phrase[&k=3][&backend=python]
+               [&titles=1][&explain=1][&index=<index-dir>]
+        /stats     queries answered, errors, and latency percentiles
+                   (ms) per mode, over the last LATENCY_WINDOW queries
+
+    Answers are JSON. The event loop (asyncio) only reads requests and
+    writes answers, so any number of clients can be connected at once;
+    the queries themselves run in a pool of worker processes, each with
+    the index loaded once, since scoring is CPU-bound Python that threads
+    would serialize. An index saved in the binary format is memory-mapped,
+    so the workers share its pages. With workers=0 queries run on one
+    thread of the server process instead.
+
+    Each worker keeps its own result cache (see resultcache.py). Latency
+    is measured in the server, from a request being read to its answer
+    being ready, so it includes waiting for a free worker.
+
+    query.py --server <address> sends its query here instead of loading
+    the index.
+
+usage:
+    python server.py serve <index-dir> <address> [--workers n]
+    python server.py bench <address> [--clients n] [--rounds n]
+
+'''
+
+import os
+import sys
+import json
+import socket
+import asyncio
+import http.client
+from collections import deque
+from time import perf_counter
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+MODES = ('boolean', 'vector', 'phrase')
+
+# Latencies kept per mode for the percentiles
+LATENCY_WINDOW = 10000
+
+PERCENTILES = (50, 90, 99)
+
+# The index a worker (or, with workers=0, the server) answers from
+_state = {}
+
+
+def _load(index_dir):
+    ''' open the index and collection, once per worker '''
+    from segments import open_index
+    from doc import Collection, has_store
+    from cran import CranFile
+    from resources import data_path
+
+    ii = open_index(index_dir)
+    # CranFile only reads cran.all if a title or doc length is asked for
+    cf = Collection.open(index_dir) if has_store(index_dir) \
+        else CranFile(data_path("cran.all"))
+    _state.update(index=ii, collection=cf)
+
+
+def _run(mode, text, k=3, backend='python', titles=False, explain=False):
+    ''' answer one query in this process; returns a dict for the JSON '''
+    from query import QueryProcessor
+
+    ii, cf = _state['index'], _state['collection']
+    qp = QueryProcessor(text, ii, cf, backend=backend)
+    answer = {}
+    if explain:
+        answer['plan'] = qp.explain()
+    if mode == 'vector':
+        answer['results'] = [[doc, score] for doc, score in qp.vectorQuery(k)]
+        docs = [doc for doc, _ in answer['results']]
+    else:
+        answer['results'] = docs = qp.booleanQuery() if mode == 'boolean' \
+            else qp.phraseQuery()
+    if titles:
+        answer['titles'] = [" ".join(cf.find(doc).title.split())
+            for doc in docs]
+    return answer
+
+
+def _warm():
+    ''' a throwaway query, so spelling and stemming tables are loaded
+        before the first client waits on them '''
+    _run('vector', "flow", 1)
+    return os.getpid()
+
+
+def percentile(values, p):
+    ''' the nearest-rank p-th percentile of a sorted list '''
+    if not values:
+        return None
+    rank = max(0, -(-p * len(values) // 100) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+class Latencies:
+    ''' the latest query times of each mode, in seconds '''
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.times = {mode: deque(maxlen=window) for mode in MODES}
+        self.count = {mode: 0 for mode in MODES}
+
+    def record(self, mode, seconds):
+        self.times[mode].append(seconds)
+        self.count[mode] += 1
+
+    def summary(self):
+        ''' {mode: {'count', 'p50', 'p90', 'p99', 'max'}}, in ms '''
+        out = {}
+        for mode in MODES:
+            times = sorted(self.times[mode])
+            stats = {'count': self.count[mode]}
+            for p in PERCENTILES:
+                value = percentile(times, p)
+                stats['p%d' % p] = None if value is None else value * 1000
+            stats['max'] = times[-1] * 1000 if times else None
+            out[mode] = stats
+        return out
+
+
+class QueryServer:
+    ''' answers HTTP query requests from a pool of loaded workers '''
+
+    def __init__(self, index_dir, workers=1):
+        self.index_dir = os.path.abspath(index_dir)
+        self.workers = workers
+        if workers:
+            self.pool = ProcessPoolExecutor(workers, initializer=_load,
+                initargs=(index_dir,))
+        else:
+            _load(index_dir)
+            self.pool = ThreadPoolExecutor(1)
+        self.latencies = Latencies()
+        self.errors = 0
+        self.started = perf_counter()
+
+    async def warm(self):
+        ''' load the index in every worker before taking requests '''
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, _warm)
+            for _ in range(max(1, self.workers))])
+
+    async def answer(self, target):
+        ''' (HTTP status, JSON-able body) for a request target '''
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        if url.path == '/stats':
+            return 200, {'index': self.index_dir, 'workers': self.workers,
+                'uptime': perf_counter() - self.started,
+                'errors': self.errors,
+                'latency_ms': self.latencies.summary()}
+        if url.path != '/query':
+            return 404, {'error': "Unknown path " + url.path}
+
+        # query.py names the index it expects
+        if 'index' in params and os.path.realpath(params['index']) != \
+           os.path.realpath(self.index_dir):
+            return 400, {'error': "Serving %s, not %s" % (self.index_dir,
+                params['index'])}
+        mode = params.get('mode', 'vector')
+        if mode not in MODES or 'q' not in params:
+            return 400, {'error': "Give q and a mode of " + ", ".join(MODES)}
+        try:
+            k = int(params.get('k', 3))
+        except ValueError:
+            k = 0
+        if k < 1:
+            return 400, {'error': "k must be a positive number"}
+        start = perf_counter()
+        try:
+            answer = await asyncio.get_running_loop().run_in_executor(
+                self.pool, _run, mode, params['q'], k,
+                params.get('backend', 'python'), params.get('titles') == '1',
+                params.get('explain') == '1')
+        except ValueError as e:
+            # Bad backend, or an index without doc lengths or collection
+            self.errors += 1
+            return 400, {'error': str(e)}
+        except Exception as e:
+            # Anything else (a doc missing from the collection, a worker
+            #   gone) is the server's fault, but the client still gets
+            #   an answer
+            self.errors += 1
+            return 500, {'error': "%s: %s" % (type(e).__name__, e)}
+        self.latencies.record(mode, perf_counter() - start)
+        return 200, answer
+
+    async def handle(self, reader, writer):
+        ''' serve one connection, a request at a time, until it closes '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    # No telling where the next request would start, so
+                    #   answer this one and close
+                    method = None
+
+                if method is None:
+                    status, body = 400, {'error': "Malformed request"}
+                    close = True
+                else:
+                    await reader.readexactly(length)
+                    if method != 'GET':
+                        status, body = 405, {'error': "Only GET is served"}
+                    else:
+                        status, body = await self.answer(target)
+                    close = version == 'HTTP/1.0' or \
+                        headers.get('connection', '').lower() == 'close'
+                data = json.dumps(body).encode('utf-8')
+                writer.write(("HTTP/1.1 %d %s\r\nContent-Type: "
+                    "application/json\r\nContent-Length: %d\r\n%s\r\n" % (
+                    status, http.client.responses.get(status, ''), len(data),
+                    "Connection: close\r\n" if close else "")).encode(
+                    'latin-1') + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass # a line past the stream limit, or a client gone
+                 #   mid-request
+        finally:
+            writer.close()
+
+    async def serve(self, address):
+        await self.warm()
+        if is_unix(address):
+            if os.path.exists(address):
+                os.unlink(address)
+            server = await asyncio.start_unix_server(self.handle, address)
+        else:
+            host, port = split_address(address)
+            server = await asyncio.start_server(self.handle, host, port)
+        print("Serving", self.index_dir, "on", address, "with",
+            self.workers or "no", "worker processes", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def is_unix(address):
+    ''' true for a Unix socket path, false for host:port '''
+    return '/' in address or ':' not in address
+
+
+def split_address(address):
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    ''' HTTPConnection over a Unix socket '''
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def connect(address, timeout=None):
+    ''' an HTTPConnection to a server, which can be reused for requests '''
+    if is_unix(address):
+        return _UnixConnection(address, timeout)
+    return http.client.HTTPConnection(*split_address(address),
+        timeout=timeout)
+
+
+def request(address, path, connection=None, **params):
+    ''' GET path from a server; returns the decoded JSON answer, or raises
+        ValueError with the server's error '''
+    conn = connection or connect(address)
+    try:
+        conn.request('GET', path + ('?' + urlencode(params) if params
+            else ''))
+        response = conn.getresponse()
+        body = json.loads(response.read().decode('utf-8'))
+    finally:
+        if connection is None:
+            conn.close()
+    if response.status != 200:
+        raise ValueError(body.get('error', response.reason))
+    return body
+
+
+def bench(address, clients=8, rounds=2):
+    ''' every Cranfield query, in both modes, from concurrent clients '''
+    from cranqry import loadCranQry
+    from resources import data_path
+
+    qc = loadCranQry(data_path("query.text"))
+    work = [(mode, qc[qid].text) for _ in range(rounds) for qid in qc
+        for mode in ('boolean', 'vector')]
+    done = []
+
+    def client(jobs):
+        conn = connect(address)
+        for mode, text in jobs:
+            start = perf_counter()
+            request(address, '/query', conn, q=text, mode=mode)
+            done.append(perf_counter() - start)
+        conn.close()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(clients) as pool:
+            await asyncio.gather(*[loop.run_in_executor(pool, client,
+                work[i::clients]) for i in range(clients)])
+
+    start = perf_counter()
+    asyncio.run(run())
+    elapsed = perf_counter() - start
+    done.sort()
+    print("%d queries from %d clients in %.2f s: %.0f queries/s" % (
+        len(done), clients, elapsed, len(done) / elapsed))
+    print("client latency (ms): " + ", ".join("p%d %.2f" % (p,
+        percentile(done, p) * 1000) for p in PERCENTILES))
+    print("server:", json.dumps(request(address, '/stats')['latency_ms']))
+
+
+def main(args=None):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Serve queries over a warm index")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="run the query service")
+    serve.add_argument('index_dir', help="saved index (plain or segmented)")
+    serve.add_argument('address', help="host:port, or a Unix socket path")
+    serve.add_argument('--workers', type=int, default=min(4,
+        os.cpu_count() or 1),
+        help="worker processes; 0 answers in the server process")
+    timing = commands.add_parser('bench', help="time a running service")
+    timing.add_argument('address')
+    timing.add_argument('--clients', type=int, default=8)
+    timing.add_argument('--rounds', type=int, default=2,
+        help="times every query is asked, per mode")
+    args = parser.parse_args(args)
+
+    if args.command == 'bench':
+        bench(args.address, args.clients, args.rounds)
+        return
+    server = QueryServer(args.index_dir, args.workers)
+    try:
+        asyncio.run(server.serve(args.address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,258 @@
+'''
+
+Set algebra over sorted docID sequences
+
+    Posting lists are sorted by docID, so AND, OR and AND-NOT can all be
+    done in one merge-style pass over both lists, in time linear in their
+    lengths. When one list is much longer than the other, the pass
+    gallops instead: each docID of the short list is found in the long one
+    with an exponential search followed by a binary search, so the cost
+    depends mostly on the short list.
+
+    NOT is never applied on its own. A negated operand is carried as
+    (postings, True) and folded into the next AND or OR with the rules
+    below, so the complement of a posting list is only built if the whole
+    query is negative.
+
+        a AND b          a AND NOT b = a - b      NOT a AND NOT b = NOT (a OR b)
+        a OR NOT b = NOT (b - a)                  NOT a OR NOT b = NOT (a AND b)
+
+usage (benchmark against the list-based operations query.py used to do):
+    python setops.py index_dir
+
+'''
+
+from bisect import bisect_left
+
+# Gallop once one list is this many times longer than the other
+GALLOP_RATIO = 8
+
+
+def _gallop(seq, target, lo):
+    ''' first index at or after lo with seq[index] >= target '''
+    n = len(seq)
+    step = 1
+    while lo + step < n and seq[lo + step] < target:
+        step *= 2
+    return bisect_left(seq, target, lo + step // 2, min(n, lo + step + 1))
+
+
+def intersect(a, b):
+    ''' docIDs in both a and b '''
+    if len(a) > len(b):
+        a, b = b, a
+    out = []
+    if not a:
+        return out
+
+    if len(b) > GALLOP_RATIO * len(a):
+        j = 0
+        n = len(b)
+        for doc in a:
+            j = _gallop(b, doc, j)
+            if j == n: break
+            if b[j] == doc:
+                out.append(doc)
+        return out
+
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            out.append(a[i])
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+    return out
+
+
+def union(a, b):
+    ''' docIDs in a or b '''
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        return list(b)
+
+    out = []
+    if len(b) > GALLOP_RATIO * len(a):
+        # Copy the runs of b between the docIDs of a
+        j = 0
+        for doc in a:
+            k = _gallop(b, doc, j)
+            out.extend(b[j:k])
+            out.append(doc)
+            j = k + 1 if k < len(b) and b[k] == doc else k
+        out.extend(b[j:])
+        return out
+
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            out.append(a[i])
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            out.append(a[i])
+            i += 1
+        else:
+            out.append(b[j])
+            j += 1
+    out.extend(a[i:])
+    out.extend(b[j:])
+    return out
+
+
+def difference(a, b):
+    ''' docIDs in a but not in b (a AND NOT b) '''
+    if not a or not b:
+        return list(a)
+
+    out = []
+    if len(b) > GALLOP_RATIO * len(a):
+        # Look each docID of a up in b
+        j = 0
+        for doc in a:
+            j = _gallop(b, doc, j)
+            if j == len(b) or b[j] != doc:
+                out.append(doc)
+        return out
+
+    if len(a) > GALLOP_RATIO * len(b):
+        # Copy the runs of a between the docIDs of b
+        i = 0
+        for doc in b:
+            k = _gallop(a, doc, i)
+            out.extend(a[i:k])
+            i = k + 1 if k < len(a) and a[k] == doc else k
+        out.extend(a[i:])
+        return out
+
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            out.append(a[i])
+            i += 1
+        else:
+            j += 1
+    out.extend(a[i:])
+    return out
+
+
+def intersect_all(lists):
+    ''' AND of many lists, shortest first, stopping once empty '''
+    lists = sorted(lists, key=len)
+    if not lists:
+        return []
+    out = list(lists[0])
+    for l in lists[1:]:
+        if not out: break
+        out = intersect(out, l)
+    return out
+
+
+def and_signed(a, a_not, b, b_not):
+    ''' AND of two possibly negated lists; returns (list, negated) '''
+    if a_not and b_not:
+        return union(a, b), True
+    if a_not:
+        return difference(b, a), False
+    if b_not:
+        return difference(a, b), False
+    return intersect(a, b), False
+
+
+def or_signed(a, a_not, b, b_not):
+    ''' OR of two possibly negated lists; returns (list, negated) '''
+    if a_not and b_not:
+        return intersect(a, b), True
+    if a_not:
+        return difference(a, b), True
+    if b_not:
+        return difference(b, a), True
+    return union(a, b), False
+
+
+def resolve(a, a_not, universe):
+    ''' turn a possibly negated list into a plain list of docIDs '''
+    return difference(universe, a) if a_not else list(a)
+
+
+class LegacySetOps:
+    ''' the list operations booleanQuery used before, for comparison '''
+
+    def __init__(self, universe):
+        self.universe = list(universe)
+
+    def resolve(self, a, a_not, universe=None):
+        return [n for n in self.universe if n not in a] if a_not else list(a)
+
+    def and_signed(self, a, a_not, b, b_not):
+        a = self.resolve(a, a_not)
+        b = self.resolve(b, b_not)
+        return [p for p in b if p in a], False
+
+    def or_signed(self, a, a_not, b, b_not):
+        a = self.resolve(a, a_not)
+        b = self.resolve(b, b_not)
+        return sorted(list(set(a + b))), False
+
+
+def benchmark(path, repeat=20):
+    ''' time the boolean cases of query.test() with both implementations '''
+    from time import perf_counter
+    import boolparse
+    from segments import open_index
+    from query import QueryProcessor
+
+    ii = open_index(path)
+    queries = [
+        "measurements of the effect of two-dimensional and three-dimensional roughness elements on boundary layer transition",
+        "hugoniot and infinitesimally",
+        "gravel or stagnation",
+        "slipstream and not diameter",
+        "slipstream and diameter",
+        "diameter or slipstream",
+        "(slipstream and diameter) and thrust",
+        "slipstream or (diameter or thrust)",
+        "(conduction and cylinder and gas) or (radiation and gas) or hugoniot",
+        "flow and not pressure",
+        "not flow and not pressure",
+    ]
+
+    print("%-50s %12s %12s %8s" % ("query", "legacy (ms)", "merge (ms)",
+        "speedup"))
+    merge_ops = boolparse.setops
+    legacy_ops = LegacySetOps(sorted(ii.indexed_docs()))
+    for q in queries:
+        # Spelling correction would swamp the set operations; parse once
+        qp = QueryProcessor(q, ii, None, cache=False)
+        tree = qp.parse_boolean()
+        qp.parse_boolean = lambda: tree
+
+        times = []
+        results = []
+        for ops in (legacy_ops, merge_ops):
+            boolparse.setops = ops
+            start = perf_counter()
+            for _ in range(repeat):
+                result = qp.booleanQuery()
+            times.append((perf_counter() - start) / repeat * 1000)
+            results.append(result)
+        boolparse.setops = merge_ops
+
+        print("%-50s %12.3f %12.3f %7.1fx%s" % (q[:50], times[0], times[1],
+            times[0] / times[1] if times[1] else 0,
+            "" if results[0] == results[1] else "  RESULTS DIFFER"))
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) != 2:
+        print("Syntax: python setops.py <index-location>")
+    else:
+        benchmark(argv[1])
@@ -0,0 +1,369 @@
+'''
+
+Symmetric delete (SymSpell) spelling correction
+
+    norvig_spell.correction makes every string one and two edits away
+    from a word and looks each one up, which is hundreds of thousands of
+    strings for a word that is not close to anything. Edits are only
+    needed in one direction, though: two words are within edit distance d
+    when deleting at most d letters from each gives the same string. So
+    every dictionary word is filed under each string its deletes give,
+    once, and a query word only generates its own deletes (tens of them)
+    and looks those up. Each word found is checked with a real edit
+    distance (with transpositions, like Norvig's edits1).
+
+    The correction is picked the way Norvig's is: the word itself if it
+    is known, else the most frequent word at the smallest distance; ties
+    go to the first word in sorted order.
+
+    The delete table can be saved into an index directory, as a few flat
+    files that are mmapped on load like the index itself:
+
+        spelling/meta     magic, version, max distance, words, keys
+        spelling/words    every word, utf-8, '\\n' separated, sorted
+        spelling/counts   the count of every word
+        spelling/keys     every delete string, utf-8, sorted
+        spelling/keyidx   where each key starts in keys (keys + 1 entries)
+        spelling/postidx  where each key's words start in posts (keys + 1)
+        spelling/posts    word numbers under each key
+
+    Queries go through a Corrector, which skips any word whose stem is
+    already in the index, and keeps recent corrections in an LRU cache.
+    An index saved without a table is corrected from one built over
+    big.txt, which takes a while; it is only built for the first word
+    the index does not know.
+
+usage:
+    python spelling.py build <index-dir> [--index-vocab] [--max-distance N]
+    python spelling.py report [<index-dir>]
+
+'''
+
+import os
+import struct
+from functools import lru_cache
+from array import array
+import util
+import resources
+from diskindex import _to_bytes, _from_bytes, _map
+
+MAGIC = b'CRANSPL\0'
+VERSION = 1
+
+# magic, version, max distance, words, keys
+META = struct.Struct('<8sIIII')
+
+MAX_DISTANCE = 2
+
+# Corrections kept by each Corrector
+CACHE_SIZE = 4096
+
+
+def deletes(word, max_distance):
+    ''' {string: deletes needed} for every string up to max_distance
+        letters can be deleted from word to give '''
+    found = {word: 0}
+    frontier = {word}
+    for distance in range(1, max_distance + 1):
+        frontier = set(w[:i] + w[i+1:] for w in frontier
+            for i in range(len(w)))
+        for w in frontier:
+            found.setdefault(w, distance)
+    return found
+
+
+def edit_distance(a, b, limit):
+    ''' Damerau-Levenshtein (optimal string alignment) distance of a and
+        b, or limit + 1 if it is more than limit '''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i-1] == b[j-1] else 1
+            cur[j] = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + cost)
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                cur[j] = min(cur[j], prev2[j-2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1] if prev[-1] <= limit else limit + 1
+
+
+class SymSpell:
+    ''' symmetric delete spelling corrector over word counts '''
+
+    def __init__(self, counts, max_distance=MAX_DISTANCE):
+        self.counts = dict(counts)
+        self.max_distance = max_distance
+        self.deletes = {}
+        for word in self.counts:
+            for key in deletes(word, max_distance):
+                self.deletes.setdefault(key, []).append(word)
+
+    def words_under(self, key):
+        ''' dictionary words with key among their deletes '''
+        return self.deletes.get(key, ())
+
+    def correction(self, word):
+        ''' most probable spelling correction for word '''
+        if word in self.counts or not word:
+            return word
+
+        # Deletes of the word, fewest deletes first
+        by_distance = {}
+        for key, distance in deletes(word, self.max_distance).items():
+            by_distance.setdefault(distance, []).append(key)
+
+        best = None # (distance, -count, word)
+        seen = set()
+        for distance in sorted(by_distance):
+            # Words found from here on are at least this far away
+            if best is not None and best[0] < distance:
+                break
+            for key in by_distance[distance]:
+                for candidate in self.words_under(key):
+                    if candidate in seen: continue
+                    seen.add(candidate)
+                    found = edit_distance(word, candidate, self.max_distance)
+                    if found > self.max_distance: continue
+                    rank = (found, -self.counts[candidate], candidate)
+                    if best is None or rank < best:
+                        best = rank
+        return best[2] if best else word
+
+    def save(self, path):
+        ''' write the delete table to path/spelling '''
+        out_dir = os.path.join(path, 'spelling')
+        os.makedirs(out_dir, exist_ok=True)
+        words = sorted(self.counts)
+        word_ids = {word: i for i, word in enumerate(words)}
+        keys = sorted(self.deletes, key=lambda k: k.encode('utf-8'))
+
+        with open(os.path.join(out_dir, 'words'), 'wb') as out:
+            out.write('\n'.join(words).encode('utf-8'))
+        with open(os.path.join(out_dir, 'counts'), 'wb') as out:
+            out.write(_to_bytes(array('I', (self.counts[w] for w in words))))
+
+        key_idx = array('I', [0])
+        post_idx = array('I', [0])
+        posts = array('I')
+        with open(os.path.join(out_dir, 'keys'), 'wb') as out:
+            for key in keys:
+                encoded = key.encode('utf-8')
+                out.write(encoded)
+                key_idx.append(key_idx[-1] + len(encoded))
+                posts.extend(sorted(word_ids[w] for w in self.deletes[key]))
+                post_idx.append(len(posts))
+        for name, arr in (('keyidx', key_idx), ('postidx', post_idx),
+                ('posts', posts)):
+            with open(os.path.join(out_dir, name), 'wb') as out:
+                out.write(_to_bytes(arr))
+
+        # The meta file goes last, so a half-written table will not load
+        with open(os.path.join(out_dir, 'meta'), 'wb') as out:
+            out.write(META.pack(MAGIC, VERSION, self.max_distance,
+                len(words), len(keys)))
+
+
+class DiskSymSpell(SymSpell):
+    ''' a SymSpell whose delete table stays in a saved index directory '''
+
+    def __init__(self, path):
+        in_dir = os.path.join(path, 'spelling')
+        with open(os.path.join(in_dir, 'meta'), 'rb') as f:
+            magic, version, self.max_distance, n_words, self.n_keys = \
+                META.unpack(f.read())
+        if magic != MAGIC or version > VERSION:
+            raise ValueError(in_dir + " is not a spelling table")
+
+        with open(os.path.join(in_dir, 'words'), 'rb') as f:
+            self.words = f.read().decode('utf-8').split('\n') \
+                if n_words else []
+        counts = _from_bytes('I', _map(os.path.join(in_dir, 'counts')))
+        self.counts = dict(zip(self.words, counts))
+
+        self.keys = _map(os.path.join(in_dir, 'keys'))
+        self.key_idx = _from_bytes('I', _map(os.path.join(in_dir, 'keyidx')))
+        self.post_idx = _from_bytes('I',
+            _map(os.path.join(in_dir, 'postidx')))
+        self.posts = _from_bytes('I', _map(os.path.join(in_dir, 'posts')))
+
+    def _key_at(self, i):
+        return self.keys[self.key_idx[i] : self.key_idx[i + 1]]
+
+    def words_under(self, key):
+        ''' binary search the sorted keys '''
+        target = key.encode('utf-8')
+        lo, hi = 0, self.n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.n_keys or self._key_at(lo) != target:
+            return ()
+        return [self.words[w] for w in
+            self.posts[self.post_idx[lo] : self.post_idx[lo + 1]]]
+
+
+def has_table(path):
+    ''' true if an index directory holds a saved spelling table '''
+    return path is not None and \
+        os.path.isfile(os.path.join(path, 'spelling', 'meta'))
+
+
+def index_vocabulary(counts, index):
+    ''' the words of counts that can matter to a query on index: those
+        whose stem is indexed, and stopwords, which are dropped anyway '''
+    analyzer = index.analyzer
+    return {word: n for word, n in counts.items()
+        if analyzer.is_stopword(word) or analyzer.stem(word) in index.items}
+
+
+_default = None
+
+def default_symspell():
+    ''' a SymSpell over every word of big.txt, built once per process '''
+    global _default
+    if _default is None:
+        _default = SymSpell(resources.word_counts())
+    return _default
+
+
+class Corrector:
+    ''' query-time spelling correction for one index '''
+
+    def __init__(self, symspell=None, lexicon=None, cache_size=CACHE_SIZE,
+                 analyzer=None, factory=None):
+        # With a factory instead of a SymSpell, the SymSpell is made when
+        #   the first word needs correcting
+        self._symspell = symspell
+        self._factory = factory
+        self.lexicon = lexicon
+        self.analyzer = analyzer or util.default_analyzer()
+        self.correction = lru_cache(maxsize=cache_size)(self._correct)
+
+    @property
+    def symspell(self):
+        if self._symspell is None:
+            self._symspell = self._factory()
+        return self._symspell
+
+    def _correct(self, word):
+        # Words the index already knows need no correcting
+        if self.lexicon is not None and word and \
+           self.analyzer.stem(word) in self.lexicon:
+            return word
+        return self.symspell.correction(word)
+
+
+def for_index(index):
+    ''' the Corrector of an index, using its saved spelling table if it
+        has one; made once per index '''
+    corrector = getattr(index, '_corrector', None)
+    if corrector is None:
+        path = getattr(index, 'path', None)
+        if has_table(path):
+            corrector = Corrector(DiskSymSpell(path), index.items,
+                analyzer=index.analyzer)
+        else:
+            corrector = Corrector(None, index.items,
+                analyzer=index.analyzer, factory=default_symspell)
+        index._corrector = corrector
+    return corrector
+
+
+def build(path, index_vocab=False, max_distance=MAX_DISTANCE):
+    ''' save a spelling table built from big.txt into an index directory '''
+    counts = resources.word_counts()
+    if index_vocab:
+        from segments import open_index
+        counts = index_vocabulary(counts, open_index(path))
+    SymSpell(counts, max_distance).save(path)
+    return len(counts)
+
+
+def _misspell(word, distance, rng):
+    ''' word with distance random Norvig-style edits '''
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    for _ in range(distance):
+        i = rng.randrange(len(word) + 1)
+        kind = rng.choice(['delete', 'insert', 'replace', 'transpose'])
+        if kind == 'delete' and i < len(word):
+            word = word[:i] + word[i+1:]
+        elif kind == 'transpose' and i < len(word) - 1:
+            word = word[:i] + word[i+1] + word[i] + word[i+2:]
+        elif kind == 'replace' and i < len(word):
+            word = word[:i] + rng.choice(letters) + word[i+1:]
+        else:
+            word = word[:i] + rng.choice(letters) + word[i:]
+    return word
+
+
+def report(path=None, samples=200, seed=7):
+    ''' per-token latency of Norvig's corrector and SymSpell on words
+        one and two edits from a dictionary word '''
+    import random
+    from time import perf_counter
+    import norvig_spell
+
+    start = perf_counter()
+    built = SymSpell(norvig_spell.WORDS)
+    print("SymSpell built from %d words in %.2f s" % (len(built.counts),
+        perf_counter() - start))
+    spellers = [("symspell", built)]
+    if has_table(path):
+        start = perf_counter()
+        spellers.append(("saved", DiskSymSpell(path)))
+        print("Saved table loaded in %.2f ms" % ((perf_counter() - start)
+            * 1000))
+
+    rng = random.Random(seed)
+    words = sorted(w for w in norvig_spell.WORDS if len(w) > 3)
+    print("%-12s %14s %10s %10s" % ("", "ms per token", "speedup",
+        "agreement"))
+    for distance in (1, 2):
+        tokens = [_misspell(rng.choice(words), distance, rng)
+            for _ in range(samples)]
+
+        start = perf_counter()
+        expected = [norvig_spell.correction(t) for t in tokens]
+        norvig_ms = (perf_counter() - start) / samples * 1000
+        print("distance %d" % distance)
+        print("  %-10s %14.3f" % ("norvig", norvig_ms))
+
+        for name, speller in spellers:
+            start = perf_counter()
+            got = [speller.correction(t) for t in tokens]
+            ms = (perf_counter() - start) / samples * 1000
+            # Norvig breaks ties between equally common words arbitrarily
+            agree = sum(e == g or norvig_spell.WORDS[e] ==
+                    norvig_spell.WORDS[g] for e, g in zip(expected, got))
+            print("  %-10s %14.3f %9.0fx %9.1f%%" % (name, ms,
+                norvig_ms / ms, 100 * agree / samples))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="SymSpell spelling tables")
+    sub = parser.add_subparsers(dest='command')
+    b = sub.add_parser('build', help="save a spelling table into an index")
+    b.add_argument('index_dir')
+    b.add_argument('--index-vocab', action='store_true',
+        help="only keep words whose stem is in the index")
+    b.add_argument('--max-distance', type=int, default=MAX_DISTANCE)
+    r = sub.add_parser('report', help="latency against norvig_spell")
+    r.add_argument('index_dir', nargs='?')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        n = build(args.index_dir, args.index_vocab, args.max_distance)
+        print("Spelling table of", n, "words saved to", args.index_dir)
+    elif args.command == 'report':
+        report(args.index_dir)
+    else:
+        parser.print_help()
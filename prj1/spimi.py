@@ -0,0 +1,142 @@
+'''
+
+Block files and the k-way merge for memory-bounded (SPIMI) indexing
+
+    When an InvertedIndex is given a memory limit, indexDoc spills the
+    terms it holds to a block file whenever their estimated size passes
+    the limit, and starts a new block. A block file is a run of terms in
+    sorted order:
+
+        term length, term (utf-8), df,
+        then df times: docID, tf, tf positions
+
+    all as little-endian 32-bit ints. Saving the index merges the blocks
+    with a streaming k-way merge straight into the diskindex format, so
+    only one term's postings are held at a time. Blocks are written in doc
+    order, so a term's postings from each block just follow one another.
+
+    Doc tf-idf weights can only be worked out once a term is fully merged,
+    but the doc vectors are stored by docID. The weights are sorted by
+    docID on the side, spilling bounded runs to temporary files that are
+    merged the same way.
+
+'''
+
+import os
+import struct
+import heapq
+import tempfile
+from array import array
+from itertools import groupby
+from operator import itemgetter
+from math import log10, sqrt
+from diskindex import IndexWriter, _to_bytes, _from_bytes
+
+# Rough heap cost of the building blocks of an in-memory index, used to
+#   decide when a block is full: an IndexItem, a Posting, and one position
+TERM_BYTES = 400
+POSTING_BYTES = 200
+POSITION_BYTES = 36
+
+# docID, term number, tf, weight; as spilled while sorting doc vectors
+WEIGHT_RECORD = struct.Struct('<IIId')
+
+INT = struct.Struct('<I')
+
+
+def write_block(items, filename):
+    ''' write a dict of term -> IndexItem to a block file '''
+    with open(filename, 'wb') as out:
+        for term in sorted(items, key=lambda t: t.encode('utf-8')):
+            encoded = term.encode('utf-8')
+            posting = items[term].posting
+            out.write(INT.pack(len(encoded)))
+            out.write(encoded)
+            out.write(INT.pack(len(posting)))
+            for doc in sorted(posting):
+                positions = array('I', sorted(posting[doc].positions))
+                out.write(_to_bytes(array('I', [doc, len(positions)])))
+                out.write(_to_bytes(positions))
+
+
+def read_block(filename):
+    ''' stream (term bytes, [(docID, positions), ...]) from a block file '''
+    with open(filename, 'rb') as f:
+        while True:
+            head = f.read(INT.size)
+            if not head:
+                return
+            term = f.read(INT.unpack(head)[0])
+            df = INT.unpack(f.read(INT.size))[0]
+            postings = []
+            for _ in range(df):
+                doc, tf = _from_bytes('I', f.read(2 * INT.size))
+                postings.append((doc, _from_bytes('I', f.read(tf * INT.size))
+                    .tolist()))
+            yield term, postings
+
+
+def _spill_weights(weights, tmp_dir):
+    ''' sort a run of (docID, term number, tf, weight) and write it out '''
+    weights.sort()
+    fd, filename = tempfile.mkstemp(suffix='.vec', dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as out:
+        for record in weights:
+            out.write(WEIGHT_RECORD.pack(*record))
+    return filename
+
+
+def _read_weights(filename):
+    with open(filename, 'rb') as f:
+        while True:
+            record = f.read(WEIGHT_RECORD.size)
+            if not record:
+                return
+            yield WEIGHT_RECORD.unpack(record)
+
+
+def merge_blocks(blocks, path, n_docs, doc_ids, codec='raw', memory_limit=0,
+        tmp_dir=None, doc_lengths=None):
+    ''' k-way merge block files into an index directory at path '''
+    writer = IndexWriter(path, codec, doc_lengths)
+
+    # Squared doc vector lengths, indexed by docID
+    norms = array('d')
+
+    # Weights waiting to be sorted by docID
+    weights = []
+    max_weights = max(1, memory_limit // 64) if memory_limit else 1 << 20
+    runs = []
+
+    merged = heapq.merge(*[read_block(b) for b in blocks], key=itemgetter(0))
+    for term, group in groupby(merged, key=itemgetter(0)):
+        # heapq.merge keeps equal terms in block order, i.e. doc order
+        postings = [p for _, block_postings in group for p in block_postings]
+        term_id = writer.add_term(term.decode('utf-8'), postings)
+
+        # A term in every doc has an idf of 0; its weights are still
+        #   stored, to keep the term frequencies
+        idf = log10(n_docs / len(postings))
+        for doc, positions in postings:
+            weight = log10(1 + len(positions)) * idf
+            if doc >= len(norms):
+                norms.extend([0.0] * (doc + 1 - len(norms)))
+            norms[doc] += weight * weight
+            weights.append((doc, term_id, len(positions), weight))
+
+        if len(weights) >= max_weights:
+            runs.append(_spill_weights(weights, tmp_dir))
+            weights = []
+
+    norms = {doc: sqrt(sq) for doc, sq in enumerate(norms) if doc > 0}
+
+    # Normalized doc vectors, merged back into docID order
+    weights.sort()
+    by_doc = heapq.merge(weights, *[_read_weights(r) for r in runs])
+    vectors = ((doc, [(term_id, tf, weight / norms[doc] if weight else 0.0)
+            for _, term_id, tf, weight in group])
+        for doc, group in groupby(by_doc, key=itemgetter(0)))
+    writer.finish(n_docs, doc_ids, norms, vectors)
+
+    for r in runs:
+        os.remove(r)
@@ -0,0 +1,240 @@
+'''
+
+Top-k vector scoring with MaxScore dynamic pruning
+
+    vectorQuery scores a doc d against the words t of a query as
+
+        score(d) = sum over t of  w(t) * tf(t, d) / len(d)
+
+    with w(t) = log10(1 + query tf) * idf(t), added once for every time
+    the word appears in the query. A word can therefore add at most
+
+        bound(t) = n(t) * w(t) * max over d of tf(t, d) / len(d)
+
+    to any score, where n(t) counts its occurrences in the query. The max
+    is stored per term when the index is saved (see diskindex.py and
+    InvertedIndex.max_score).
+
+    MaxScore (Turtle and Flood, 1995) walks the posting lists document at
+    a time in docID order and keeps the best k docs in a heap. Terms are
+    sorted by bound; once the bounds of the smallest few add up to no more
+    than the k-th best score so far, a doc that has only those terms cannot
+    make the top k, so those lists stop producing candidates and are only
+    searched for docs found through the other lists. A candidate is
+    dropped as soon as its partial score plus the bounds of the lists not
+    yet looked at cannot beat the k-th score.
+
+    A doc that is scored gets exactly the same floating point sum as the
+    exhaustive loop, and ties are broken by docID in both, so the top k
+    are the same.
+
+    Cursors walk the postings where they are stored: the docID and tf
+    arrays of a built index, or the mapped postings file of a raw saved
+    index, read in place, so a list that is only searched is not read
+    past the docs looked up. Postings compressed with a gap codec are
+    decoded as the cursor moves (see StreamCursor).
+
+    Most Cranfield queries have many words with similar bounds, so few
+    lists stop producing candidates, and in CPython the bookkeeping per
+    candidate still costs about what the dict updates it saves do: with
+    the top 10 over the Cranfield queries, 193 docs are scored instead of
+    871, in 2.4 ms against 1.5 ms, and at 10 times Cranfield (see
+    bench.py) 1232 instead of 10581, in 26 ms against 24 ms. vectorQuery
+    only prunes when asked to (prune=True).
+
+usage (compare against exhaustive scoring on the Cranfield queries):
+    python topk.py index_dir [k]
+
+'''
+
+import heapq
+from setops import _gallop
+
+# Past the largest docID
+END = 1 << 32
+
+# Slack on the bounds, so rounding can never prune a doc that belongs
+EPS = 1e-9
+
+
+def cursor(item, weight, count, bound):
+    ''' a cursor over an item's postings: over its docID and tf arrays in
+        place where the index has them, or decoding as it goes '''
+    arrays = item.postings_arrays()
+    if arrays is None:
+        return StreamCursor(item.iter_postings(), weight, count, bound)
+    return Cursor(arrays[0], arrays[1], weight, count, bound)
+
+
+class Cursor:
+    ''' a position in one term's docID-sorted postings, held as arrays
+        (or memoryviews of the mapped index), which are not copied '''
+
+    def __init__(self, docids, tfs, weight, count, bound):
+        self.docids = docids
+        self.tfs = tfs
+        self.n = len(docids)
+        self.weight = weight # added per occurrence of the word in the query
+        self.full = count * weight # added for the word over the query
+        self.bound = count * weight * bound # most the term adds to a score
+        self.i = -1
+        self.next()
+
+    def next(self):
+        ''' move to the next posting; doc and tf are the current one's '''
+        self.i += 1
+        if self.i < self.n:
+            self.doc = self.docids[self.i]
+            self.tf = self.tfs[self.i]
+        else:
+            self.doc = END
+
+    def seek(self, doc):
+        ''' move to the first posting at or after doc '''
+        if self.doc >= doc:
+            return
+        self.i = _gallop(self.docids, doc, self.i) - 1
+        self.next()
+
+
+class StreamCursor(Cursor):
+    ''' a cursor over compressed postings, decoded only as far as it
+        moves; seeking has to decode every posting it passes '''
+
+    def __init__(self, postings, weight, count, bound):
+        self.postings = postings
+        self.weight = weight
+        self.full = count * weight
+        self.bound = count * weight * bound
+        self.next()
+
+    def next(self):
+        self.doc, self.tf = next(self.postings, (END, 0))
+
+    def seek(self, doc):
+        while self.doc < doc:
+            self.next()
+
+
+def maxscore(cursors, order, k, doc_length):
+    ''' top k (docID, score) pairs, and the number of docs fully scored
+
+        cursors holds one Cursor per distinct query term; order lists the
+        cursor of every word of the query, in query order, so scores are
+        added up the same way as the exhaustive loop. '''
+    if k <= 0:
+        return [], 0
+
+    # Smallest bound first; upper[i] is the sum of the first i + 1 bounds
+    cursors = sorted(cursors, key=lambda c: c.bound)
+    upper = []
+    for c in cursors:
+        upper.append(c.bound + (upper[-1] if upper else 0.0))
+
+    heap = [] # (score, -docID); the worst of the top k on top
+    threshold = None
+    first_essential = 0
+    essential = cursors
+    scored = 0
+
+    while essential:
+        # The next candidate, and what the lists that produced it give it
+        doc = END
+        for c in essential:
+            if c.doc < doc:
+                doc = c.doc
+        if doc == END:
+            break
+        partial = 0.0
+        matched = []
+        for c in essential:
+            if c.doc == doc:
+                partial += c.full * c.tf
+                matched.append(c)
+        length = doc_length(doc)
+        partial /= length
+
+        # The other lists, biggest bound first, while the doc can still win
+        pruned = False
+        for i in range(first_essential - 1, -1, -1):
+            if (partial + upper[i]) * (1 + EPS) <= threshold:
+                pruned = True
+                break
+            c = cursors[i]
+            c.seek(doc)
+            if c.doc == doc:
+                partial += c.full * c.tf / length
+
+        if not pruned:
+            # Exactly the exhaustive sum: per word, in query order
+            score = None
+            for c in order:
+                if c.doc == doc:
+                    contribution = c.weight * c.tf
+                    score = contribution if score is None \
+                        else score + contribution
+            score /= length
+            scored += 1
+
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -doc))
+            elif (score, -doc) > heap[0]:
+                heapq.heapreplace(heap, (score, -doc))
+            if len(heap) == k:
+                threshold = heap[0][0]
+                while first_essential < len(cursors) and \
+                      upper[first_essential] * (1 + EPS) <= threshold:
+                    first_essential += 1
+                essential = cursors[first_essential:]
+
+        for c in matched:
+            c.next()
+
+    top = sorted(((-neg_doc, score) for score, neg_doc in heap),
+        key=lambda x: (-x[1], x[0]))
+    return top, scored
+
+
+def benchmark(path, k=10):
+    ''' docs scored and latency of both paths over the Cranfield queries '''
+    from time import perf_counter
+    from segments import open_index
+    from cranqry import loadCranQry
+    from query import QueryProcessor
+    from resources import data_path
+
+    ii = open_index(path)
+    qc = loadCranQry(data_path("query.text"))
+
+    totals = {False: [0, 0.0], True: [0, 0.0]}
+    differ = []
+    for qid in qc:
+        # Spelling correction would swamp the scoring; do it once
+        qp = QueryProcessor(qc[qid].text, ii, cache=False)
+        terms = qp.preprocessing()
+        qp.preprocessing = lambda: list(terms)
+
+        results = {}
+        for prune in (False, True):
+            start = perf_counter()
+            results[prune] = qp.vectorQuery(k, prune=prune)
+            totals[prune][1] += perf_counter() - start
+            totals[prune][0] += qp.docs_scored
+        if results[False] != results[True]:
+            differ.append(qid)
+
+    n = len(qc)
+    print("%d queries, top %d" % (n, k))
+    print("%-12s %14s %14s" % ("", "docs scored", "latency (ms)"))
+    for prune, name in ((False, "exhaustive"), (True, "maxscore")):
+        print("%-12s %14.1f %14.3f" % (name, totals[prune][0] / n,
+            totals[prune][1] / n * 1000))
+    print("Results equal:", not differ, differ[:10] if differ else "")
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) not in (2, 3):
+        print("Syntax: python topk.py <index-location> [k]")
+    else:
+        benchmark(argv[1], *[int(a) for a in argv[2:]])